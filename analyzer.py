@@ -1,33 +1,61 @@
+import logging
+
 import matplotlib.pyplot as plt
-from market_data import MongoWrapper
+from market_data import MongoWrapper, time_now
+from screening import ScreeningEngine, format_table
+from utils.downsample import MinMaxBuckets
 
 from pprint import pprint
 
+logger = logging.getLogger(__name__)
+
 
 class Analyzer:
-    def __init__(self):
-        self.db_wrapper = MongoWrapper()
+    def __init__(self, db_wrapper: MongoWrapper = None):
+        self.db_wrapper = db_wrapper or MongoWrapper()
 
-    def rude_filter(self):
-        cursor = self.db_wrapper.get_registered(5000, 1, 40000)
-        data = list(cursor)
-        for item in data:
-            prices = self.db_wrapper.get_price_history(item['app_id'], item['market_hash_name'])
-            print(prices)
+    def rude_filter(self, min_count=5000, min_price=1, max_price=40000, days=30, sort_by='volume', limit=100):
+        if not isinstance(self.db_wrapper, MongoWrapper):
+            logger.warning('Screening runs aggregations of MongoWrapper only')
+            return []
+        rows = ScreeningEngine(self.db_wrapper.db).screen(min_count, min_price, max_price, days, sort_by, limit)
+        print(format_table(rows))
+        return rows
 
-    def show_stats(self, url: str, duration: int):
-        x, y_buy, y_sell = [], [], []
-        histograms = self.db_wrapper.get_histograms(url, duration)
-        if histograms:
-            start = histograms[0]['timestamp']
-            for histogram in histograms:
-                x.append(histogram['timestamp'] - start)
-                y_buy.append(histogram['buy'][0][0])
-                y_sell.append(histogram['sell'][0][0])
+    def show_stats(self, url: str, duration: int, width=1500, path=None):
+        """
+        Plots best buy and sell prices. Long periods are read from OHLC rollups of the coarsest resolution
+        still giving ~width points, short ones from best levels of raw snapshots. Points are downsampled
+        to ~width per line, so memory and plotting time do not depend on duration.
+        :param path: save the chart into file (format by extension, e.g. .png or .svg) instead of showing a window
+        :return: True if there was something to plot
+        """
+        end = time_now()
+        buckets = max(1, width // 2)
+        buy, sell = MinMaxBuckets(end - duration, end, buckets), MinMaxBuckets(end - duration, end, buckets)
+        bars = self.db_wrapper.get_bars(url, duration, buckets)
+        if bars:
+            for bar in bars:
+                for side, line in (('bid', buy), ('ask', sell)):
+                    if bar.get(f'{side}_low') is not None:
+                        line.add(bar['t'], bar[f'{side}_low'])
+                        line.add(bar['t'], bar[f'{side}_high'])
+        else:
+            for histogram in self.db_wrapper.get_histograms(url, duration, top=1, stream=True):
+                if histogram['buy']:
+                    buy.add(histogram['timestamp'], histogram['buy'][0][0])
+                if histogram['sell']:
+                    sell.add(histogram['timestamp'], histogram['sell'][0][0])
+        if len(buy) or len(sell):
+            (x_buy, y_buy), (x_sell, y_sell) = buy.points(), sell.points()
+            start = min(x_buy[:1] + x_sell[:1])
             dpi = 100
-            plt.figure(figsize=(min(300, 10 * len(histograms) // dpi), 10), dpi=dpi)
-            plt.plot(x, y_buy)
-            plt.plot(x, y_sell)
-            plt.show()
-
-
+            plt.figure(figsize=(width // dpi, 10), dpi=dpi)
+            plt.plot([x - start for x in x_buy], y_buy)
+            plt.plot([x - start for x in x_sell], y_sell)
+            if path is None:
+                plt.show()
+            else:
+                plt.savefig(path)
+                plt.close()
+        return bool(len(buy) or len(sell))
@@ -0,0 +1,241 @@
+import asyncio
+import json
+import logging
+from json.decoder import JSONDecodeError
+from multiprocessing import Queue
+from threading import Thread
+from time import time
+
+from aiohttp import ClientError
+
+from market_data import MarketData, DBWrapper, Task, TaskType, listing_description, DEFAULT_PREFERENCES, \
+    SEARCH_TEMPLATE, HISTOGRAM_TEMPLATE, PRICE_HISTORY_TEMPLATE
+from utils.metrics import METRICS
+from utils.page_scanner import ListingScanner
+from utils.rate_limiter import endpoint_class
+from utils.response_cache import ResponseCache
+from utils.scheduler import TaskScheduler
+from utils.session_pool import SessionPool, NoHealthySession
+from utils.steam_session import SteamSession
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMarketObserver:
+    """
+    asyncio version of MarketObserver. All requests go through one pooled SteamSession
+    (or SessionPool of several accounts), amount of simultaneous requests is limited by concurrency.
+    """
+
+    def __init__(self, session, concurrency=100, cache: ResponseCache = None):
+        """
+        :param session: SteamSession or SessionPool
+        :param cache: serves recent pages and merges simultaneous requests of the same url, None - no caching
+        """
+        self.session = session
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.cache = cache
+
+    @classmethod
+    async def create(cls, credentials, concurrency=100, limiter=None, cache: ResponseCache = None):
+        """
+        :param credentials: path to credentials json or list of paths, several accounts are polled through SessionPool
+        :param limiter: RateLimiter or list of them, one per account
+        """
+        paths = [credentials] if isinstance(credentials, str) else list(credentials)
+        limiters = limiter if isinstance(limiter, list) else [limiter] * len(paths)
+        if len(paths) == 1:
+            session = SteamSession(paths[0], connections_limit=concurrency, limiter=limiters[0])
+            await session.try_init_cookies(interactive=False)
+        else:
+            session = await SessionPool.create(paths, connections_limit=concurrency, limiters=limiters)
+        return cls(session, concurrency, cache)
+
+    def get_sessions_stats(self) -> list:
+        if isinstance(self.session, SessionPool):
+            return self.session.get_stats()
+        return [{'username': self.session.username, 'healthy': True, 'requests': self.session.requests_counter}]
+
+    def get_account_preferences(self):
+        return dict(DEFAULT_PREFERENCES)
+
+    async def get_page(self, url) -> str:
+        if self.cache is not None:
+            return await self.cache.get_async(url, self._fetch_page)
+        return await self._fetch_page(url)
+
+    async def _fetch_page(self, url) -> str:
+        async with self.semaphore:
+            try:
+                text, error = await self.session.get_text(url)
+            except (ClientError, asyncio.TimeoutError):
+                logger.warning('Can not connect to the server. Please, check internet connection')
+                return None
+            except NoHealthySession as e:
+                logger.warning('%s', e)
+                return None
+        if error is not None:
+            logger.warning('%s answered: %s', url, error)
+        return text
+
+    async def compose_and_send(self, template, **kwargs):
+        endpoint = endpoint_class(template)
+        try:
+            url = template.format(**kwargs, **self.get_account_preferences())
+            with METRICS.timer('request_seconds', endpoint=endpoint):
+                data = await self.get_page(url)
+            with METRICS.timer('json_decode_seconds', endpoint=endpoint):
+                result = json.loads(data)
+            METRICS.inc('requests', endpoint=endpoint, status='ok')
+            return result
+        except (JSONDecodeError, TypeError):
+            METRICS.inc('requests', endpoint=endpoint, status='error')
+            logger.warning('Unable to decode answer on %s. Maybe page is broken', template)
+
+    async def collect_items(self, app_id, start, q='', sort_column='popular', sort_dir='desc'):
+        return await self.compose_and_send(SEARCH_TEMPLATE, q=q, app_id=app_id, start=start,
+                                           sort_column=sort_column, sort_dir=sort_dir)
+
+    async def get_description(self, item_url: str) -> dict:
+        scanner = ListingScanner()
+        async with self.semaphore:
+            chunks = self.session.iter_chunks(item_url)
+            try:
+                async for chunk in chunks:
+                    if scanner.feed(chunk):
+                        break
+            except (ClientError, asyncio.TimeoutError, NoHealthySession) as e:
+                logger.warning('Description of %s is not loaded: %r', item_url, e)
+                return None
+            finally:
+                await chunks.aclose()
+        return listing_description(item_url, scanner)
+
+    async def get_histogram(self, item_nameid: str) -> dict:
+        return await self.compose_and_send(HISTOGRAM_TEMPLATE, item_nameid=item_nameid)
+
+    async def get_price_history(self, app_id: str, market_hash_name: str):
+        return await self.compose_and_send(PRICE_HISTORY_TEMPLATE, app_id=app_id, market_hash_name=market_hash_name)
+
+    async def close(self):
+        await self.session.aio_destructor()
+
+
+class AsyncMarketData(MarketData):
+    """
+    MarketData running all polls as coroutines in one event loop thread,
+    so amount of polls in flight is limited by observer concurrency instead of threads count.
+    DB wrappers are synchronous, their calls run in the loop's default executor and do not stall the fetches.
+    """
+
+    def __init__(self, queue: Queue, credentials_json_path, db_wrapper: DBWrapper, concurrency=100,
+                 limiter=None, cache: ResponseCache = None, **kwargs):
+        """
+        :param credentials_json_path: path or list of paths, see AsyncMarketObserver.create
+        :param limiter: RateLimiter or list of them, one per account
+        :param cache: see AsyncMarketObserver
+        :param kwargs: see MarketData
+        """
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        observer = self.call(AsyncMarketObserver.create(credentials_json_path, concurrency, limiter, cache))
+        super().__init__(queue, observer, db_wrapper, **kwargs)
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def make_scheduler(self, max_workers):
+        # polls beyond concurrency would only wait for the semaphore, they wait in the scheduler by priority instead
+        return TaskScheduler(self.execute_task, submit=self.submit, on_reschedule=self.mark_dirty,
+                             max_in_flight=self.observer.concurrency)
+
+    def submit(self, task: Task):
+        return asyncio.run_coroutine_threadsafe(self.execute_task_async(task), self.loop)
+
+    async def in_executor(self, function, *args):
+        return await self.loop.run_in_executor(None, function, *args)
+
+    async def get_description_async(self, item_url):
+        with METRICS.timer('description_seconds', source='db'):
+            description = await self.in_executor(self.db_wrapper.get_description, item_url)
+        if description is None:
+            with METRICS.timer('description_seconds', source='web'):
+                description = await self.observer.get_description(item_url)
+            METRICS.inc('requests', endpoint='listings', status='error' if description is None else 'ok')
+            if description is not None:
+                await self.in_executor(self.db_wrapper.add_description, description)
+        return description
+
+    async def onboard_async(self, urls: list) -> dict:
+        descriptions = await asyncio.gather(*(self.get_description_async(url) for url in urls),
+                                            return_exceptions=True)
+        return {url: None if isinstance(description, Exception) else description
+                for url, description in zip(urls, descriptions)}
+
+    async def execute_task_async(self, task: Task):
+        self.scheduler.lag.add(time() - task.start)
+        params = await self.get_description_async(task.url)
+        if params is None:
+            # listing page was not received, the task is polled again next period
+            METRICS.inc('skipped_tasks', priority=task.priority.name.lower(), reason='no_description')
+            logger.warning('No description of %s, poll skipped', task.url)
+            return task
+        if task.task_type == TaskType.PRICE_HISTORY:
+            raw = await self.observer.get_price_history(params['app_id'], params['market_hash_name'])
+            await self.in_executor(self.store_price_history, params['app_id'], params['market_hash_name'], raw)
+        elif task.task_type == TaskType.HISTOGRAM:
+            raw = await self.observer.get_histogram(params['item_nameid'])
+            self.adapt_delay(task, await self.in_executor(self.store_histogram, params['item_nameid'], raw))
+        else:
+            assert False  # Unknown task_type
+        return task
+
+    async def collect_items_async(self, app_id, how_much=500):
+        for page in range(0, how_much, 100):
+            data = await self.observer.collect_items(app_id=app_id, start=page)
+            if not self.register_search_results(data, page, how_much):
+                break
+
+    def get_description(self, item_url):
+        return self.call(self.get_description_async(item_url))
+
+    def execute_task(self, task: Task):
+        return self.call(self.execute_task_async(task))
+
+    def onboard(self, urls: list, workers=None) -> dict:
+        return self.call(self.onboard_async(urls))
+
+    def collect_items(self, app_id, how_much=500):
+        return self.call(self.collect_items_async(app_id, how_much))
+
+    def get_search_page(self, app_id, start, sort_column='popular', sort_dir='desc'):
+        return self.call(self.observer.collect_items(app_id=app_id, start=start,
+                                                     sort_column=sort_column, sort_dir=sort_dir))
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        stats['sessions'] = self.observer.get_sessions_stats()
+        return stats
+
+    async def cancel_pending(self):
+        """
+        Cancels polls in flight and waits for them, then closes async generators they left open (iter_chunks)
+        and waits for DB calls still running in the executor
+        """
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await self.loop.shutdown_asyncgens()
+        await self.loop.shutdown_default_executor()
+
+    def close(self):
+        # the scheduler is not dispatching anymore, polls still in flight would write after DB is closed
+        self.call(self.cancel_pending())
+        super().close()
+        self.call(self.observer.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
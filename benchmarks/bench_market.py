@@ -0,0 +1,233 @@
+"""
+Load test of MarketData polling against a local fake steam (benchmarks/fake_steam.py) and in-memory DB.
+
+    python -m benchmarks.bench_market [--items 100 1000 10000 50000] [--duration 30] [--period 60]
+                                      [--engine sync|async] [--latency 0.05] [--throttle-rate 0.01]
+                                      [--recorded dir] [--cold] [--output results.jsonl]
+
+For every amount of items the tasks are spread uniformly over one period and polled for duration seconds.
+Result is JSON: tasks/sec against the scheduled rate, scheduler lag, CPU seconds per task and memory.
+With --output every run is appended as one JSON line, so runs of different commits can be compared.
+"""
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+from argparse import ArgumentParser
+from multiprocessing import Queue
+from threading import Thread
+from time import perf_counter, process_time, sleep, time
+from urllib import parse
+from urllib.request import urlopen
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from async_market import AsyncMarketData, AsyncMarketObserver
+from benchmarks.fake_steam import item_nameid, start_process
+from benchmarks.memory_db import MemoryWrapper
+from market_data import MarketData, MarketObserver, SimpleStealer, Task, TaskType, LISTING_PREFIX
+from utils.metrics import METRICS
+
+STEAM = 'https://steamcommunity.com'
+
+
+class LocalStealer(SimpleStealer):
+    """
+    SimpleStealer sending steamcommunity.com requests to the fake steam
+    """
+
+    def __init__(self, base_url: str, pool_size=100, limiter=None, max_retries=3):
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    def is_alive(self):
+        return True
+
+    def get_page(self, url) -> str:
+        return super().get_page(url.replace(STEAM, self.base_url, 1))
+
+    def stream_page(self, url, chunk_size=16384):
+        return super().stream_page(url.replace(STEAM, self.base_url, 1), chunk_size)
+
+
+class LocalSession:
+    """
+    SteamSession interface without login, requests go to the fake steam
+    """
+
+    def __init__(self, base_url: str, connections_limit=100):
+        self.base_url = base_url
+        self.username = 'bench'
+        self.requests_counter = 0
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections_limit))
+
+    async def get_text(self, url):
+        self.requests_counter += 1
+        async with self.session.get(url.replace(STEAM, self.base_url, 1)) as response:
+            if response.status == 200:
+                return await response.text(), None
+            return None, response.reason
+
+    async def iter_chunks(self, url, chunk_size=16384):
+        self.requests_counter += 1
+        async with self.session.get(url.replace(STEAM, self.base_url, 1)) as response:
+            if response.status != 200:
+                raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                  status=response.status, message=response.reason)
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def aio_destructor(self):
+        await self.session.close()
+
+
+class LocalAsyncMarketData(AsyncMarketData):
+    def __init__(self, queue: Queue, base_url: str, db_wrapper, concurrency=100):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        observer = self.call(self._create_observer(base_url, concurrency))
+        MarketData.__init__(self, queue, observer, db_wrapper)
+
+    @staticmethod
+    async def _create_observer(base_url, concurrency):
+        return AsyncMarketObserver(LocalSession(base_url, concurrency), concurrency)
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def server_stats(base_url: str) -> dict:
+    with urlopen(f'{base_url}/__stats') as response:
+        return json.loads(response.read())
+
+
+def wait_server(base_url: str, timeout=10):
+    deadline = time() + timeout
+    while True:
+        try:
+            return server_stats(base_url)
+        except OSError:
+            if time() > deadline:
+                raise
+            sleep(0.1)
+
+
+def updates() -> dict:
+    return {key: value for key, value in METRICS.snapshot().items() if key.startswith('updates{')}
+
+
+def make_market(args, queue: Queue, db):
+    if args.engine == 'async':
+        return LocalAsyncMarketData(queue, args.base_url, db, args.concurrency)
+    return MarketData(queue, MarketObserver(LocalStealer(args.base_url, args.concurrency)), db,
+                      max_workers=args.concurrency)
+
+
+def run_scenario(items: int, args) -> dict:
+    rng = random.Random(items)
+    db = MemoryWrapper()
+    urls = [f'{LISTING_PREFIX}730/{parse.quote(f"item{i}")}' for i in range(items)]
+    if not args.cold:
+        for i, url in enumerate(urls):
+            db.descriptions[url] = {'url': url, 'app_id': '730', 'market_hash_name': f'item{i}',
+                                    'item_nameid': str(item_nameid(f'item{i}')), 'is_short_tradable': True}
+    queue = Queue()
+    market = make_market(args, queue, db)
+    now = time()
+    for i, url in enumerate(urls):
+        task_type = TaskType.PRICE_HISTORY if rng.random() < args.price_history_share else TaskType.HISTOGRAM
+        task = Task(task_type, url, args.period, start=now + rng.uniform(0, args.period))
+        market.scheduler.schedule(task)
+        market.registered[task.key] = task
+
+    gc.collect()
+    before_updates, before_server = updates(), server_stats(args.base_url)
+    rss_before = rss_bytes()
+    cpu_start, start = process_time(), perf_counter()
+    runner = Thread(target=market.run, daemon=True)
+    runner.start()
+    sleep(args.duration)
+    queue.put('exit')
+    runner.join()
+    elapsed, cpu = perf_counter() - start, process_time() - cpu_start
+
+    after_updates, after_server = updates(), server_stats(args.base_url)
+    done = {key: value - before_updates.get(key, 0) for key, value in after_updates.items()}
+    completed = sum(done.values())
+    failed = sum(value for key, value in done.items() if 'status="error"' in key)
+    return {
+        'items': items,
+        'scheduled_tasks_per_second': items / args.period,
+        'tasks_per_second': completed / elapsed,
+        'completed': completed,
+        'failed': failed,
+        'lag': market.scheduler.lag.snapshot(),
+        'cpu_seconds_per_task': cpu / completed if completed else None,
+        'rss_bytes': rss_bytes(),
+        'rss_growth_bytes': rss_bytes() - rss_before,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'server_requests': {endpoint: count - before_server['requests'].get(endpoint, 0)
+                            for endpoint, count in after_server['requests'].items()},
+        'server_throttled': after_server['throttled'] - before_server['throttled'],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--items', type=int, nargs='+', default=[100, 1000, 10000, 50000])
+    parser.add_argument('--duration', type=float, default=30, help='seconds of polling per scenario')
+    parser.add_argument('--period', type=int, default=60, help='polling period of every item')
+    parser.add_argument('--engine', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--concurrency', type=int, default=64, help='threads (sync) or requests in flight (async)')
+    parser.add_argument('--price-history-share', type=float, default=0.1, help='share of price history tasks')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake steam answer delay')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--recorded', help='directory with recorded responses, see benchmarks/fake_steam.py')
+    parser.add_argument('--cold', action='store_true', help='descriptions are not known, listing pages are fetched')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', help='append results to this JSON lines file')
+    args = parser.parse_args()
+    args.base_url = f'http://127.0.0.1:{args.port}'
+
+    server = start_process(args.port, args.latency, args.throttle_rate, args.recorded)
+    try:
+        wait_server(args.base_url)
+        result = {
+            'time': int(time()),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'params': {key: value for key, value in vars(args).items() if key not in ('output', 'base_url')},
+            'scenarios': [run_scenario(items, args) for items in args.items],
+        }
+    finally:
+        server.terminate()
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'a') as output:
+            output.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Compares plain and delta encoded order book snapshots: BSON size, encode and decode time.
+
+    python -m benchmarks.bench_orderbook_codec [--input item123.json] [--mongo mongodb://localhost:27017]
+
+--input is a mongoexport dump of one item{item_nameid} collection (one snapshot per line),
+without it a synthetic random walk order book is used.
+--mongo also measures what get_histograms does: find() range scan over the last hours of the day and decoding,
+full ladders and top level only, in a temporary database which is dropped afterwards.
+
+Delta encoding trades read CPU for size: documents are ~47x smaller, but decoding diffs costs more
+than reading plain BSON, so whether range scans get faster depends on disk and cache, measure it with --mongo.
+"""
+import json
+import random
+from argparse import ArgumentParser
+from time import perf_counter
+
+import bson
+
+from utils.orderbook_codec import HistogramEncoder, decode_histograms
+
+RANGE_SCAN_DB = 'bench_orderbook_codec'
+
+
+def load_recorded(path: str) -> list:
+    histograms = []
+    with open(path) as source:
+        for line in source:
+            if line.strip():
+                histogram = json.loads(line)
+                histogram.pop('_id', None)
+                histograms.append(histogram)
+    histograms.sort(key=lambda histogram: histogram['timestamp'])
+    return histograms
+
+
+def generate(count=8640, levels=100, seed=0) -> list:
+    """
+    Snapshots every 10 seconds for a day: mostly unchanged books with a few levels moving at a time
+    """
+    random.seed(seed)
+    sell = {1000 + i * 3: random.randint(1, 30) for i in range(levels)}
+    buy = {990 - i * 3: random.randint(1, 30) for i in range(levels)}
+    histograms = []
+    for i in range(count):
+        for side in (sell, buy):
+            for _ in range(random.choice((0, 0, 0, 1, 2))):
+                price = random.choice(list(side))
+                side[price] = max(1, side[price] + random.randint(-3, 3))
+
+        def ladder(side, reverse):
+            cumulative, result = 0, []
+            for price in sorted(side, reverse=reverse):
+                cumulative += side[price]
+                result.append([price / 100, cumulative])
+            return result
+
+        histograms.append({'timestamp': 1600000000 + 10 * i, 'sell_count': sum(sell.values()),
+                           'buy_count': sum(buy.values()), 'sell': ladder(sell, False), 'buy': ladder(buy, True)})
+    return histograms
+
+
+def run(histograms: list, keyframe_interval: int) -> dict:
+    plain_size = sum(len(bson.encode(histogram)) for histogram in histograms)
+    encoder = HistogramEncoder(keyframe_interval)
+    start = perf_counter()
+    documents = [encoder.encode('bench', histogram) for histogram in histograms]
+    encode_time = perf_counter() - start
+    encoded_size = sum(len(bson.encode(document)) for document in documents)
+
+    start = perf_counter()
+    decoded = list(decode_histograms(documents))
+    decode_time = perf_counter() - start
+    start = perf_counter()
+    list(decode_histograms(documents, top=1))
+    decode_top_time = perf_counter() - start
+
+    start = perf_counter()
+    plain_documents = [bson.decode(bson.encode(histogram)) for histogram in histograms]
+    plain_read_time = perf_counter() - start
+    start = perf_counter()
+    list(decode_histograms(bson.decode(bson.encode(document)) for document in documents))
+    encoded_read_time = perf_counter() - start
+
+    return {
+        'snapshots': len(histograms),
+        'lossless': decoded == plain_documents,
+        'plain_bytes': plain_size,
+        'encoded_bytes': encoded_size,
+        'ratio': plain_size / encoded_size,
+        'encode_seconds': encode_time,
+        'decode_seconds': decode_time,
+        'decode_top1_seconds': decode_top_time,
+        'plain_bson_read_seconds': plain_read_time,
+        'encoded_bson_read_seconds': encoded_read_time,
+    }
+
+
+def time_range_scan(collection, since: int, top=None, repeats=5) -> float:
+    """
+    Best of repeats seconds of get_histograms-like read: from the last keyframe before since, decoded
+    """
+    best = None
+    for _ in range(repeats):
+        start = perf_counter()
+        keyframe = collection.find_one({'k': True, 'timestamp': {'$lte': since}}, {'timestamp': 1},
+                                       sort=[('timestamp', -1)])
+        projection = {'_id': 0}
+        if top is not None:
+            projection.update({'sell': {'$slice': top}, 'buy': {'$slice': top}})
+        cursor = collection.find({'timestamp': {'$gte': since if keyframe is None else keyframe['timestamp']}},
+                                 projection).sort([('timestamp', 1)])
+        for _ in decode_histograms(cursor, top):
+            pass
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_range_scans(histograms: list, keyframe_interval: int, db, hours=6) -> dict:
+    """
+    :param db: pymongo Database, its collections plain and encoded are replaced
+    """
+    encoder = HistogramEncoder(keyframe_interval)
+    since = histograms[-1]['timestamp'] - hours * 3600
+    result = {'range_scan_hours': hours}
+    for name, documents in (('plain', [dict(histogram) for histogram in histograms]),
+                            ('encoded', [encoder.encode('bench', histogram) for histogram in histograms])):
+        db.drop_collection(name)
+        db[name].create_index([('timestamp', 1)], unique=True)
+        db[name].insert_many(documents)
+        result[f'{name}_range_scan_seconds'] = time_range_scan(db[name], since)
+        result[f'{name}_range_scan_top1_seconds'] = time_range_scan(db[name], since, top=1)
+    return result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--input', help='mongoexport dump of item{item_nameid} collection')
+    parser.add_argument('--keyframe-interval', type=int, default=60)
+    parser.add_argument('--mongo', help='MongoDB uri, measure find() range scans in a temporary database')
+    args = parser.parse_args()
+    histograms = load_recorded(args.input) if args.input else generate()
+    result = run(histograms, args.keyframe_interval)
+    if args.mongo:
+        from pymongo import MongoClient
+        client = MongoClient(args.mongo)
+        try:
+            result.update(run_range_scans(histograms, args.keyframe_interval, client[RANGE_SCAN_DB]))
+        finally:
+            client.drop_database(RANGE_SCAN_DB)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
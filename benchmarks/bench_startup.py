@@ -0,0 +1,90 @@
+"""
+Cold start of the command loop: wall time of importing a module in fresh interpreters and the slowest imports.
+
+    python -m benchmarks.bench_startup [--module bot] [--runs 10] [--top 10] [--output results.jsonl]
+
+Result is JSON: median and max import seconds, the slowest modules by cumulative -X importtime
+and heavy modules which were imported although the command loop does not need them.
+"""
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+from time import time
+
+# imported by workers and the plotting process only
+HEAVY = ('matplotlib', 'numpy', 'pymongo', 'requests', 'aiohttp', 'asyncio', 'http.server')
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def git_revision():
+    # not imported from bench_market, it loads everything this benchmark checks for
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(module: str) -> dict:
+    output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def _import_times(code: str) -> dict:
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True).stderr
+    imports = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            imports[name.strip()] = int(cumulative) / 1e6
+    return imports
+
+
+def slowest_imports(module: str, top: int) -> list:
+    """
+    :return: [(module, cumulative seconds)] of the top slowest imports, the module itself included,
+    modules loaded by the bare interpreter (site, .pth files) are left out
+    """
+    interpreter = _import_times('pass')
+    imports = [(name, seconds) for name, seconds in _import_times(f'import {module}').items() if name not in interpreter]
+    return sorted(imports, key=lambda pair: -pair[1])[:top]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--module', default='bot')
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters to start')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to report')
+    parser.add_argument('--output', help='append results to this JSON lines file')
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.runs)]
+    seconds = [run['seconds'] for run in runs]
+    result = {
+        'time': int(time()),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'params': {key: value for key, value in vars(args).items() if key != 'output'},
+        'median_seconds': round(statistics.median(seconds), 4),
+        'max_seconds': round(max(seconds), 4),
+        'heavy_modules': sorted({module for run in runs for module in run['heavy']}),
+        'slowest_imports': [[name, round(cumulative, 4)] for name, cumulative in slowest_imports(args.module, args.top)],
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'a') as output:
+            output.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
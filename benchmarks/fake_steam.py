@@ -0,0 +1,191 @@
+"""
+Local stand-in for steamcommunity.com market endpoints used by MarketData:
+
+    /market/itemordershistogram, /market/pricehistory/, /market/search/render/, /market/listings/{app_id}/{name}
+
+Answers are synthetic or taken from recorded responses (--recorded directory with any of
+itemordershistogram.json, pricehistory.json, search_render.json, listing.html).
+Every answer can be delayed by latency seconds and replaced by 429 with throttle_rate probability.
+
+    python -m benchmarks.fake_steam [--port 8765] [--latency 0.05] [--throttle-rate 0.01] [--recorded dir]
+"""
+import json
+import os
+import random
+import re
+import zlib
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process
+from threading import Lock
+from time import sleep
+from urllib import parse
+
+from utils.rate_limiter import endpoint_class
+
+RECORDED_FILES = {
+    'itemordershistogram': 'itemordershistogram.json',
+    'pricehistory': 'pricehistory.json',
+    'search/render': 'search_render.json',
+    'listings': 'listing.html',
+}
+
+
+def item_nameid(market_hash_name: str) -> int:
+    return zlib.crc32(market_hash_name.encode()) % 1000000000
+
+
+def synthetic_histogram(nameid: int) -> dict:
+    rng = random.Random(nameid)
+    base = rng.randint(100, 100000)
+    # book shape is fixed per item, sell prices jitter between polls like a live market
+    sell, buy, cumulative = [], [], 0
+    for level in range(rng.randint(20, 100)):
+        cumulative += rng.randint(1, 30)
+        sell.append([(base + level * 3 + random.randint(0, 1)) / 100, cumulative, ''])
+    cumulative = 0
+    for level in range(rng.randint(20, 100)):
+        cumulative += rng.randint(1, 30)
+        buy.append([(base - 10 - level * 3) / 100, cumulative, ''])
+    return {'success': 1, 'price_prefix': '', 'price_suffix': 'pуб.',
+            'sell_order_count': f'{sell[-1][1]:,}', 'buy_order_count': f'{buy[-1][1]:,}',
+            'sell_order_graph': sell, 'buy_order_graph': buy}
+
+
+def synthetic_price_history(name: str, days=365) -> dict:
+    rng = random.Random(name)
+    price = rng.uniform(1, 1000)
+    prices = []
+    for day in range(days):
+        for hour in range(0, 24, 24 if day < days - 30 else 1):
+            price = max(0.03, price * rng.uniform(0.97, 1.03))
+            prices.append([_steam_date(day, hour), round(price, 3), str(rng.randint(1, 500))])
+    return {'success': True, 'price_prefix': '', 'price_suffix': 'pуб.', 'prices': prices}
+
+
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def _steam_date(day: int, hour: int) -> str:
+    # 'Jul 02 2014 01: +0', 12 months of 28 days are enough for parsing cost
+    return f'{_MONTHS[day // 28 % 12]} {day % 28 + 1:02d} {2020 + day // 336} {hour:02d}: +0'
+
+
+def synthetic_search(app_id: str, start: int, count: int, total=50000) -> dict:
+    results = [{'asset_description': {'appid': int(app_id), 'market_hash_name': f'item{i}', 'marketable': 1},
+                'sell_listings': 1000 + i % 5000, 'sell_price': 100 + i % 10000}
+               for i in range(start, min(start + count, total))]
+    return {'success': 1, 'start': start, 'pagesize': count, 'total_count': total, 'results': results}
+
+
+def synthetic_listing(nameid: int, padding=200000) -> str:
+    # real listing pages are ~300 KB, the order spread call is placed after g_rgAssets
+    return f'<html><script>var g_rgAssets = {{"marketable":1}};</script>{" " * padding}' \
+           f'<script>Market_LoadOrderSpread( {nameid} );</script>{" " * 50000}</html>'
+
+
+class FakeSteam:
+    def __init__(self, latency=0.0, throttle_rate=0.0, recorded=None, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.recorded = {}
+        for endpoint, file_name in RECORDED_FILES.items():
+            if recorded and os.path.exists(os.path.join(recorded, file_name)):
+                with open(os.path.join(recorded, file_name), encoding='utf-8') as file:
+                    self.recorded[endpoint] = file.read()
+        self.requests = {}
+        self.throttled = 0
+        self._lock = Lock()
+
+    def answer(self, path: str) -> tuple:
+        """
+        :return: status, content type, body
+        """
+        url = parse.urlsplit(path)
+        query = dict(parse.parse_qsl(url.query))
+        endpoint = endpoint_class(url.path)
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+        if self.latency:
+            sleep(self.latency)
+        if throttled:
+            return 429, 'text/plain', b'Too Many Requests'
+        if endpoint == 'listings':
+            name = parse.unquote(url.path.rstrip('/').split('/')[-1])
+            page = self.recorded.get('listings')
+            if page is None:
+                page = synthetic_listing(item_nameid(name))
+            else:
+                page = re.sub(r'Market_LoadOrderSpread\( \d+ \)', f'Market_LoadOrderSpread( {item_nameid(name)} )', page)
+            return 200, 'text/html; charset=utf-8', page.encode()
+        if endpoint in self.recorded:
+            return 200, 'application/json', self.recorded[endpoint].encode()
+        if endpoint == 'itemordershistogram':
+            data = synthetic_histogram(int(query.get('item_nameid', 0)))
+        elif endpoint == 'pricehistory':
+            data = synthetic_price_history(query.get('market_hash_name', ''))
+        elif endpoint == 'search/render':
+            data = synthetic_search(query.get('appid', '730'), int(query.get('start', 0)), int(query.get('count', 100)))
+        else:
+            return 404, 'text/plain', b'Not found'
+        return 200, 'application/json', json.dumps(data).encode()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {'requests': dict(self.requests), 'throttled': self.throttled}
+
+    def make_server(self, port=0, host='127.0.0.1') -> ThreadingHTTPServer:
+        steam = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.path == '/__stats':
+                    status, content_type, body = 200, 'application/json', json.dumps(steam.get_stats()).encode()
+                else:
+                    status, content_type, body = steam.answer(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        return server
+
+
+def _serve(port, latency, throttle_rate, recorded):
+    FakeSteam(latency, throttle_rate, recorded).make_server(port).serve_forever()
+
+
+def start_process(port, latency=0.0, throttle_rate=0.0, recorded=None) -> Process:
+    """
+    Runs the server in a separate process, so its CPU time is not counted as client one
+    """
+    process = Process(target=_serve, args=(port, latency, throttle_rate, recorded), daemon=True)
+    process.start()
+    return process
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every answer')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--recorded', help='directory with recorded responses')
+    args = parser.parse_args()
+    print(f'Serving fake steam on http://127.0.0.1:{args.port}')
+    _serve(args.port, args.latency, args.throttle_rate, args.recorded)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+from collections import deque
+from threading import Lock
+
+from market_data import DBWrapper
+
+
+class MemoryWrapper(DBWrapper):
+    """
+    DBWrapper keeping everything in process memory, for benchmarks without mongod.
+    Only the last keep_snapshots histograms of every item are stored, so memory reflects the pipeline, not the data.
+    """
+
+    def __init__(self, keep_snapshots=10):
+        self.keep_snapshots = keep_snapshots
+        self.items = {}
+        self.descriptions = {}
+        self.histograms = {}
+        self.price_histories = {}
+        self.tasks = {}
+        self.crawls = {}
+        self.writes = 0
+        self._lock = Lock()
+
+    def register_item(self, item: dict):
+        with self._lock:
+            self.items[(str(item['app_id']), item['market_hash_name'])] = item
+            self.writes += 1
+
+    def add_description(self, description: dict):
+        with self._lock:
+            self.descriptions[description['url']] = description
+            self.writes += 1
+
+    def get_description(self, item_url: str) -> dict:
+        return self.descriptions.get(item_url)
+
+    def get_histograms(self, item_url: str, period: int, top=None, stream=False):
+        description = self.descriptions[item_url]
+        snapshots = self.histograms.get(str(description['item_nameid']), ())
+        last = snapshots[-1]['timestamp'] if snapshots else 0
+        histograms = [histogram for histogram in snapshots if histogram['timestamp'] >= last - period]
+        if top is not None:
+            histograms = [dict(histogram, sell=histogram['sell'][:top], buy=histogram['buy'][:top])
+                          for histogram in histograms]
+        return iter(histograms) if stream else histograms
+
+    def update_price_history(self, app_id: str, market_hash_name: str, price_history: dict):
+        with self._lock:
+            self.price_histories[(str(app_id), market_hash_name)] = price_history
+            self.writes += 1
+
+    def update_histogram(self, item_nameid: str, histogram: dict):
+        with self._lock:
+            snapshots = self.histograms.get(str(item_nameid))
+            if snapshots is None:
+                snapshots = self.histograms[str(item_nameid)] = deque(maxlen=self.keep_snapshots)
+            snapshots.append(histogram)
+            self.writes += 1
+
+    def save_task(self, task: dict):
+        self.tasks[task['_id']] = task
+
+    def save_task_schedules(self, schedules: dict):
+        for key, fields in schedules.items():
+            if key in self.tasks:
+                self.tasks[key].update(fields)
+
+    def load_tasks(self) -> list:
+        return [dict(task) for task in self.tasks.values()]
+
+    def get_app_links(self, app_id: str) -> list:
+        return [item['link'] for (item_app_id, _), item in self.items.items() if item_app_id == str(app_id)]
+
+    def get_crawl_state(self, app_id: str) -> dict:
+        return self.crawls.get(str(app_id))
+
+    def save_crawl_state(self, app_id: str, state: dict):
+        self.crawls[str(app_id)] = dict(state)
+
+    def mark_crawl_page(self, app_id: str, start: int):
+        state = self.crawls.setdefault(str(app_id), {'pages_done': []})
+        if start not in state['pages_done']:
+            state['pages_done'].append(start)
+
+    def get_stats(self) -> dict:
+        return {'writes': self.writes, 'items': len(self.items), 'descriptions': len(self.descriptions),
+                'histogram_items': len(self.histograms)}
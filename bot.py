@@ -1,13 +1,63 @@
-from market_data import MarketData, MarketObserver, MongoWrapper, SimpleStealer, Task, TaskType
+import logging
+import os
+import re
 from multiprocessing import Process, Queue
-from time import sleep
-from analyzer import Analyzer
-from pprint import pprint
+from queue import Empty
+from threading import Thread
+from argparse import ArgumentParser
+from time import sleep, time
+from urllib import parse
+from task import Task, TaskType
+from utils.hash_ring import HashRing
+from utils.metrics import METRICS, format_snapshot
+from utils.rate_limiter import RateLimiter
+from utils.scheduler import Priority
 
+logger = logging.getLogger(__name__)
 
-def _run_market_manager(queue: Queue):
-    print('Preparing MarketData for processing...')
-    market = MarketData(queue, MarketObserver(SimpleStealer()), MongoWrapper())
+# market_data (pymongo, requests, numpy), analyzer (matplotlib) and storage backends are imported where they are used:
+# the command loop does not need them, workers and the plotting process import them after start
+
+
+def _make_db(options):
+    if options.get('storage') == 'embedded':
+        from embedded_db import EmbeddedWrapper
+        return EmbeddedWrapper(options.get('data_path', 'data'))
+    from market_data import MongoWrapper
+    return MongoWrapper(histogram_storage=options.get('histogram_storage', 'collections'),
+                        histogram_encoding=options.get('histogram_encoding', 'plain'),
+                        price_history_mode=options.get('price_history_mode', 'replace'))
+
+
+def _make_market(queue: Queue, options, owns=None, replies: Queue = None, retention=None, backfill=False):
+    from market_data import MarketData, MarketObserver, SimpleStealer, CachingStealer
+    from utils.response_cache import ResponseCache
+    histogram_changes = options.get('histogram_changes', 'write')
+    cache = ResponseCache() if options.get('response_cache') else None
+    if options.get('async_fetch'):
+        from async_market import AsyncMarketData
+        return AsyncMarketData(queue, options['credentials'], _make_db(options), options['concurrency'],
+                               limiter=options.get('limiters') or options.get('limiter'), cache=cache, owns=owns,
+                               replies=replies, histogram_changes=histogram_changes, retention=retention,
+                               backfill=backfill)
+    stealer = SimpleStealer(options.get('limiter'))
+    if cache is not None:
+        stealer = CachingStealer(stealer, cache)
+    return MarketData(queue, MarketObserver(stealer), _make_db(options),
+                      owns=owns, replies=replies, histogram_changes=histogram_changes, retention=retention,
+                      backfill=backfill)
+
+
+def _run_market_manager(queue: Queue, options: dict, shard=0, shards=1, replies: Queue = None):
+    print(f'Preparing MarketData shard {shard + 1}/{shards} for processing...')
+    if options.get('metrics_port'):
+        METRICS.serve(options['metrics_port'] + shard)
+    ring = HashRing(range(shards))
+    owns = None if shards == 1 else (lambda url: ring.get_node(url) == shard)
+    # snapshots of all shards share collections, one pruner and one backfill of rollups are enough
+    retention = options['retention_days'] * 24 * 3600 if options.get('retention_days') and shard == 0 else None
+    market = _make_market(queue, options, owns, replies, retention, backfill=shard == 0)
+    market.restore_tasks()
     print("Prepared. Running...")
     market.running = True
     while market.running:
@@ -17,37 +67,423 @@ def _run_market_manager(queue: Queue):
             print('Unknown error. Sleep 30 seconds and rebooting')
             print(e)
             sleep(30)
-            market.task_list.clear()
+            market.save_schedule()
+            market.restore_tasks()
             market.run()
 
     print('MarketData shutdowned')
 
 
+class MarketSupervisor:
+    """
+    Runs MarketData workers in separate processes, items are assigned to workers by consistent hashing of url.
+    A dead worker is restarted with the same shard number, so it restores its own tasks from DB.
+    """
+
+    def __init__(self, options: dict, workers=1, check_interval=5):
+        self.options = options
+        self.workers = workers
+        self.check_interval = check_interval
+        self.ring = HashRing(range(workers))
+        self.queues = [Queue() for _ in range(workers)]
+        self.replies = [Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self.restarts = [0] * workers
+        self.routed = [0] * workers
+        self.running = False
+        self._watchdog = None
+
+    def start(self):
+        self.running = True
+        for shard in range(self.workers):
+            self.start_worker(shard)
+        self._watchdog = Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+        return self
+
+    def start_worker(self, shard: int):
+        process = Process(target=_run_market_manager,
+                          args=(self.queues[shard], self.options, shard, self.workers, self.replies[shard]))
+        process.start()
+        self.processes[shard] = process
+
+    def _watch(self):
+        while self.running:
+            sleep(self.check_interval)
+            for shard, process in enumerate(self.processes):
+                if self.running and not process.is_alive():
+                    logger.warning('Worker of shard %s died with code %s. Restarting', shard, process.exitcode)
+                    # killed process may leave queue locks acquired forever, commands it did not take are lost with it
+                    self.queues[shard] = Queue()
+                    self.replies[shard] = Queue()
+                    self.restarts[shard] += 1
+                    self.start_worker(shard)
+
+    def shard_of(self, key: str) -> int:
+        return self.ring.get_node(key)
+
+    def register(self, task: Task):
+        shard = self.shard_of(task.url)
+        self.routed[shard] += 1
+        self.queues[shard].put(task)
+
+    def register_many(self, task_type: TaskType, urls: list, delay: int, bounds=(None, None),
+                      priority=Priority.NORMAL, deadline=None, timeout=60) -> int:
+        """
+        Sends urls to their shards in one message per shard
+        :param bounds: min and max delay of adaptive tasks
+        :param priority, deadline: see Task
+        :return: amount of urls accepted by workers
+        """
+        by_shard = {}
+        for url in urls:
+            by_shard.setdefault(self.shard_of(url), []).append(url)
+        for shard, shard_urls in by_shard.items():
+            self.routed[shard] += len(shard_urls)
+            self.queues[shard].put(('register-many', task_type.name, delay, bounds, shard_urls, priority.name, deadline))
+        return sum(accepted for accepted, _ in self.collect_acks(by_shard, timeout))
+
+    def register_app(self, task_type: TaskType, app_id: str, delay: int, bounds=(None, None),
+                     priority=Priority.NORMAL, deadline=None, timeout=60) -> tuple:
+        """
+        Every worker registers its own share of items of the app collected by crawl
+        :return: amount of accepted items, amount of app items
+        """
+        self.broadcast(('register-app', task_type.name, delay, bounds, str(app_id), priority.name, deadline))
+        acks = self.collect_acks(range(self.workers), timeout)
+        return sum(accepted for accepted, _ in acks), max((total for _, total in acks), default=0)
+
+    def collect_acks(self, shards, timeout) -> list:
+        """
+        :return: [(accepted, total)] of workers which answered in timeout
+        """
+        deadline = time() + timeout
+        acks = []
+        for shard in shards:
+            message = self.wait_reply(shard, 'ack', deadline)
+            if message is None:
+                logger.warning('Shard %s did not acknowledge registration in %s seconds', shard, timeout)
+            else:
+                acks.append(message[2:4])
+        return acks
+
+    def send(self, command, key: str):
+        self.queues[self.shard_of(key)].put(command)
+
+    def broadcast(self, command):
+        for queue in self.queues:
+            queue.put(command)
+
+    def stats(self, timeout=5) -> list:
+        """
+        :return: load of every shard, workers which did not answer in timeout have only supervisor side numbers
+        """
+        self.broadcast(('stats',))
+        deadline = time() + timeout
+        result = []
+        for shard, process in enumerate(self.processes):
+            stats = {'shard': shard, 'pid': process.pid, 'alive': process.is_alive(),
+                     'restarts': self.restarts[shard], 'routed': self.routed[shard]}
+            message = self.wait_reply(shard, 'stats', deadline)
+            if message is not None and message[1] == process.pid:
+                stats.update(message[2])
+            result.append(stats)
+        return result
+
+    def book(self, url: str, timeout=5) -> dict:
+        """
+        :return: rolling order book metrics of the item from its worker, None if it has not been polled yet
+        """
+        self.send(('book', url), key=url)
+        message = self.wait_reply(self.shard_of(url), 'book', time() + timeout)
+        return None if message is None else message[2]
+
+    def top(self, column: str, n=10, descending=True, timeout=5) -> list:
+        """
+        Best n items of every worker merged by the column
+        """
+        self.broadcast(('top', column, n, descending))
+        deadline = time() + timeout
+        rows = []
+        for shard in range(self.workers):
+            message = self.wait_reply(shard, 'top', deadline)
+            if message is not None:
+                rows.extend(row for row in message[1] if row[column] == row[column])
+        return sorted(rows, key=lambda row: row[column], reverse=descending)[:n]
+
+    def add_alert(self, column: str, op: str, threshold: float):
+        """
+        Every worker prints ALERT when one of its items crosses the threshold
+        """
+        self.broadcast(('alert', column, op, threshold))
+
+    def wait_reply(self, shard: int, kind: str, deadline: float):
+        while True:
+            try:
+                message = self.replies[shard].get(timeout=max(0.0, deadline - time()))
+            except Empty:
+                return None
+            if message[0] == kind:
+                return message
+
+    def stop(self):
+        self.running = False
+        self.broadcast('exit')
+        for process in self.processes:
+            process.join()
+
+
+def format_shard_stats(shard: dict) -> str:
+    line = f"shard {shard['shard']}: pid {shard['pid']} {'alive' if shard['alive'] else 'dead'}, " \
+           f"restarts {shard['restarts']}, routed {shard['routed']}"
+    if 'scheduler' in shard:
+        scheduler = shard['scheduler']
+        line += f", tasks {scheduler['tasks']}, in flight {scheduler['in_flight']}, " \
+                f"waiting {sum(scheduler['waiting'].values())}, skipped {sum(scheduler['skipped'].values())}, " \
+                f"lag p99 {scheduler['lag'].get('p99', 0):.3f}s"
+        for reason, count in sorted(scheduler['skipped'].items()):
+            line += f"\n    skipped {reason}: {count}"
+    return line
+
+
+def _run_plotter(jobs: Queue, options: dict):
+    """
+    Renders charts into files without a display, Analyzer and its DB connection are created on the first job
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from analyzer import Analyzer
+    analyzer = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        url, duration, path = job
+        try:
+            if analyzer is None:
+                analyzer = Analyzer(_make_db(options))
+            if analyzer.show_stats(url, duration, path=path):
+                print(f'Chart saved to {path}')
+            else:
+                print(f'No order book snapshots of {url} in the last {duration} seconds')
+        except Exception as e:
+            logger.warning('Chart of %s failed: %r', url, e)
+    if analyzer is not None:
+        analyzer.db_wrapper.close()
+
+
+class Plotter:
+    """
+    Separate process drawing charts, started on the first request, so the command loop never waits for plotting
+    """
+
+    def __init__(self, options: dict, directory='charts'):
+        self.options = options
+        self.directory = directory
+        self.jobs = None
+        self.process = None
+
+    def plot(self, url: str, duration: int, path=None) -> str:
+        """
+        :param path: .png, .svg or any other matplotlib format, default - png in directory
+        :return: path the chart will be saved to
+        """
+        if self.process is None or not self.process.is_alive():
+            self.jobs = Queue()
+            self.process = Process(target=_run_plotter, args=(self.jobs, self.options), daemon=True)
+            self.process.start()
+        if path is None:
+            os.makedirs(self.directory, exist_ok=True)
+            name = re.sub(r'[^\w.-]+', '_', parse.unquote(url.rstrip('/').rsplit('/', 1)[-1]))
+            path = os.path.join(self.directory, f'{name}_{duration}_{int(time())}.png')
+        self.jobs.put((url, duration, path))
+        return path
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join()
+
+
+def format_book(row: dict) -> str:
+    return f"{row['item_nameid']}: bid {row['best_bid']:.2f}, ask {row['best_ask']:.2f}, " \
+           f"spread {row['spread']:.2%}, net margin {row['net_margin']:.2%}, " \
+           f"ewma {row['ewma_price']:.2f}, volatility {row['volatility']:.4f}, " \
+           f"buy orders {row['buy_count']:.0f} ({row['buy_count_delta']:+.0f}), " \
+           f"sell orders {row['sell_count']:.0f} ({row['sell_count_delta']:+.0f}), updates {row['updates']:.0f}"
+
+
+TASK_OPTIONS = '[<min delay> <max delay>] [priority=high|normal|low] [deadline=<seconds>]'
+USAGE = {
+    'register': f'register <link> <period> {TASK_OPTIONS}',
+    'register-file': f'register-file <path> <period> {TASK_OPTIONS}',
+    'register-app': f'register-app <app_id> <period> {TASK_OPTIONS}',
+    'book': 'book <link>',
+    'top': 'top [-]<column> [<n>]',
+    'alert': 'alert <column> <op> <value>',
+    'crawl': 'crawl <app_id> [<how_much>]',
+    'show': 'show <link> <seconds> [<path>]',
+}
+
+
+def parse_bounds(bounds: list) -> tuple:
+    """
+    Optional '<min delay> <max delay>' of register commands, given bounds make delay adaptive
+    """
+    return (int(bounds[0]), int(bounds[1])) if len(bounds) >= 2 else (None, None)
+
+
+def parse_task_options(args: list) -> tuple:
+    """
+    Splits 'priority=high|normal|low' and 'deadline=<seconds>' out of register command arguments
+    :return: other arguments, priority, deadline
+    :raise ValueError: unknown priority or not integer deadline
+    """
+    is_option = lambda arg: arg.startswith(('priority=', 'deadline='))
+    options = dict(arg.split('=', 1) for arg in args if is_option(arg))
+    priority = options.get('priority', 'normal')
+    if priority.upper() not in Priority.__members__:
+        raise ValueError(f'Unknown priority {priority}, known: {", ".join(p.name.lower() for p in Priority)}')
+    priority = Priority[priority.upper()]
+    deadline = int(options['deadline']) if 'deadline' in options else None
+    return [arg for arg in args if not is_option(arg)], priority, deadline
+
+
 class Bot:
-    def __init__(self):
-        pass
+    def __init__(self, **options):
+        """
+        options:
+            async_fetch - poll market with AsyncMarketData instead of thread per task
+            credentials - path to SteamSession credentials json or list of them (async_fetch only),
+                several accounts are polled through SessionPool
+            concurrency - max amount of requests in flight (async_fetch only)
+            storage - 'mongo' or 'embedded' (segment files and SQLite in data_path, see EmbeddedWrapper)
+            histogram_storage - 'collections' or 'timeseries', see MongoWrapper
+            histogram_encoding - 'plain' or 'delta', see MongoWrapper
+            price_history_mode - 'replace' or 'incremental', see MongoWrapper
+            histogram_changes - 'write', 'timestamp' or 'skip', see MarketData
+            response_cache - serve recent pages from memory and merge simultaneous requests, see ResponseCache
+            retention_days - raw snapshots older than that are pruned, OHLC rollups are kept
+            workers - amount of MarketData processes, items are sharded between them
+            metrics_port - serve Prometheus text metrics of worker N on localhost:metrics_port + N
+            charts_dir - where show saves charts without explicit path
+        Every process started by Bot shares one RateLimiter budget, every Steam account has its own one.
+        """
+        self.options = options
+        self.options.setdefault('limiter', RateLimiter())
+        credentials = self.options.get('credentials')
+        if isinstance(credentials, list) and len(credentials) > 1:
+            self.options.setdefault('limiters', [RateLimiter() for _ in credentials])
 
     def run(self):
-        queue = Queue()
-        p = Process(target=_run_market_manager, args=(queue,))
-        p.start()
-        analyzer = Analyzer()
+        if self.options.get('async_fetch'):
+            # stdin of worker processes is /dev/null, steam guard codes can be entered only here
+            import asyncio
+            from utils.steam_session import login_accounts
+            asyncio.run(login_accounts(self.options['credentials']))
+        supervisor = MarketSupervisor(self.options, self.options.get('workers') or 1).start()
+        plotter = Plotter(self.options, self.options.get('charts_dir') or 'charts')
         running = True
         while running:
             command = input()
-            if command == 'exit':
-                queue.put('exit')
-                # p.join()
-                running = False
-            elif 'register' in command:
-                url, delay = command.split(' ')[1:]
-                queue.put(Task(TaskType.HISTOGRAM, url, int(delay)))
-            elif 'show' in command:
-                url, duration = command.split(' ')[1:3]
-                analyzer.show_stats(url, int(duration))
-            else:
-                print(f'Unknown command {command}')
+            # wrong arguments of one command do not stop the bot
+            try:
+                running = self.handle_command(command, supervisor, plotter)
+            except (ValueError, IndexError) as e:
+                name = command.split(' ')[0]
+                print(f'Wrong arguments of {name}: {e}' + (f'. Usage: {USAGE[name]}' if name in USAGE else ''))
+            except (FileNotFoundError, IsADirectoryError, PermissionError) as e:
+                print(f'Can not read {e.filename}: {e.strerror}')
+
+    def handle_command(self, command: str, supervisor: MarketSupervisor, plotter: Plotter) -> bool:
+        """
+        :return: False when the bot has to stop
+        """
+        if command == 'exit':
+            supervisor.stop()
+            plotter.stop()
+            return False
+        elif command == 'stats':
+            for shard in supervisor.stats():
+                print(format_shard_stats(shard))
+                if 'metrics' in shard:
+                    print('    ' + format_snapshot(shard['metrics']).replace('\n', '\n    '))
+        elif command.startswith('register-file'):
+            (path, delay, *bounds), priority, deadline = parse_task_options(command.split(' ')[1:])
+            with open(path) as file:
+                urls = [line.strip() for line in file if line.strip()]
+            accepted = supervisor.register_many(TaskType.HISTOGRAM, urls, int(delay), parse_bounds(bounds),
+                                                priority, deadline)
+            print(f'Accepted {accepted} of {len(urls)} items')
+        elif command.startswith('register-app'):
+            (app_id, delay, *bounds), priority, deadline = parse_task_options(command.split(' ')[1:])
+            accepted, total = supervisor.register_app(TaskType.HISTOGRAM, app_id, int(delay), parse_bounds(bounds),
+                                                      priority, deadline)
+            print(f'Accepted {accepted} of {total} items')
+        elif 'register' in command:
+            (url, delay, *bounds), priority, deadline = parse_task_options(command.split(' ')[1:])
+            supervisor.register(Task(TaskType.HISTOGRAM, url, int(delay), None, *parse_bounds(bounds),
+                                     priority=priority, deadline=deadline))
+        elif command.startswith('book'):
+            row = supervisor.book(command.split(' ')[1])
+            print(format_book(row) if row else 'Item has not been polled yet')
+        elif command.startswith('top'):
+            from utils.rolling_table import COLUMNS
+            column, *n = command.split(' ')[1:]
+            if column.lstrip('-') not in COLUMNS:
+                print(f'Unknown column {column}, known: {", ".join(COLUMNS)}')
+                return True
+            for row in supervisor.top(column.lstrip('-'), int(n[0]) if n else 10, not column.startswith('-')):
+                print(format_book(row))
+        elif command.startswith('alert'):
+            from utils.rolling_table import COLUMNS, OPERATORS
+            column, op, threshold = command.split(' ')[1:4]
+            if column not in COLUMNS or op not in OPERATORS:
+                print(f'Wrong alert, columns: {", ".join(COLUMNS)}, operators: {" ".join(OPERATORS)}')
+                return True
+            supervisor.add_alert(column, op, float(threshold))
+        elif command.startswith('crawl-status'):
+            supervisor.broadcast(('crawl-status',))
+        elif command.startswith('crawl'):
+            args = command.split(' ')[1:]
+            supervisor.send(('crawl', args[0], int(args[1]) if len(args) > 1 else None), key=f'app{args[0]}')
+        elif 'show' in command:
+            url, duration, *path = command.split(' ')[1:4]
+            print(f'Drawing into {plotter.plot(url, int(duration), *path)}')
+        else:
+            print(f'Unknown command {command}')
+        return True
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--async-fetch', action='store_true', help='use aiohttp based fetch engine')
+    parser.add_argument('--credentials', nargs='+', default=['credentials.json'],
+                        help='SteamSession credentials json, several files - poll with several accounts')
+    parser.add_argument('--concurrency', type=int, default=100, help='max amount of requests in flight')
+    parser.add_argument('--storage', choices=('mongo', 'embedded'), default='mongo',
+                        help='MongoDB or embedded segment files with SQLite index, no mongod needed')
+    parser.add_argument('--data-path', default='data', help='directory of embedded storage')
+    parser.add_argument('--histogram-storage', choices=('collections', 'timeseries'), default='collections',
+                        help='one collection per item or single time-series collection')
+    parser.add_argument('--histogram-encoding', choices=('plain', 'delta'), default='plain',
+                        help='store full order book ladders or packed keyframes with diffs')
+    parser.add_argument('--price-history-mode', choices=('replace', 'incremental'), default='replace',
+                        help='rewrite whole price history or append new records into month documents')
+    parser.add_argument('--histogram-changes', choices=('write', 'timestamp', 'skip'), default='write',
+                        help='store unchanged order book as usual, as timestamp only or not at all')
+    parser.add_argument('--response-cache', action='store_true',
+                        help='serve recent pages from memory and merge simultaneous identical requests')
+    parser.add_argument('--retention-days', type=float, default=None,
+                        help='prune raw order book snapshots older than that, OHLC rollups are kept')
+    parser.add_argument('--workers', type=int, default=1, help='amount of MarketData processes sharing items')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics of worker N on localhost port + N')
+    parser.add_argument('--charts-dir', default='charts', help='where show saves charts')
+    return vars(parser.parse_args())
 
 
 if __name__ == "__main__":
-    Bot().run()
+    # every module reports through logging, forked workers inherit this configuration
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    Bot(**parse_args()).run()
@@ -0,0 +1,110 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from time import sleep
+
+from market_data import extract_items, time_now
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 100
+
+
+class CatalogCrawler:
+    """
+    Walks search/render pages of one app concurrently. Requests are still limited by the stealer rate budget.
+    Finished pages are checkpointed in DB, so an interrupted crawl continues from where it stopped.
+    Pages are sorted by name: the order does not depend on popularity and items rarely move between pages,
+    the ones which do are registered only once per crawl.
+    """
+
+    def __init__(self, market, app_id, how_much=None, workers=4, max_attempts=5):
+        """
+        :param market: MarketData used for requests and DB access
+        :param how_much: max amount of items, None - whole app
+        """
+        self.market = market
+        self.db_wrapper = market.db_wrapper
+        self.app_id = str(app_id)
+        self.how_much = how_much
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.total_pages = None
+        self.pages_done = 0
+        self.failed_pages = []
+        self.items = 0
+        self.duplicates = 0
+        self.finished = False
+        self._seen = set()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def progress(self) -> dict:
+        return {'app_id': self.app_id, 'pages_done': self.pages_done, 'total_pages': self.total_pages,
+                'items': self.items, 'duplicates': self.duplicates, 'failed_pages': len(self.failed_pages),
+                'finished': self.finished}
+
+    def fetch_page(self, start: int):
+        for attempt in range(self.max_attempts):
+            data = self.market.get_search_page(self.app_id, start, sort_column='name', sort_dir='asc')
+            if data is not None and data.get('success') == 1:
+                return data
+            sleep(min(60, 2 ** attempt))
+        return None
+
+    def process_page(self, start: int, data):
+        if data is None:
+            self.failed_pages.append(start)
+            logger.warning('Crawl %s: page %s failed %s times', self.app_id, start, self.max_attempts)
+            return
+        for item in extract_items(data):
+            key = (str(item['app_id']), item['market_hash_name'])
+            if key in self._seen:
+                self.duplicates += 1
+                continue
+            self._seen.add(key)
+            self.db_wrapper.register_item(item)
+            self.items += 1
+        self.db_wrapper.mark_crawl_page(self.app_id, start)
+        self.pages_done += 1
+        logger.debug('Crawl %s: %s/%s pages, %s items', self.app_id, self.pages_done, self.total_pages, self.items)
+
+    def run(self):
+        state = self.db_wrapper.get_crawl_state(self.app_id)
+        if state is None or state.get('finished'):
+            first = self.fetch_page(0)
+            if first is None:
+                logger.warning('Crawl %s can not be started', self.app_id)
+                return
+            state = {'total_count': first['total_count'], 'pages_done': [], 'started': time_now(), 'finished': False}
+            self.db_wrapper.save_crawl_state(self.app_id, state)
+            self.total_pages = self._count_pages(state['total_count'])
+            self.process_page(0, first)
+            done = {0}
+        else:
+            logger.info('Crawl %s resumed: %s pages were done before', self.app_id, len(state['pages_done']))
+            self.total_pages = self._count_pages(state['total_count'])
+            self.pages_done = len(state['pages_done'])
+            done = set(state['pages_done'])
+        pages = [start for start in range(0, self.total_pages * PAGE_SIZE, PAGE_SIZE) if start not in done]
+        with ThreadPoolExecutor(self.workers) as executor:
+            for start, data in zip(pages, executor.map(self.fetch_page, pages)):
+                self.process_page(start, data)
+        if not self.failed_pages:
+            state = self.db_wrapper.get_crawl_state(self.app_id) or state
+            state.update({'finished': True, 'updated': time_now()})
+            self.db_wrapper.save_crawl_state(self.app_id, state)
+        self.finished = True
+        logger.info('Crawl %s finished: %s', self.app_id, self.progress())
+
+    def _count_pages(self, total_count: int) -> int:
+        if self.how_much is not None:
+            total_count = min(total_count, self.how_much)
+        return (total_count + PAGE_SIZE - 1) // PAGE_SIZE
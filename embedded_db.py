@@ -0,0 +1,187 @@
+import json
+import os
+import sqlite3
+import threading
+
+from market_data import DBWrapper, time_now
+from utils.lru_cache import LRUCache
+from utils.metrics import METRICS
+from utils.segment_store import SegmentStore
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS descriptions (url TEXT PRIMARY KEY, document TEXT)',
+    'CREATE TABLE IF NOT EXISTS items (app_id TEXT, market_hash_name TEXT, document TEXT, '
+    'PRIMARY KEY (app_id, market_hash_name))',
+    'CREATE TABLE IF NOT EXISTS price_history (app_id TEXT, market_hash_name TEXT, timestamp INTEGER, price REAL, '
+    'volume INTEGER, PRIMARY KEY (app_id, market_hash_name, timestamp))',
+    'CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, document TEXT)',
+    'CREATE TABLE IF NOT EXISTS crawls (app_id TEXT PRIMARY KEY, document TEXT)',
+)
+
+
+class EmbeddedWrapper(DBWrapper):
+    """
+    DBWrapper without mongod: order book snapshots go into append-only columnar segments (utils/segment_store.py),
+    everything else into one SQLite file. Price history is always stored incrementally, one row per record.
+    Several processes may use the same path, each of them appends its own segment files.
+    """
+
+    def __init__(self, path='data', block_rows=256, flush_interval=60, description_cache_size=10000):
+        """
+        :param path: directory of index.sqlite and histograms/ segments
+        :param block_rows, flush_interval: see SegmentStore
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.sql = sqlite3.connect(os.path.join(path, 'index.sqlite'), timeout=60, check_same_thread=False)
+        self.sql.execute('PRAGMA journal_mode=WAL')
+        self.sql.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.sql.execute(statement)
+        self.sql.commit()
+        self.segments = SegmentStore(os.path.join(path, 'histograms'), block_rows=block_rows,
+                                     flush_interval=flush_interval)
+        self.descriptions = LRUCache(description_cache_size)
+        self.last_price_timestamps = {}
+        self._lock = threading.Lock()
+
+    def _execute(self, statement: str, parameters=(), many=False):
+        with self._lock, METRICS.timer('sqlite_write_seconds'):
+            if many:
+                self.sql.executemany(statement, parameters)
+            else:
+                self.sql.execute(statement, parameters)
+            self.sql.commit()
+
+    def _query(self, statement: str, parameters=()) -> list:
+        with self._lock:
+            return self.sql.execute(statement, parameters).fetchall()
+
+    def register_item(self, item: dict):
+        self._execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                      (str(item['app_id']), item['market_hash_name'], json.dumps(item)))
+
+    def iter_items(self):
+        for document, in self._query('SELECT document FROM items'):
+            yield json.loads(document)
+
+    def get_app_links(self, app_id: str) -> list:
+        return [json.loads(document)['link']
+                for document, in self._query('SELECT document FROM items WHERE app_id = ?', (str(app_id),))]
+
+    def add_description(self, description: dict):
+        self._execute('INSERT OR REPLACE INTO descriptions VALUES (?, ?)',
+                      (description['url'], json.dumps(description)))
+        self.descriptions.put(description['url'], description)
+
+    def get_description(self, item_url: str) -> dict:
+        description = self.descriptions.get(item_url)
+        if description is None:
+            rows = self._query('SELECT document FROM descriptions WHERE url = ?', (item_url,))
+            if rows:
+                description = json.loads(rows[0][0])
+                self.descriptions.put(item_url, description)
+        return description
+
+    def iter_descriptions(self):
+        for document, in self._query('SELECT document FROM descriptions'):
+            yield json.loads(document)
+
+    def get_last_price_timestamp(self, app_id: str, market_hash_name: str):
+        key = (str(app_id), market_hash_name)
+        if key not in self.last_price_timestamps:
+            self.last_price_timestamps[key] = self._query(
+                'SELECT MAX(timestamp) FROM price_history WHERE app_id = ? AND market_hash_name = ?', key)[0][0]
+        return self.last_price_timestamps[key]
+
+    def update_price_history(self, app_id: str, market_hash_name: str, price_history: dict):
+        records = price_history['history']
+        self._execute('INSERT OR REPLACE INTO price_history VALUES (?, ?, ?, ?, ?)',
+                      [(str(app_id), market_hash_name, *record) for record in records], many=True)
+        if records:
+            self.last_price_timestamps[(str(app_id), market_hash_name)] = records[-1][0]
+
+    def get_price_history(self, app_id, market_hash_name):
+        history = [list(row) for row in self._query(
+            'SELECT timestamp, price, volume FROM price_history WHERE app_id = ? AND market_hash_name = ? '
+            'ORDER BY timestamp', (str(app_id), market_hash_name))]
+        return {'market_hash_name': market_hash_name, 'history': history} if history else None
+
+    def iter_price_histories(self):
+        """
+        :return: generator of (app_id, price history)
+        """
+        for app_id, market_hash_name in self._query('SELECT DISTINCT app_id, market_hash_name FROM price_history'):
+            yield app_id, self.get_price_history(app_id, market_hash_name)
+
+    def update_histogram(self, item_nameid: str, histogram: dict):
+        self.segments.append(item_nameid, histogram)
+
+    def mark_histogram_unchanged(self, item_nameid: str, timestamp: int):
+        self.segments.append_unchanged(item_nameid, timestamp)
+
+    def get_histograms(self, item_url: str, period: int, top=None, stream=False):
+        """
+        :param top: keep only top price levels of every side
+        :param stream: return generator instead of list
+        """
+        description = self.get_description(item_url)
+        now = time_now()
+        histograms = self.segments.read(description['item_nameid'], now - period, now, top)
+        return histograms if stream else list(histograms)
+
+    def iter_item_histograms(self):
+        """
+        :return: generator of (item_nameid, generator of all its snapshots)
+        """
+        for item in self.segments.items():
+            yield str(item), self.segments.read(item, 0, time_now())
+
+    def prune_histograms(self, retention: int) -> int:
+        """
+        Whole days are dropped, so up to a day more than retention is kept
+        """
+        return self.segments.prune(time_now() - retention)
+
+    def save_task(self, task: dict):
+        self._execute('INSERT OR REPLACE INTO tasks VALUES (?, ?)', (task['_id'], json.dumps(task)))
+
+    def save_task_schedules(self, schedules: dict):
+        with self._lock:
+            for key, fields in schedules.items():
+                rows = self.sql.execute('SELECT document FROM tasks WHERE id = ?', (key,)).fetchall()
+                if rows:
+                    self.sql.execute('UPDATE tasks SET document = ? WHERE id = ?',
+                                     (json.dumps(dict(json.loads(rows[0][0]), **fields)), key))
+            self.sql.commit()
+
+    def load_tasks(self) -> list:
+        return [json.loads(document) for document, in self._query('SELECT document FROM tasks')]
+
+    def get_crawl_state(self, app_id: str) -> dict:
+        rows = self._query('SELECT document FROM crawls WHERE app_id = ?', (str(app_id),))
+        return json.loads(rows[0][0]) if rows else None
+
+    def save_crawl_state(self, app_id: str, state: dict):
+        self._execute('INSERT OR REPLACE INTO crawls VALUES (?, ?)', (str(app_id), json.dumps(state)))
+
+    def mark_crawl_page(self, app_id: str, start: int):
+        with self._lock:
+            rows = self.sql.execute('SELECT document FROM crawls WHERE app_id = ?', (str(app_id),)).fetchall()
+            state = json.loads(rows[0][0]) if rows else {'_id': str(app_id), 'pages_done': []}
+            if start not in state.setdefault('pages_done', []):
+                state['pages_done'].append(start)
+            state['updated'] = time_now()
+            self.sql.execute('INSERT OR REPLACE INTO crawls VALUES (?, ?)', (str(app_id), json.dumps(state)))
+            self.sql.commit()
+
+    def iter_crawl_states(self):
+        for app_id, document in self._query('SELECT app_id, document FROM crawls'):
+            yield app_id, json.loads(document)
+
+    def get_stats(self) -> dict:
+        return {'descriptions': self.descriptions.get_stats(), 'segments': self.segments.get_stats()}
+
+    def close(self):
+        self.segments.close()
+        self.sql.close()
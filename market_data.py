@@ -1,20 +1,68 @@
 import json
-from enum import Enum
+import logging
+import os
+import re
 from pickle import load
-from time import sleep
-
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReplaceOne, InsertOne, UpdateOne
+from pymongo.errors import OperationFailure
 
 from abc import ABC, abstractmethod
-from requests.exceptions import RequestException
-from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from requests.exceptions import RequestException, HTTPError
 from multiprocessing import Queue
+from threading import Thread, Lock
+from time import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from json.decoder import JSONDecodeError
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 from urllib import parse
 
 from pprint import pprint
 
+from utils.scheduler import TaskScheduler, Priority
+from task import Task, TaskType, time_now
+from utils.rate_limiter import RateLimiter, is_throttled, endpoint_class
+from utils.metrics import METRICS
+from utils.lru_cache import LRUCache
+from utils.bulk_writer import BulkWriter
+from utils.orderbook_codec import HistogramEncoder, decode_histograms
+from utils.page_scanner import ListingScanner
+from utils.response_cache import ResponseCache
+from utils.rolling_table import RollingTable
+from utils.rollups import RESOLUTIONS, BarAggregator, bar_collection, pick_resolution
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFERENCES = {
+    "country": "RU",
+    "language": "russian",
+    "currency": "5",
+    "price_suffix": 'pуб.',
+    "two_factor": "0",
+    "norender": "1",
+}
+
+SEARCH_TEMPLATE = "https://steamcommunity.com/market/search/render/" \
+                  "?query={q}&start={start}&count=100" \
+                  "&search_descriptions=0&sort_column={sort_column}&sort_dir={sort_dir}&appid={app_id}&norender=1"
+
+HISTOGRAM_TEMPLATE = "https://steamcommunity.com/market/itemordershistogram" \
+                     "?country={country}" \
+                     "&language={language}" \
+                     "&currency={currency}" \
+                     "&item_nameid={item_nameid}" \
+                     "&two_factor={two_factor}" \
+                     "&norender={norender}"
+
+PRICE_HISTORY_TEMPLATE = "https://steamcommunity.com/market/pricehistory/" \
+                         "?currency={currency}" \
+                         "&appid={app_id}" \
+                         "&market_hash_name={market_hash_name}"
+
+LISTING_PREFIX = "https://steamcommunity.com/market/listings/"
+
 
 class WebStealer(ABC):
 
@@ -30,23 +78,28 @@ class WebStealer(ABC):
     def get_page(self, url) -> str:
         pass
 
+    def stream_page(self, url, chunk_size=16384):
+        """
+        Yields page in byte chunks. Connection is closed when generator is closed.
+        :raise RequestException: page is not loaded, an empty stream is never a page
+        """
+        page = self.get_page(url)
+        if not page:
+            raise RequestException(f'{url} is not loaded')
+        yield page.encode('utf-8')
+
 
 class SimpleStealer(WebStealer):
-    def __init__(self):
+    def __init__(self, limiter: RateLimiter = None, max_retries=3):
         self.session = load(open("session.data", "rb"))
         self.nick_name = 'tdm.leet'
+        self.limiter = limiter
+        self.max_retries = max_retries
         if not self.is_alive():
             raise RuntimeError('Session is no longer active')
 
     def get_account_preferences(self):
-        return {
-            "country": "RU",
-            "language": "russian",
-            "currency": "5",
-            "price_suffix": 'pуб.',
-            "two_factor": "0",
-            "norender": "1",
-        }
+        return dict(DEFAULT_PREFERENCES)
 
     def is_alive(self):
         page = self.get_page('https://store.steampowered.com')
@@ -55,11 +108,67 @@ class SimpleStealer(WebStealer):
             return False
         return True
 
+    def _request(self, url, stream=False):
+        """
+        GET through the limiter, throttled answers are retried after its backoff
+        :param stream: body is not read, throttling is told by status only
+        :return: response or None if the server is not reachable or still throttles
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire(url)
+            try:
+                response = self.session.get(url, stream=stream)
+            except RequestException:
+                logger.warning('Can not connect to the server. Please, check internet connection')
+                return None
+            throttled = is_throttled(response.status_code, None if stream else response.text)
+            if self.limiter is not None:
+                self.limiter.report(url, throttled)
+            if not throttled or self.limiter is None:
+                return response
+            response.close()
+            logger.warning('Throttled (%s) on %s, attempt %s', response.status_code, url, attempt + 1)
+        return None
+
     def get_page(self, url) -> str:
-        try:
-            return self.session.get(url).text
-        except RequestException:
-            print('WARNING: Can not connect to the server. Please, check internet connection')
+        response = self._request(url)
+        return None if response is None else response.text
+
+    def stream_page(self, url, chunk_size=16384):
+        response = self._request(url, stream=True)
+        if response is None:
+            raise RequestException(f'{url} is not loaded')
+        with response:
+            if response.status_code != 200:
+                raise HTTPError(f'{url} answered: {response.status_code}', response=response)
+            yield from response.iter_content(chunk_size)
+
+
+class CachingStealer(WebStealer):
+    """
+    Serves recent pages from ResponseCache and merges simultaneous requests of the same url into one.
+    Listing pages read by stream_page are not cached: their descriptions are cached by DBWrapper.
+    """
+
+    def __init__(self, stealer: WebStealer, cache: ResponseCache = None):
+        self.stealer = stealer
+        self.cache = cache or ResponseCache()
+
+    def get_account_preferences(self):
+        return self.stealer.get_account_preferences()
+
+    def is_alive(self) -> bool:
+        return self.stealer.is_alive()
+
+    def get_page(self, url) -> str:
+        return self.cache.get(url, self.stealer.get_page)
+
+    def stream_page(self, url, chunk_size=16384):
+        return self.stealer.stream_page(url, chunk_size)
+
+    def get_stats(self) -> dict:
+        return self.cache.get_stats()
 
 
 class DBWrapper(ABC):
@@ -77,7 +186,11 @@ class DBWrapper(ABC):
         pass
 
     @abstractmethod
-    def get_histograms(self, item_url: str, period: int) -> list:
+    def get_histograms(self, item_url: str, period: int, top=None, stream=False):
+        """
+        :param top: keep only top price levels of every side, None - all of them
+        :param stream: return iterable read lazily instead of list
+        """
         pass
 
     @abstractmethod
@@ -88,19 +201,246 @@ class DBWrapper(ABC):
     def update_histogram(self, item_nameid: str, histogram: dict):
         pass
 
+    def get_last_price_timestamp(self, app_id: str, market_hash_name: str):
+        """
+        Timestamp of the newest stored price history record, None - history has to be written in full
+        """
+        return None
+
+    def save_task(self, task: dict):
+        pass
+
+    def mark_histogram_unchanged(self, item_nameid: str, timestamp: int):
+        """
+        Order book is the same as in the previous snapshot, by default nothing is stored
+        """
+        pass
+
+    def save_task_schedules(self, schedules: dict):
+        """
+        :param schedules: {task key: {'start': next start, 'delay': current delay}}
+        """
+        pass
+
+    def load_tasks(self) -> list:
+        return []
+
+    def get_app_links(self, app_id: str) -> list:
+        """
+        Listing urls of registered items of the app
+        """
+        return []
+
+    def get_bars(self, item_url: str, period: int, points: int, resolution=None) -> list:
+        """
+        OHLC bars of best bid and ask over the last period seconds at the coarsest resolution giving points bars
+        :return: None if there are no rollups, no bars in the period or only raw snapshots are enough,
+                 see get_histograms
+        """
+        return None
+
+    def backfill_rollups(self) -> int:
+        """
+        Rolls up raw snapshots stored before rollups were written, must run before they are pruned
+        :return: amount of rolled up snapshots
+        """
+        return 0
+
+    def prune_histograms(self, retention: int) -> int:
+        """
+        Removes raw snapshots older than retention seconds
+        :return: amount of removed snapshots
+        """
+        return 0
+
+    def get_crawl_state(self, app_id: str) -> dict:
+        return None
+
+    def save_crawl_state(self, app_id: str, state: dict):
+        pass
+
+    def mark_crawl_page(self, app_id: str, start: int):
+        pass
+
+    def get_stats(self) -> dict:
+        return {}
 
-def time_now():
-    return int(datetime.utcnow().timestamp())
+    def close(self):
+        pass
+
+
+HISTOGRAMS = 'histograms'
+
+
+def collection_index(collection: str):
+    """
+    :return: (keys, options) of index the collection is created with or None
+    """
+    if collection == 'descriptions':
+        return [('url', ASCENDING)], {'unique': True}
+    if collection == 'items_list':
+        return [('app_id', ASCENDING), ('market_hash_name', ASCENDING)], {'unique': True}
+    if collection in [bar_collection(resolution) for resolution in RESOLUTIONS]:
+        return [('item_nameid', ASCENDING), ('t', ASCENDING)], {'unique': True}
+    if re.fullmatch(r'item\d+', collection):
+        return [('timestamp', ASCENDING)], {'unique': True}
+    if re.fullmatch(r'app\d+', collection):
+        return [('market_hash_name', ASCENDING), ('month', ASCENDING)], {}
+    return None
 
 
 class MongoWrapper(DBWrapper):
-    def __init__(self):
+    def __init__(self, description_cache_size=10000, description_ttl=None, batch_size=500, flush_interval=1.0,
+                 histogram_storage='collections', histogram_encoding='plain', keyframe_interval=60,
+                 price_history_mode='replace', rollups=True, rollup_flush_interval=300):
+        """
+        :param rollups: roll snapshots up into bars_1m, bars_1h and bars_1d OHLC collections on ingest
+        :param rollup_flush_interval: max seconds an open bar waits in memory before its part is written
+        :param price_history_mode: 'replace' - one document per item rewritten on every update,
+                                   'incremental' - only new records are appended into per month documents
+        :param histogram_storage: 'collections' - one item{item_nameid} collection per item,
+                                  'timeseries' - all snapshots in one HISTOGRAMS collection keyed by (item_nameid, time)
+        :param histogram_encoding: 'plain' - full ladders as lists,
+                                   'delta' - packed keyframes every keyframe_interval snapshots and diffs between them
+        :param description_cache_size: max amount of descriptions kept in memory
+        :param description_ttl: seconds after which cached description is read from DB again, None - never
+        :param batch_size: max amount of buffered writes sent in one bulk_write
+        :param flush_interval: max seconds a buffered write waits for its batch
+        """
         self.client = MongoClient()
-        self.db = None
         if 'TradeBot' not in self.client.list_database_names():
-            # TODO: log that DB not found
-            print('WARNING: DB not found we will create new one.')
-            self.db = self.client.get_database('TradeBot')
+            logger.warning('DB not found we will create new one.')
+        self.db = self.client.get_database('TradeBot')
+        self.descriptions = LRUCache(description_cache_size, description_ttl)
+        # names of existing collections, a collection gets its index when it is first seen missing here
+        self.collections = set(self.db.list_collection_names())
+        self.histogram_storage = histogram_storage
+        self.price_history_mode = price_history_mode
+        self.last_price_timestamps = {}
+        self.encoder = HistogramEncoder(keyframe_interval) if histogram_encoding == 'delta' else None
+        self.timeseries = False
+        self.rollups = BarAggregator(flush_interval=rollup_flush_interval) if rollups else None
+        self.ensure_indexes()
+        if histogram_storage == 'timeseries':
+            self._init_histogram_store()
+        self.writer = BulkWriter(self.db, batch_size, flush_interval)
+
+    def _create_index(self, collection: str, keys: list, options: dict):
+        try:
+            self.db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            logger.warning('Can not create index %s on %s: %s', keys, collection, e)
+
+    def ensure_indexes(self):
+        """
+        New collections are indexed when they are created. Collections of a DB made before indexes existed
+        are indexed by one-time migration remembered in 'migrations'.
+        """
+        if self.db['migrations'].find_one({'_id': 'indexes'}) is None:
+            self.migrate_indexes()
+        self._ensure_index('descriptions')
+        self._ensure_index('items_list')
+        if self.rollups is not None:
+            for resolution in RESOLUTIONS:
+                self._ensure_index(bar_collection(resolution))
+
+    def migrate_indexes(self):
+        for name in self.collections:
+            if collection_index(name) is not None:
+                self._create_index(name, *collection_index(name))
+        self.db['migrations'].replace_one({'_id': 'indexes'}, {'_id': 'indexes', 'time': time_now()}, upsert=True)
+
+    def _ensure_index(self, collection: str):
+        """
+        Creates index together with collection, existing collections are not touched
+        """
+        if collection not in self.collections:
+            self._create_index(collection, *collection_index(collection))
+            self.collections.add(collection)
+
+    def _init_histogram_store(self):
+        created = HISTOGRAMS not in self.collections
+        if created:
+            try:
+                self.db.create_collection(HISTOGRAMS, timeseries={
+                    'timeField': 'time', 'metaField': 'item_nameid', 'granularity': 'seconds'})
+            except OperationFailure as e:
+                logger.warning('Time-series collections are not supported (%s). Using plain %s collection',
+                               e, HISTOGRAMS)
+                self.db.create_collection(HISTOGRAMS)
+            self.collections.add(HISTOGRAMS)
+        self.timeseries = 'timeseries' in self.db[HISTOGRAMS].options()
+        if created:
+            self._create_index(HISTOGRAMS, [('item_nameid', ASCENDING), ('time', ASCENDING)],
+                               {'unique': not self.timeseries})
+
+    def migrate_histogram_collections(self, drop=False, batch_size=1000):
+        """
+        Copies snapshots from item{item_nameid} collections into HISTOGRAMS store.
+        Collections are remembered in 'migrations' before and after the copy, so the tool can be restarted safely:
+        snapshots of an interrupted copy are deleted from HISTOGRAMS and the collection is copied again.
+        """
+        if self.histogram_storage != 'timeseries':
+            raise RuntimeError("Migration requires histogram_storage='timeseries'")
+        for name in sorted(self.db.list_collection_names(filter={'name': {'$regex': r'^item\d+$'}})):
+            state = self.db['migrations'].find_one({'_id': name})
+            # migrations of older versions have no 'done' and were recorded after the copy
+            if state is None or not state.get('done', True):
+                item_nameid = name[len('item'):]
+                if state is not None:
+                    # time-series collection has no unique key, copied snapshots would be inserted twice
+                    removed = self._delete_copied(name, item_nameid)
+                    print(f'{name}: {removed} snapshots of interrupted migration removed')
+                self.db['migrations'].replace_one({'_id': name}, {'_id': name, 'done': False, 'time': time_now()},
+                                                  upsert=True)
+                batch, copied = [], 0
+                for histogram in self.db[name].find({}, {'_id': 0}).sort([('timestamp', ASCENDING)]):
+                    batch.append(self._histogram_operation(item_nameid, histogram))
+                    if len(batch) >= batch_size:
+                        self.db[HISTOGRAMS].bulk_write(batch, ordered=False)
+                        copied, batch = copied + len(batch), []
+                if batch:
+                    self.db[HISTOGRAMS].bulk_write(batch, ordered=False)
+                    copied += len(batch)
+                self.db['migrations'].replace_one({'_id': name},
+                                                  {'_id': name, 'done': True, 'count': copied, 'time': time_now()})
+                print(f'{name}: {copied} snapshots migrated')
+            if drop:
+                self.db.drop_collection(name)
+
+    def _delete_copied(self, name: str, item_nameid: str) -> int:
+        """
+        Deletes snapshots of the item within time range of its item{item_nameid} collection,
+        newer ones are written by polling into HISTOGRAMS directly
+        """
+        first = self.db[name].find_one({}, {'timestamp': 1}, sort=[('timestamp', ASCENDING)])
+        last = self.db[name].find_one({}, {'timestamp': 1}, sort=[('timestamp', DESCENDING)])
+        if first is None:
+            return 0
+        return self.db[HISTOGRAMS].delete_many({
+            'item_nameid': str(item_nameid),
+            'time': {'$gte': datetime.utcfromtimestamp(first['timestamp']),
+                     '$lte': datetime.utcfromtimestamp(last['timestamp'])}}).deleted_count
+
+    def _histogram_operation(self, item_nameid: str, histogram: dict):
+        document = dict(histogram, item_nameid=str(item_nameid), time=datetime.utcfromtimestamp(histogram['timestamp']))
+        if self.timeseries:
+            return InsertOne(document)
+        return ReplaceOne({'item_nameid': document['item_nameid'], 'time': document['time']}, document, upsert=True)
+
+    def get_stats(self) -> dict:
+        return {'descriptions': self.descriptions.get_stats(), 'writer': self.writer.get_stats()}
+
+    def close(self):
+        if self.rollups is not None:
+            self._write_bars(self.rollups.drain())
+        self.writer.close()
+
+    def get_app_links(self, app_id: str) -> list:
+        self.writer.flush()
+        # search/render gives app_id as int
+        app_ids = [str(app_id), int(app_id)] if str(app_id).isdigit() else [app_id]
+        return [item['link'] for item in self.db['items_list'].find({'app_id': {'$in': app_ids}}, {'_id': 0, 'link': 1})]
 
     def get_registered(self, min_count, min_price, max_price):
         return self.db['items_list'].find(
@@ -109,32 +449,238 @@ class MongoWrapper(DBWrapper):
 
     def add_description(self, description: dict):
         print(f'Description was added {description["url"]}')
-        self.db['descriptions'].replace_one({'url': description['url']}, description, upsert=True)
+        with METRICS.timer('mongo_write_seconds', collection='descriptions'):
+            self.db['descriptions'].replace_one({'url': description['url']}, description, upsert=True)
+        self.descriptions.put(description['url'], description)
 
     def get_description(self, item_url: str) -> dict:
-        return self.db['descriptions'].find_one({'url': item_url})
+        description = self.descriptions.get(item_url)
+        if description is None:
+            description = self.db['descriptions'].find_one({'url': item_url})
+            if description is not None:
+                self.descriptions.put(item_url, description)
+        return description
+
+    def get_last_price_timestamp(self, app_id: str, market_hash_name: str):
+        if self.price_history_mode != 'incremental':
+            return None
+        key = (str(app_id), market_hash_name)
+        if key not in self.last_price_timestamps:
+            # newest month bucket, legacy single document has no month and goes last
+            document = self.db[f'app{app_id}'].find_one(
+                {'market_hash_name': market_hash_name}, {'last': 1, 'history': {'$slice': -1}},
+                sort=[('month', DESCENDING)])
+            last = None
+            if document is not None:
+                last = document.get('last', document['history'][-1][0] if document.get('history') else None)
+            self.last_price_timestamps[key] = last
+        return self.last_price_timestamps[key]
 
     def update_price_history(self, app_id: str, market_hash_name: str, price_history: dict):
-        # TODO make it smarter
-        self.db[f'app{app_id}'].replace_one({'market_hash_name': market_hash_name}, price_history, upsert=True)
+        if self.price_history_mode != 'incremental':
+            with METRICS.timer('mongo_write_seconds', collection='app'):
+                self.db[f'app{app_id}'].replace_one({'market_hash_name': market_hash_name}, price_history, upsert=True)
+            return
+        self._ensure_index(f'app{app_id}')
+        months = {}
+        for record in price_history['history']:
+            months.setdefault(datetime.utcfromtimestamp(record[0]).strftime('%Y-%m'), []).append(record)
+        for month, records in months.items():
+            # records are appended only if they are newer than the bucket, so a retried write does not repeat them
+            newer = {'$lt': [{'$ifNull': ['$last', None]}, records[0][0]]}
+            self.writer.add(f'app{app_id}', UpdateOne({'market_hash_name': market_hash_name, 'month': month}, [{'$set': {
+                'history': {'$cond': [newer, {'$concatArrays': [{'$ifNull': ['$history', []]}, {'$literal': records}]},
+                                      '$history']},
+                'last': {'$max': ['$last', records[-1][0]]}}}], upsert=True))
+        if price_history['history']:
+            self.last_price_timestamps[(str(app_id), market_hash_name)] = price_history['history'][-1][0]
 
     def get_price_history(self, app_id, market_hash_name):
-        return self.db[f'app{app_id}'].find_one({'market_hash_name': market_hash_name})
+        history = []
+        for document in self.db[f'app{app_id}'].find({'market_hash_name': market_hash_name}).sort([('month', ASCENDING)]):
+            history.extend(document['history'])
+        return {'market_hash_name': market_hash_name, 'history': history} if history else None
 
     def update_histogram(self, item_nameid: str, histogram: dict):
-        self.db[f'item{item_nameid}'].replace_one({'timestamp': histogram['timestamp']}, histogram, upsert=True)
+        if self.rollups is not None:
+            self._write_bars(self.rollups.add(item_nameid, histogram))
+        if self.encoder is not None:
+            histogram = self.encoder.encode(item_nameid, histogram)
+        self._write_histogram(item_nameid, histogram)
+
+    def mark_histogram_unchanged(self, item_nameid: str, timestamp: int):
+        # readers repeat the previous snapshot, see decode_histograms
+        if self.rollups is not None:
+            self._write_bars(self.rollups.add_unchanged(item_nameid, timestamp))
+        self._write_histogram(item_nameid, {'timestamp': timestamp, 'unchanged': True})
+
+    def _write_histogram(self, item_nameid: str, document: dict):
+        if self.histogram_storage == 'timeseries':
+            # time-series collections have no unique index, repeated insert would duplicate the snapshot
+            self.writer.add(HISTOGRAMS, self._histogram_operation(item_nameid, document), idempotent=not self.timeseries)
+            return
+        self._ensure_index(f'item{item_nameid}')
+        self.writer.add(f'item{item_nameid}', ReplaceOne({'timestamp': document['timestamp']}, document, upsert=True))
+
+    def _write_bars(self, parts: list, older=False):
+        for resolution, item_nameid, bar in parts:
+            # $inc of snapshot count
+            self.writer.add(bar_collection(resolution),
+                            UpdateOne({'item_nameid': item_nameid, 't': bar.t}, bar.merge_update(older), upsert=True),
+                            idempotent=False)
+
+    def get_bars(self, item_url: str, period: int, points: int, resolution=None) -> list:
+        """
+        :param resolution: one of RESOLUTIONS instead of picked by points
+        """
+        resolution = resolution or pick_resolution(period, points)
+        if self.rollups is None or resolution is None:
+            return None
+        description = self.get_description(item_url)
+        bars = list(self.db[bar_collection(resolution)].find(
+            {'item_nameid': str(description['item_nameid']), 't': {'$gte': time_now() - period}},
+            {'_id': 0, 'item_nameid': 0}).sort([('t', ASCENDING)]))
+        # not rolled up yet (e.g. backfill has not run), raw snapshots are read instead
+        return bars or None
+
+    def _histogram_items(self) -> list:
+        if self.histogram_storage == 'timeseries':
+            return self.db[HISTOGRAMS].distinct('item_nameid')
+        return [name[len('item'):] for name in self.db.list_collection_names(filter={'name': {'$regex': r'^item\d+$'}})]
+
+    def backfill_rollups(self) -> int:
+        """
+        Every item is rolled up from its first snapshot till its earliest bar written on ingest (stored or open),
+        these parts are older than stored ones and keep their close. Backfilled items are remembered in 'migrations'.
+        """
+        if self.rollups is None:
+            return 0
+        self.writer.flush()
+        started = time_now()
+        done = {document['_id'] for document in self.db['migrations'].find({'_id': {'$regex': r'^rollups:'}}, {'_id': 1})}
+        rolled = 0
+        for item_nameid in self._histogram_items():
+            item_nameid = str(item_nameid)
+            if f'rollups:{item_nameid}' in done:
+                continue
+            finest = min(self.rollups.resolutions, key=self.rollups.resolutions.get)
+            first_bar = self.db[bar_collection(finest)].find_one({'item_nameid': item_nameid}, {'t': 1},
+                                                                sort=[('t', ASCENDING)])
+            until = min(t for t in (first_bar and first_bar['t'], self.rollups.open_since(item_nameid), started)
+                        if t is not None)
+            aggregator = BarAggregator(self.rollups.resolutions, flush_interval=float('inf'))
+            parts = []
+            for histogram in self._read_histograms(item_nameid, 0, top=1):
+                if histogram['timestamp'] >= until:
+                    break
+                parts.extend(aggregator.add(item_nameid, histogram))
+                rolled += 1
+            self._write_bars(parts + aggregator.drain(), older=True)
+            self.writer.add('migrations', ReplaceOne({'_id': f'rollups:{item_nameid}'},
+                                                     {'_id': f'rollups:{item_nameid}', 'until': until,
+                                                      'time': time_now()}, upsert=True))
+        self.writer.flush()
+        return rolled
+
+    def prune_histograms(self, retention: int) -> int:
+        """
+        Every item keeps the last snapshot readers can start from before the cutoff (keyframe or full snapshot),
+        so diffs and unchanged markers after it are still readable
+        """
+        self.writer.flush()
+        removed = 0
+        for item_nameid in self._histogram_items():
+            collection, query, field, to_field = self._histogram_source(item_nameid)
+            cutoff = to_field(time_now() - retention)
+            start = collection.find_one(
+                {**query, field: {'$lte': cutoff},
+                 '$or': [{'k': True}, {'enc': {'$exists': False}, 'unchanged': {'$exists': False}}]},
+                {field: 1}, sort=[(field, DESCENDING)])
+            if start is not None:
+                with METRICS.timer('mongo_write_seconds', collection='prune'):
+                    removed += collection.delete_many({**query, field: {'$lt': start[field]}}).deleted_count
+        return removed
+
+    def _histogram_source(self, item_nameid):
+        """
+        :return: collection, filter selecting the item, time field, converter from unix time to time field value
+        """
+        if self.histogram_storage == 'timeseries':
+            return self.db[HISTOGRAMS], {'item_nameid': str(item_nameid)}, 'time', datetime.utcfromtimestamp
+        return self.db[f'item{item_nameid}'], {}, 'timestamp', int
 
-    def get_histograms(self, item_url: str, period: int) -> list:
+    def get_histograms(self, item_url: str, period: int, top=None, stream=False):
+        """
+        :param top: keep only top price levels of every side, plain ladders are cut by DB projection
+        :param stream: return generator reading the cursor lazily instead of list
+        """
         description = self.get_description(item_url)
         start_time = int((datetime.utcnow() - timedelta(seconds=period)).timestamp())
-        cursor = self.db[f'item{description["item_nameid"]}'] \
-            .find({'timestamp': {'$gte': start_time}}).sort([('timestamp', ASCENDING)])
-        return [histo for histo in cursor]
+        histograms = self._read_histograms(description['item_nameid'], start_time, top)
+        return histograms if stream else list(histograms)
 
-    def register_item(self, item):
-        self.db['items_list'].replace_one({'market_hash_name': item['market_hash_name'], 'app_id': item['app_id']},
-                                          item, upsert=True)
+    def _read_histograms(self, item_nameid: str, start_time: int, top=None):
+        """
+        :return: generator of snapshots of the item since start_time, time ordered
+        """
+        collection, query, field, to_field = self._histogram_source(item_nameid)
+        scan_from = to_field(start_time)
+        if self.encoder is not None:
+            # diffs are decoded starting from the last keyframe before requested period
+            keyframe = collection.find_one({**query, 'k': True, field: {'$lte': scan_from}}, {field: 1},
+                                           sort=[(field, DESCENDING)])
+            if keyframe is not None:
+                scan_from = keyframe[field]
+        projection = {'_id': 0, 'item_nameid': 0, 'time': 0}
+        if top is not None:
+            projection.update({'sell': {'$slice': top}, 'buy': {'$slice': top}})
+        cursor = collection.find({**query, field: {'$gte': scan_from}}, projection).sort([(field, ASCENDING)])
+        if self.encoder is None:
+            cursor = self._with_unchanged_source(cursor, collection, query, field, scan_from, projection)
+        return (histo for histo in decode_histograms(cursor, top) if histo['timestamp'] >= start_time)
+
+    @staticmethod
+    def _with_unchanged_source(cursor, collection, query, field, scan_from, projection):
+        """
+        Unchanged markers at the start of the period repeat a snapshot stored before it, that one is read first
+        """
+        first = next(cursor, None)
+        if first is None:
+            return
+        if first.get('unchanged'):
+            source = collection.find_one({**query, field: {'$lt': scan_from}, 'unchanged': {'$exists': False}},
+                                         projection, sort=[(field, DESCENDING)])
+            if source is not None:
+                yield source
+        yield first
+        yield from cursor
+
+    def save_task(self, task: dict):
+        self.writer.add('tasks', ReplaceOne({'_id': task['_id']}, task, upsert=True))
+
+    def save_task_schedules(self, schedules: dict):
+        for key, fields in schedules.items():
+            self.writer.add('tasks', UpdateOne({'_id': key}, {'$set': fields}))
+
+    def load_tasks(self) -> list:
+        self.writer.flush()
+        return list(self.db['tasks'].find({}))
+
+    def get_crawl_state(self, app_id: str) -> dict:
+        return self.db['crawls'].find_one({'_id': str(app_id)})
+
+    def save_crawl_state(self, app_id: str, state: dict):
+        with METRICS.timer('mongo_write_seconds', collection='crawls'):
+            self.db['crawls'].replace_one({'_id': str(app_id)}, state, upsert=True)
+
+    def mark_crawl_page(self, app_id: str, start: int):
+        # goes through the same buffer after page items, so a page is marked only after its items are sent
+        self.writer.add('crawls', UpdateOne({'_id': str(app_id)},
+                                            {'$addToSet': {'pages_done': start}, '$set': {'updated': time_now()}}))
 
+    def register_item(self, item):
+        self.writer.add('items_list', ReplaceOne({'market_hash_name': item['market_hash_name'], 'app_id': item['app_id']},
+                                                 item, upsert=True))
 
 
 class BrokenPageSource(Exception):
@@ -146,7 +692,7 @@ class WrongCurrency(Exception):
 
 
 def extract_appid_and_hashname(item_url: str):
-    item_url = item_url[len('https://steamcommunity.com/market/listings/'):]
+    item_url = item_url[len(LISTING_PREFIX):]
     return item_url.split('/')
 
 
@@ -165,6 +711,54 @@ def extract_item_nameid(page_source: str):
     return None
 
 
+def parse_description(item_url: str, page_source: str):
+    try:
+        app_id, hash_name = extract_appid_and_hashname(item_url)
+        return {
+            "app_id": app_id,
+            "market_hash_name": hash_name,
+            "is_short_tradable": is_immediately_resoldable(page_source),
+            'item_nameid': extract_item_nameid(page_source),
+            'url': item_url
+        }
+    except BrokenPageSource:
+        logger.warning('There is broken page: %s', item_url)
+
+
+def scan_description(item_url: str, chunks) -> dict:
+    """
+    Same as parse_description, but reads listing page in chunks and stops as soon as markers are found
+    :return: None if the page is not loaded or broken
+    """
+    try:
+        scanner = ListingScanner().scan(chunks)
+    except RequestException as e:
+        logger.warning('Description of %s is not loaded: %r', item_url, e)
+        return None
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return listing_description(item_url, scanner)
+
+
+def listing_description(item_url: str, scanner: ListingScanner) -> dict:
+    if not scanner.bytes_read:
+        # nothing was read, missing markers do not mean the item has no histogram
+        logger.warning('Description of %s is not loaded: empty page', item_url)
+        return None
+    if scanner.broken:
+        logger.warning('There is broken page: %s', item_url)
+        return None
+    app_id, hash_name = extract_appid_and_hashname(item_url)
+    return {
+        "app_id": app_id,
+        "market_hash_name": hash_name,
+        "is_short_tradable": scanner.is_short_tradable,
+        'item_nameid': scanner.item_nameid,
+        'url': item_url
+    }
+
+
 class MarketObserver:
 
     def __init__(self, stealer: WebStealer):
@@ -175,10 +769,12 @@ class MarketObserver:
         else:
             raise TypeError("stealer should be subclassed from WebStealer")
 
-    def collect_items(self, app_id, start, q=''):
-        template = f"https://steamcommunity.com/market/search/render/?query={q}&start={start}&count=100&" \
-                   f"search_descriptions=0&sort_column=popular&sort_dir=desc&appid={app_id}&norender=1"
-        return self.compose_and_send(template, q=q, app_id=app_id, start=start)
+    def get_account_preferences(self):
+        return self.stealer.get_account_preferences()
+
+    def collect_items(self, app_id, start, q='', sort_column='popular', sort_dir='desc'):
+        return self.compose_and_send(SEARCH_TEMPLATE, q=q, app_id=app_id, start=start,
+                                     sort_column=sort_column, sort_dir=sort_dir)
 
     def get_description(self, item_url: str) -> dict:
         """
@@ -191,68 +787,59 @@ class MarketObserver:
         :param item_url:
         :return:
         """
-        page_source = self.stealer.get_page(item_url)
-        try:
-            app_id, hash_name = extract_appid_and_hashname(item_url)
-            return {
-                "app_id": app_id,
-                "market_hash_name": hash_name,
-                "is_short_tradable": is_immediately_resoldable(page_source),
-                'item_nameid': extract_item_nameid(page_source),
-                'url': item_url
-            }
-            preferences = self.stealer.get_account_preferences()
-        # TODO: log it
-        except BrokenPageSource:
-            print(f"WARNING: There is broken page: {item_url}")
+        return scan_description(item_url, self.stealer.stream_page(item_url))
 
     def compose_and_send(self, template, **kwargs):
+        endpoint = endpoint_class(template)
         try:
-            url = template.format(**kwargs, **preferences)
-            data = self.stealer.get_page(url)
-            return json.loads(data)
+            url = template.format(**kwargs, **self.get_account_preferences())
+            with METRICS.timer('request_seconds', endpoint=endpoint):
+                data = self.stealer.get_page(url)
+            with METRICS.timer('json_decode_seconds', endpoint=endpoint):
+                result = json.loads(data)
+            METRICS.inc('requests', endpoint=endpoint, status='ok')
+            return result
         except (JSONDecodeError, TypeError):
-            # TODO make log
-            print(f"WARNING: Unable to decode answer on {template}. Maybe page is broken")
+            METRICS.inc('requests', endpoint=endpoint, status='error')
+            logger.warning('Unable to decode answer on %s. Maybe page is broken', template)
 
     def get_histogram(self, item_nameid: str) -> dict:
         """
         Returns prices histogram for item
         """
-        template = "https://steamcommunity.com/market/itemordershistogram" \
-                   "?country={country}" \
-                   "&language={language}" \
-                   "&currency={currency}" \
-                   "&item_nameid={item_nameid}" \
-                   "&two_factor={two_factor}" \
-                   "&norender={norender}"
-        return self.compose_and_send(template, item_nameid=item_nameid)
+        return self.compose_and_send(HISTOGRAM_TEMPLATE, item_nameid=item_nameid)
 
     def get_price_history(self, app_id: str, market_hash_name: str):
         """
         Returns price history
         :return:
         """
-        template = "https://steamcommunity.com/market/pricehistory/" \
-                   "?currency={currency}" \
-                   "&appid={app_id}" \
-                   "&market_hash_name={market_hash_name}"
-        return self.compose_and_send(template, app_id=app_id, market_hash_name=market_hash_name)
+        return self.compose_and_send(PRICE_HISTORY_TEMPLATE, app_id=app_id, market_hash_name=market_hash_name)
+
+
+@lru_cache(maxsize=65536)
+def steam_timestamp(steam_datetime: str) -> int:
+    normalized_datetime = datetime.strptime(steam_datetime, "%b %d %Y %H: +0").astimezone(tz=timezone.utc)
+    return int(normalized_datetime.timestamp())
 
 
-def reformat_price_history(raw, market_hash_name: str) -> dict:
+def reformat_price_history(raw, market_hash_name: str, since=None) -> dict:
     """
     list of 3 items:
         - steam formatted datetime
         - median price
         - solds count
-    :param:
+    :param since: keep only records newer than this timestamp. Records are chronological,
+                  so older ones are not even parsed.
     :return:
     """
     history = []
-    for record in raw['prices']:
-        normalized_datetime = datetime.strptime(record[0], "%b %d %Y %H: +0").astimezone(tz=timezone.utc)
-        history.append([int(normalized_datetime.timestamp()), record[1], int(record[2])])
+    for record in reversed(raw['prices']):
+        timestamp = steam_timestamp(record[0])
+        if since is not None and timestamp <= since:
+            break
+        history.append([timestamp, record[1], int(record[2])])
+    history.reverse()
     return {'market_hash_name': market_hash_name, 'history': history}
 
 
@@ -266,140 +853,419 @@ def reformat_histogram(raw) -> dict:
     }
 
 
-class TaskType(Enum):
-    PRICE_HISTORY = 0
-    HISTOGRAM = 1
-    SCREENING = 2
+def histogram_fingerprint(histogram: dict) -> int:
+    """
+    Equal for snapshots of the same order book, timestamp is not taken into account
+    """
+    return hash((histogram['sell_count'], histogram['buy_count'],
+                 tuple(map(tuple, histogram['sell'])), tuple(map(tuple, histogram['buy']))))
 
 
-class Task:
-    def __init__(self, task_type: TaskType, url: str, delay=None, start=None):
-        self.url = url
-        self.task_type = task_type
-        self.delay = delay
-        self.start = time_now() if start is None else start
+def extract_items(data) -> list:
+    """
+    Marketable items of search/render answer in items_list format
+    """
+    items = []
+    for item in data['results']:
+        asset = item['asset_description']
+        if asset['marketable'] and 'market_marketable_restriction' not in asset:
+            app_id = asset['appid']
+            name = asset['market_hash_name']
+            items.append({
+                "time": time_now(),
+                "app_id": app_id,
+                "market_hash_name": name,
+                "count": item["sell_listings"],
+                "price": item["sell_price"],
+                "link": f"{LISTING_PREFIX}{app_id}/{parse.quote(name)}"
+            })
+    return items
 
 
 class MarketData:
-    def __init__(self, queue: Queue, observer: MarketObserver, db_wrapper: DBWrapper):
+    def __init__(self, queue: Queue, observer: MarketObserver, db_wrapper: DBWrapper, max_workers=None,
+                 checkpoint_interval=30, recovery_window=300, owns=None, replies: Queue = None,
+                 histogram_changes='write', analytics: RollingTable = None, retention=None, prune_interval=3600,
+                 backfill=False):
+        """
+        :param histogram_changes: what to do with snapshot equal to the previous one of the item:
+                                  'write' - store it as usual, 'timestamp' - store only its timestamp, 'skip' - nothing
+        :param checkpoint_interval: seconds between batched saves of tasks schedule
+        :param recovery_window: max seconds over which overdue tasks are spread after restart
+        :param owns: predicate on task url, only owned tasks are restored (sharded workers share one tasks collection)
+        :param replies: queue for answers on commands (stats), None - answers are printed
+        :param analytics: rolling order book metrics updated by every histogram, see RollingTable
+        :param retention: raw snapshots older than retention seconds are pruned every prune_interval seconds,
+                          None - kept forever (rollups are kept anyway)
+        :param backfill: roll up snapshots stored before rollups were turned on in background after start,
+                         pruning waits for it anyway
+        """
         self.running = False
-        self.sleep_duration = 0.01
-        self.task_list = []
         self.queue = queue
+        self.owns = owns
+        self.replies = replies
+        self.histogram_changes = histogram_changes
+        self.fingerprints = {}
+        self.analytics = RollingTable() if analytics is None else analytics
+        self.commands = deque()
+        self.listener = None
+        self.crawlers = {}
+        self.checkpoint_interval = checkpoint_interval
+        self.recovery_window = recovery_window
+        self.next_checkpoint = time() + checkpoint_interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.next_prune = time()
+        self.pruner = None
+        self.backfill_on_start = backfill
+        self.backfiller = None
+        self.backfilled = False
+        self.backfill_lock = Lock()
+        self.dirty_tasks = {}
+        self.registered = {}
         self.observer = observer
+        self.scheduler = self.make_scheduler(max_workers)
+        METRICS.gauge('scheduler_tasks', lambda: len(self.scheduler))
+        METRICS.gauge('scheduler_in_flight', lambda: self.scheduler.in_flight)
+        METRICS.gauge('scheduler_waiting', lambda: self.scheduler.waiting)
+        METRICS.gauge('scheduler_lag_p99_seconds', lambda: self.scheduler.lag.snapshot()['p99'])
+        METRICS.gauge('commands_queue_depth', lambda: len(self.commands))
         if issubclass(type(db_wrapper), DBWrapper):
             self.db_wrapper = db_wrapper
         else:
             raise TypeError(f"db_wrapper({type(db_wrapper)}) should be subclassed from DBWrapper")
 
+    def make_scheduler(self, max_workers):
+        return TaskScheduler(self.execute_task, max_workers=max_workers, on_reschedule=self.mark_dirty)
+
+    def mark_dirty(self, task: Task):
+        self.dirty_tasks[task.key] = task
+
+    def save_schedule(self):
+        dirty, self.dirty_tasks = self.dirty_tasks, {}
+        if dirty:
+            self.db_wrapper.save_task_schedules({key: {'start': task.start, 'delay': task.delay}
+                                                 for key, task in dirty.items()})
+        self.next_checkpoint = time() + self.checkpoint_interval
+
+    def restore_tasks(self):
+        """
+        Loads persisted tasks instead of scheduled ones. Overdue tasks are spread over
+        min(delay, recovery_window) seconds, so restart does not fire all of them at once.
+        """
+        self.scheduler.clear()
+        self.registered.clear()
+        now = time()
+        restored = overdue = 0
+        for document in self.db_wrapper.load_tasks():
+            task = Task.from_document(document)
+            if self.owns is not None and not self.owns(task.url):
+                continue
+            if task.start < now:
+                task.start = now + random.uniform(0, min(task.delay or 0, self.recovery_window))
+                overdue += 1
+            self.scheduler.schedule(task)
+            self.registered[task.key] = task
+            restored += 1
+        logger.info('Restored %s tasks, %s overdue were spread', restored, overdue)
+
     def get_description(self, item_url):
-        description = self.db_wrapper.get_description(item_url)
+        with METRICS.timer('description_seconds', source='db'):
+            description = self.db_wrapper.get_description(item_url)
         if description is None:
-            description = self.observer.get_description(item_url)
-            self.db_wrapper.add_description(description)
+            with METRICS.timer('description_seconds', source='web'):
+                description = self.observer.get_description(item_url)
+            METRICS.inc('requests', endpoint='listings', status='error' if description is None else 'ok')
+            if description is not None:
+                self.db_wrapper.add_description(description)
         return description
 
     def collect_items(self, app_id, how_much=500):
         for page in range(0, how_much, 100):
             print(page)
             data = self.observer.collect_items(app_id=app_id, start=page)
-            if data['success'] != 1:
-                # TODO: log it Wrong API
-                print('Cannot collect items: wrong API')
-            if not data['results']:
-                if page != how_much:
-                    print(f"We could collect only ~{100 * page}~ items. There is no more")
-                    break
-            for item in data['results']:
-                asset = item['asset_description']
-                if asset['marketable'] and 'market_marketable_restriction' not in asset:
-                    app_id = asset['appid']
-                    name = asset['market_hash_name']
-                    pure_item = {
-                        "time": time_now(),
-                        "app_id": app_id,
-                        "market_hash_name": name,
-                        "count": item["sell_listings"],
-                        "price": item["sell_price"],
-                        "link": f"https://steamcommunity.com/market/listings/{app_id}/{parse.quote(name)}"
-                    }
-                    self.db_wrapper.register_item(pure_item)
+            if not self.register_search_results(data, page, how_much):
+                break
+
+    def register_search_results(self, data, page, how_much) -> bool:
+        """
+        Registers items from one search/render page
+        :return: False when there are no more items
+        """
+        if data['success'] != 1:
+            # TODO: log it Wrong API
+            print('Cannot collect items: wrong API')
+        if not data['results']:
+            if page != how_much:
+                print(f"We could collect only ~{100 * page}~ items. There is no more")
+                return False
+        for pure_item in extract_items(data):
+            self.db_wrapper.register_item(pure_item)
+        return True
+
+    def get_search_page(self, app_id, start, sort_column='popular', sort_dir='desc'):
+        return self.observer.collect_items(app_id=app_id, start=start, sort_column=sort_column, sort_dir=sort_dir)
+
+    def onboard(self, urls: list, workers=8) -> dict:
+        """
+        Resolves descriptions of many items concurrently, already known ones are taken from DB
+        :return: {url: description or None}
+        """
+        with ThreadPoolExecutor(workers) as executor:
+            return dict(zip(urls, executor.map(self._safe_get_description, urls)))
+
+    def _safe_get_description(self, item_url):
+        try:
+            return self.get_description(item_url)
+        except Exception as e:
+            logger.warning('Can not get description of %s: %r', item_url, e)
+            return None
 
     def register_task(self, task: Task):
         if task.delay is None:
             self.execute_task(task)
         else:
-            self.task_list.append(task)
+            self._schedule_task(task)
         # TODO log it
         print(f'Register task: {task.url}')
 
-    def update_task_executor(self):
-        # TODO: REIMPLEMENT
-        with ThreadPoolExecutor() as executor:
-            feature_dict = {executor.submit(self.execute_task, task): task.url for task in self.task_list}
-            try:
-                for feature in as_completed(feature_dict.keys(), timeout=3):
-                    task = feature.result()
-                    if task and task.delay is not None:
-                        task.start += task.delay
-                        print(f'Task {feature_dict[feature]} completed')
-            except TimeoutError:
-                # TODO log it
-                print(f'Timed out')
-        sleep(self.sleep_duration)
+    def _schedule_task(self, task: Task):
+        if task.key in self.registered:
+            # already polled item gets new period starting from its next run
+            registered = self.registered[task.key]
+            registered.delay, registered.min_delay, registered.max_delay = task.delay, task.min_delay, task.max_delay
+            registered.priority, registered.deadline = task.priority, task.deadline
+            self.db_wrapper.save_task(registered.to_document())
+        else:
+            self.scheduler.schedule(task)
+            self.registered[task.key] = task
+            self.db_wrapper.save_task(task.to_document())
+
+    def register_many(self, task_type: TaskType, urls: list, delay: int, min_delay=None, max_delay=None,
+                      priority: Priority = Priority.NORMAL, deadline=None) -> int:
+        """
+        Registers periodic tasks for many items at once, the ones owned by other shards and not listing urls are skipped
+        :return: amount of accepted urls
+        """
+        accepted = []
+        for url in urls:
+            if not url.startswith(LISTING_PREFIX) or (self.owns is not None and not self.owns(url)):
+                continue
+            self._schedule_task(Task(task_type, url, delay, min_delay=min_delay, max_delay=max_delay,
+                                     priority=priority, deadline=deadline))
+            accepted.append(url)
+        print(f'Registered {len(accepted)} of {len(urls)} tasks')
+        if accepted:
+            self.start_onboard(accepted)
+        return len(accepted)
+
+    def start_onboard(self, urls: list):
+        """
+        Resolves descriptions of newly registered items in background, polls do not wait for the whole batch
+        """
+        Thread(target=self.onboard, args=(urls,), daemon=True).start()
+
+    def get_scheduler_stats(self) -> dict:
+        """
+        Scheduler lag (seconds between due time and actual start), amount of registered, waiting and skipped tasks
+        """
+        return self.scheduler.get_stats()
 
     def execute_task(self, task: Task):
-        if task.start < time_now():
-            params = self.get_description(task.url)
-            if task.task_type == TaskType.PRICE_HISTORY:
-                self.update_price_history(params['app_id'], params['market_hash_name'])
-            elif task.task_type == TaskType.HISTOGRAM:
-                self.update_histogram(params['item_nameid'])
-            else:
-                assert False  # Unknown task_type
-            return task
-        return None
+        params = self.get_description(task.url)
+        if task.task_type == TaskType.PRICE_HISTORY:
+            self.update_price_history(params['app_id'], params['market_hash_name'])
+        elif task.task_type == TaskType.HISTOGRAM:
+            self.adapt_delay(task, self.update_histogram(params['item_nameid']))
+        else:
+            assert False  # Unknown task_type
+        return task
+
+    @staticmethod
+    def adapt_delay(task: Task, changed):
+        """
+        Adaptive task is polled twice as often after a change and 1.5 times less often after an unchanged snapshot
+        :param changed: None - snapshot was not received
+        """
+        if task.adaptive and changed is not None:
+            task.delay = min(task.max_delay, max(task.min_delay, task.delay * (0.5 if changed else 1.5)))
+
+    def check_currency(self, raw):
+        expected_currency = self.observer.get_account_preferences()['price_suffix']
+        if raw["price_suffix"].encode('utf-8') != expected_currency.encode('utf-8'):
+            raise WrongCurrency(
+                f"Wrong currency: expected '{expected_currency.encode('utf-8')}'"
+                f" got '{raw['price_suffix'].encode('utf-8')}'")
 
     def update_price_history(self, app_id: str, market_hash_name: str):
         raw = self.observer.get_price_history(app_id, market_hash_name)
+        self.store_price_history(app_id, market_hash_name, raw)
+
+    def store_price_history(self, app_id: str, market_hash_name: str, raw):
         if raw is not None and raw['success']:
-            expected_currency = self.observer.stealer.get_account_preferences()['price_suffix']
-            if raw["price_suffix"].encode('utf-8') == expected_currency.encode('utf-8'):
-                price_history = reformat_price_history(raw, market_hash_name)
+            self.check_currency(raw)
+            since = self.db_wrapper.get_last_price_timestamp(app_id, market_hash_name)
+            with METRICS.timer('reformat_seconds', kind='price_history'):
+                price_history = reformat_price_history(raw, market_hash_name, since)
+            with METRICS.timer('db_update_seconds', kind='price_history'):
                 self.db_wrapper.update_price_history(app_id, market_hash_name, price_history)
-            else:
-                raise WrongCurrency(
-                    f"Wrong currency: expected '{expected_currency.encode('utf-8')}'"
-                    f" got '{raw['price_suffix'].encode('utf-8')}'")
+            METRICS.inc('updates', kind='price_history', status='ok')
         else:
-            # TODO log it
-            print(f"WARNING: Price history for {app_id}/{market_hash_name} was not been updated")
+            METRICS.inc('updates', kind='price_history', status='error')
+            logger.warning('Price history for %s/%s was not been updated', app_id, market_hash_name)
 
     def update_histogram(self, item_nameid: str):
         raw = self.observer.get_histogram(item_nameid)
+        return self.store_histogram(item_nameid, raw)
+
+    def store_histogram(self, item_nameid: str, raw):
+        """
+        :return: True if the order book changed since the previous snapshot,
+                 None if nothing was received or there is no previous snapshot to compare with
+        """
         if raw is not None and raw['success'] == 1:
-            expected_currency = self.observer.stealer.get_account_preferences()['price_suffix']
-            if raw["price_suffix"].encode('utf-8') == expected_currency.encode('utf-8'):
+            self.check_currency(raw)
+            with METRICS.timer('reformat_seconds', kind='histogram'):
                 histogram = reformat_histogram(raw)
-                self.db_wrapper.update_histogram(item_nameid, histogram)
-            else:
-                raise WrongCurrency(
-                    f"Wrong currency: expected '{expected_currency.encode('utf-8')}'"
-                    f" got '{raw['price_suffix'].encode('utf-8')}'")
-        else:
-            # TODO log it
-            print(f"WARNING: Histogram for {item_nameid} was not been updated")
+            fingerprint, previous = histogram_fingerprint(histogram), self.fingerprints.get(item_nameid)
+            changed = previous != fingerprint
+            self.fingerprints[item_nameid] = fingerprint
+            with METRICS.timer('analytics_seconds'):
+                self.analytics.update(item_nameid, histogram)
+            METRICS.inc('histograms', status='changed' if changed else 'unchanged')
+            with METRICS.timer('db_update_seconds', kind='histogram'):
+                if changed or self.histogram_changes == 'write':
+                    self.db_wrapper.update_histogram(item_nameid, histogram)
+                elif self.histogram_changes == 'timestamp':
+                    self.db_wrapper.mark_histogram_unchanged(item_nameid, histogram['timestamp'])
+            METRICS.inc('updates', kind='histogram', status='ok')
+            return changed if previous is not None else None
+        METRICS.inc('updates', kind='histogram', status='error')
+        logger.warning('Histogram for %s was not been updated', item_nameid)
+        return None
+
+    def _listen(self):
+        while True:
+            command = self.queue.get()
+            self.commands.append(command)
+            self.scheduler.wake()
+            if isinstance(command, str) and command.lower() == 'exit':
+                break
+
+    def start_crawl(self, app_id, how_much=None):
+        from crawler import CatalogCrawler
+        crawler = self.crawlers.get(str(app_id))
+        if crawler is not None and crawler.is_alive():
+            print(f'Crawl {app_id} is already running: {crawler.progress()}')
+            return
+        self.crawlers[str(app_id)] = CatalogCrawler(self, app_id, how_much).start()
+
+    def process_commands(self):
+        while self.commands:
+            task = self.commands.popleft()
+            if isinstance(task, Task):
+                self.register_task(task)
+            if isinstance(task, tuple) and task[0] == 'crawl':
+                self.start_crawl(*task[1:])
+            if isinstance(task, tuple) and task[0] == 'crawl-status':
+                for crawler in self.crawlers.values():
+                    print(crawler.progress())
+            if isinstance(task, tuple) and task[0] == 'register-many':
+                _, task_type, delay, bounds, urls, priority, deadline = task
+                accepted = self.register_many(TaskType[task_type], urls, delay, *bounds, Priority[priority], deadline)
+                self.reply(('ack', 'register-many', accepted, len(urls)))
+            if isinstance(task, tuple) and task[0] == 'register-app':
+                _, task_type, delay, bounds, app_id, priority, deadline = task
+                urls = self.db_wrapper.get_app_links(app_id)
+                accepted = self.register_many(TaskType[task_type], urls, delay, *bounds, Priority[priority], deadline)
+                self.reply(('ack', 'register-app', accepted, len(urls)))
+            if isinstance(task, tuple) and task[0] == 'book':
+                description = self.db_wrapper.get_description(task[1])
+                self.reply(('book', task[1], description and self.analytics.get(description['item_nameid'])))
+            if isinstance(task, tuple) and task[0] == 'top':
+                self.reply(('top', self.analytics.top(*task[1:])))
+            if isinstance(task, tuple) and task[0] == 'alert':
+                self.analytics.add_alert(*task[1:])
+            if isinstance(task, tuple) and task[0] == 'stats':
+                self.reply(('stats', os.getpid(), self.get_stats()))
+            if isinstance(task, str) and task.lower() == 'exit':
+                self.running = False
 
     def run(self):
         self.running = True
+        if self.listener is None or not self.listener.is_alive():
+            self.listener = Thread(target=self._listen, daemon=True)
+            self.listener.start()
+        if self.backfill_on_start and self.backfiller is None:
+            self.start_backfill()
         while self.running:
-            while not self.queue.empty():
-                task = self.queue.get()
-                if isinstance(task, Task):
-                    self.register_task(task)
-                if isinstance(task, str) and task.lower() == 'exit':
-                    self.running = False
-                    # TODO: put all tasks in database
-            self.update_task_executor()
+            self.process_commands()
+            if not self.running:
+                break
+            timeout = self.scheduler.run_pending()
+            if time() >= self.next_checkpoint:
+                self.save_schedule()
+            if self.retention is not None and time() >= self.next_prune:
+                self.start_prune()
+            checkpoint_in = max(0.0, self.next_checkpoint - time())
+            self.scheduler.wait(checkpoint_in if timeout is None else min(timeout, checkpoint_in))
+        self.close()
+
+    def start_prune(self):
+        self.next_prune = time() + self.prune_interval
+        if self.pruner is None or not self.pruner.is_alive():
+            self.pruner = Thread(target=self.prune, daemon=True)
+            self.pruner.start()
+
+    def start_backfill(self):
+        self.backfiller = Thread(target=self._safe_backfill, daemon=True)
+        self.backfiller.start()
+
+    def _safe_backfill(self):
+        try:
+            self.backfill()
+        except Exception as e:
+            logger.warning('Backfill of rollups failed: %r', e)
+
+    def backfill(self):
+        """
+        Rolls snapshots stored before rollups were turned on up into bars, once per process.
+        Once an item has bars they are read instead of its raw snapshots, so older periods have to be rolled up too.
+        """
+        with self.backfill_lock:
+            if not self.backfilled:
+                with METRICS.timer('backfill_seconds'):
+                    METRICS.inc('backfilled_snapshots', self.db_wrapper.backfill_rollups())
+                self.backfilled = True
+
+    def prune(self):
+        try:
+            # snapshots stored before rollups were turned on would be lost with their bars
+            self.backfill()
+            with METRICS.timer('prune_seconds'):
+                removed = self.db_wrapper.prune_histograms(self.retention)
+            METRICS.inc('pruned_snapshots', removed)
+        except Exception as e:
+            logger.warning('Pruning of old snapshots failed: %r', e)
+
+    def reply(self, message):
+        if self.replies is None:
+            pprint(message)
+        else:
+            self.replies.put(message)
+
+    def get_stats(self) -> dict:
+        return {'scheduler': self.get_scheduler_stats(), 'db': self.db_wrapper.get_stats(),
+                'analytics': {'items': len(self.analytics), 'alerts': [str(rule) for rule in self.analytics.rules]},
+                'metrics': METRICS.snapshot()}
+
+    def close(self):
+        self.scheduler.shutdown()
+        for task in self.scheduler.tasks():
+            self.mark_dirty(task)
+        self.save_schedule()
+        self.db_wrapper.close()
+        print(f'DB stats: {self.db_wrapper.get_stats()}')
+
 
 
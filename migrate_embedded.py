@@ -0,0 +1,74 @@
+from argparse import ArgumentParser
+
+from pymongo import ReplaceOne
+
+from embedded_db import EmbeddedWrapper
+from market_data import MongoWrapper, time_now
+
+
+def import_from_mongo(mongo: MongoWrapper, embedded: EmbeddedWrapper):
+    for description in mongo.db['descriptions'].find({}, {'_id': 0}):
+        embedded.add_description(description)
+    for item in mongo.db['items_list'].find({}, {'_id': 0}):
+        embedded.register_item(item)
+    for name in mongo.db.list_collection_names(filter={'name': {'$regex': r'^app\d+$'}}):
+        # incremental mode keeps one document per month, records are merged by timestamp
+        for document in mongo.db[name].find({}, {'_id': 0, 'market_hash_name': 1, 'history': 1}):
+            embedded.update_price_history(name[len('app'):], document['market_hash_name'], document)
+    for task in mongo.load_tasks():
+        embedded.save_task(task)
+    for state in mongo.db['crawls'].find({}):
+        embedded.save_crawl_state(state['_id'], state)
+    items = snapshots = 0
+    for description in embedded.iter_descriptions():
+        for histogram in mongo.get_histograms(description['url'], time_now(), stream=True):
+            embedded.update_histogram(description['item_nameid'], histogram)
+            snapshots += 1
+        items += 1
+    print(f'{snapshots} snapshots of {items} items imported')
+
+
+def export_to_mongo(embedded: EmbeddedWrapper, mongo: MongoWrapper):
+    for description in embedded.iter_descriptions():
+        mongo.writer.add('descriptions', ReplaceOne({'url': description['url']}, description, upsert=True))
+    for item in embedded.iter_items():
+        mongo.register_item(item)
+    for app_id, price_history in embedded.iter_price_histories():
+        mongo.update_price_history(app_id, price_history['market_hash_name'], price_history)
+    for task in embedded.load_tasks():
+        mongo.save_task(task)
+    for app_id, state in embedded.iter_crawl_states():
+        mongo.writer.add('crawls', ReplaceOne({'_id': app_id}, state, upsert=True))
+    items = snapshots = 0
+    for item_nameid, histograms in embedded.iter_item_histograms():
+        for histogram in histograms:
+            mongo.update_histogram(item_nameid, histogram)
+            snapshots += 1
+        items += 1
+    print(f'{snapshots} snapshots of {items} items exported')
+
+
+def main():
+    parser = ArgumentParser(description='Copy data between MongoDB and embedded storage (embedded_db.py)')
+    parser.add_argument('direction', choices=('import', 'export'),
+                        help='import - from MongoDB into embedded storage, export - back into MongoDB')
+    parser.add_argument('--path', default='data', help='directory of embedded storage')
+    parser.add_argument('--histogram-storage', choices=('collections', 'timeseries'), default='collections')
+    parser.add_argument('--histogram-encoding', choices=('plain', 'delta'), default='plain')
+    parser.add_argument('--price-history-mode', choices=('replace', 'incremental'), default='replace')
+    args = parser.parse_args()
+    mongo = MongoWrapper(histogram_storage=args.histogram_storage, histogram_encoding=args.histogram_encoding,
+                         price_history_mode=args.price_history_mode)
+    embedded = EmbeddedWrapper(args.path)
+    try:
+        if args.direction == 'import':
+            import_from_mongo(mongo, embedded)
+        else:
+            export_to_mongo(embedded, mongo)
+    finally:
+        embedded.close()
+        mongo.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+from argparse import ArgumentParser
+
+from market_data import MongoWrapper
+
+
+def main():
+    parser = ArgumentParser(description='Move item{item_nameid} histogram collections into one time-series store')
+    parser.add_argument('--drop', action='store_true', help='drop item collections after migration')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    db_wrapper = MongoWrapper(histogram_storage='timeseries')
+    db_wrapper.migrate_histogram_collections(drop=args.drop, batch_size=args.batch_size)
+    db_wrapper.close()
+
+
+if __name__ == '__main__':
+    main()
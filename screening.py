@@ -0,0 +1,159 @@
+from collections import defaultdict
+from time import time
+from urllib import parse
+
+import numpy as np
+
+STEAM_FEE = 0.15
+
+
+class ScreeningEngine:
+    """
+    Ranks registered items by their price history.
+    Histories are fetched with one aggregation per app (cut to the requested window on the server side),
+    order book closes are read from daily OHLC rollups (bars_1d) in one aggregation,
+    all metrics are computed over flat NumPy arrays at once.
+    """
+
+    COLUMNS = ('app_id', 'market_hash_name', 'count', 'price', 'volume', 'median', 'volatility', 'spread', 'net_margin',
+               'book_margin')
+
+    def __init__(self, db):
+        """
+        :param db: pymongo Database (MongoWrapper.db)
+        """
+        self.db = db
+
+    def load_items(self, min_count, min_price, max_price) -> list:
+        return list(self.db['items_list'].find(
+            {'count': {"$gte": min_count}, 'price': {"$gte": min_price, "$lte": max_price}},
+            {'_id': 0, 'app_id': 1, 'market_hash_name': 1, 'count': 1, 'price': 1}))
+
+    def load_histories(self, items: list, since: int) -> dict:
+        """
+        :return: {(app_id, market_hash_name): [[timestamp, median price, volume], ...]}
+        """
+        # price histories are stored under names quoted as in listing urls, items_list keeps them unquoted
+        names = defaultdict(list)
+        for item in items:
+            names[str(item['app_id'])].append(parse.quote(item['market_hash_name']))
+        histories = {}
+        for app_id, hash_names in names.items():
+            # incremental price history is split into month documents, legacy one has neither month nor last
+            pipeline = [
+                {'$match': {'market_hash_name': {'$in': hash_names},
+                            '$or': [{'last': {'$gte': since}}, {'last': {'$exists': False}}]}},
+                {'$sort': {'month': 1}},
+                {'$project': {'_id': 0, 'market_hash_name': 1, 'history': {'$filter': {
+                    'input': '$history', 'as': 'record',
+                    'cond': {'$gte': [{'$arrayElemAt': ['$$record', 0]}, since]}}}}},
+            ]
+            for document in self.db[f'app{app_id}'].aggregate(pipeline):
+                key = (app_id, parse.unquote(document['market_hash_name']))
+                histories.setdefault(key, []).extend(document['history'])
+        return histories
+
+    def load_book(self, items: list, since: int) -> dict:
+        """
+        :return: {(app_id, market_hash_name): (last best bid, last best ask)} of daily bars since
+        """
+        keys = {(str(item['app_id']), item['market_hash_name']) for item in items}
+        nameids = {}
+        for description in self.db['descriptions'].find(
+                {'app_id': {'$in': list({app_id for app_id, _ in keys})}},
+                {'_id': 0, 'app_id': 1, 'market_hash_name': 1, 'item_nameid': 1}):
+            # descriptions keep names quoted as in listing urls
+            key = (str(description['app_id']), parse.unquote(description['market_hash_name']))
+            if key in keys and description.get('item_nameid') is not None:
+                nameids[str(description['item_nameid'])] = key
+        pipeline = [
+            {'$match': {'item_nameid': {'$in': list(nameids)}, 't': {'$gte': since - since % 86400}}},
+            {'$sort': {'t': 1}},
+            {'$group': {'_id': '$item_nameid', 'bid': {'$last': '$bid_close'}, 'ask': {'$last': '$ask_close'}}},
+        ]
+        return {nameids[bar['_id']]: (bar['bid'], bar['ask']) for bar in self.db['bars_1d'].aggregate(pipeline)}
+
+    @staticmethod
+    def compute_metrics(items: list, histories: dict, book: dict = None) -> dict:
+        """
+        Vectorized metrics per item:
+            volume - sold amount in the window
+            median - median of hourly/daily median prices
+            volatility - standard deviation of log returns
+            spread - lowest listing price relative to median
+            net_margin - what is left after selling at median with Steam fee relative to buying at lowest listing
+            book_margin - the same for buying by order at the last best bid and selling at the last best ask
+        """
+        n = len(items)
+        blocks = [np.asarray(histories.get((str(item['app_id']), item['market_hash_name'])) or np.empty((0, 3)),
+                  dtype=np.float64).reshape(-1, 3) for item in items]
+        lengths = np.array([len(block) for block in blocks], dtype=np.int64)
+        rows = np.concatenate(blocks) if n else np.empty((0, 3))
+        owner = np.repeat(np.arange(n), lengths)
+        prices, volumes = rows[:, 1], rows[:, 2]
+
+        volume = np.bincount(owner, weights=volumes, minlength=n)
+
+        # median: sort by (owner, price) and average the two middle elements of every group (the same one if odd)
+        order = np.lexsort((prices, owner))
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if n else np.empty(0, dtype=np.int64)
+        median = np.full(n, np.nan)
+        has_data = lengths > 0
+        sorted_prices = prices[order]
+        lower = starts[has_data] + (lengths[has_data] - 1) // 2
+        upper = starts[has_data] + lengths[has_data] // 2
+        median[has_data] = (sorted_prices[lower] + sorted_prices[upper]) / 2
+
+        # volatility: log returns inside every group (rows are time ordered per item)
+        log_prices = np.log(np.maximum(prices, 1e-9))
+        returns = np.diff(log_prices)
+        same_owner = owner[1:] == owner[:-1]
+        returns, return_owner = returns[same_owner], owner[1:][same_owner]
+        return_count = np.bincount(return_owner, minlength=n)
+        return_sum = np.bincount(return_owner, weights=returns, minlength=n)
+        return_sq = np.bincount(return_owner, weights=returns ** 2, minlength=n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = return_sum / return_count
+            volatility = np.sqrt(np.maximum(return_sq / return_count - mean ** 2, 0))
+            listing = np.array([item['price'] for item in items], dtype=np.float64) / 100
+            spread = listing / median - 1
+            net_margin = median * (1 - STEAM_FEE) / listing - 1
+            closes = np.array([(book or {}).get((str(item['app_id']), item['market_hash_name']), (None, None))
+                               for item in items], dtype=np.float64).reshape(-1, 2)
+            book_margin = closes[:, 1] * (1 - STEAM_FEE) / closes[:, 0] - 1
+
+        return {
+            'app_id': np.array([str(item['app_id']) for item in items], dtype=object),
+            'market_hash_name': np.array([item['market_hash_name'] for item in items], dtype=object),
+            'count': np.array([item['count'] for item in items], dtype=np.int64),
+            'price': listing,
+            'volume': volume,
+            'median': median,
+            'volatility': volatility,
+            'spread': spread,
+            'net_margin': net_margin,
+            'book_margin': book_margin,
+        }
+
+    @staticmethod
+    def rank(metrics: dict, sort_by='volume', descending=True, limit=None) -> list:
+        keys = np.nan_to_num(metrics[sort_by].astype(np.float64), nan=-np.inf if descending else np.inf)
+        order = np.argsort(-keys if descending else keys, kind='stable')[:limit]
+        return [{column: metrics[column][i] for column in ScreeningEngine.COLUMNS} for i in order]
+
+    def screen(self, min_count=5000, min_price=1, max_price=40000, days=30, sort_by='volume', limit=100) -> list:
+        items = self.load_items(min_count, min_price, max_price)
+        since = int(time()) - days * 24 * 3600
+        histories = self.load_histories(items, since)
+        return self.rank(self.compute_metrics(items, histories, self.load_book(items, since)), sort_by, limit=limit)
+
+
+def format_table(rows: list) -> str:
+    header = f"{'app':>6} {'name':40} {'count':>7} {'price':>9} {'volume':>9} {'median':>9} " \
+             f"{'volat.':>7} {'spread':>7} {'margin':>7} {'book':>7}"
+    lines = [header]
+    for row in rows:
+        lines.append(f"{row['app_id']:>6} {row['market_hash_name'][:40]:40} {row['count']:>7} {row['price']:>9.2f} "
+                     f"{row['volume']:>9.0f} {row['median']:>9.2f} {row['volatility']:>7.3f} "
+                     f"{row['spread']:>7.2%} {row['net_margin']:>7.2%} {row['book_margin']:>7.2%}")
+    return '\n'.join(lines)
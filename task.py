@@ -1,5 +1,51 @@
-from abc import ABC
+from datetime import datetime
+from enum import Enum
 
-class Task(ABC):
-    pass
+from utils.scheduler import Priority
 
+
+def time_now():
+    return int(datetime.utcnow().timestamp())
+
+
+class TaskType(Enum):
+    PRICE_HISTORY = 0
+    HISTOGRAM = 1
+    SCREENING = 2
+
+
+class Task:
+    def __init__(self, task_type: TaskType, url: str, delay=None, start=None, min_delay=None, max_delay=None,
+                 priority: Priority = Priority.NORMAL, deadline=None):
+        """
+        :param min_delay, max_delay: bounds of adaptive delay, None - delay is fixed
+        :param priority: share of workers the task gets under load, see TaskScheduler
+        :param deadline: seconds after due time the poll is still worth running, None - one delay
+        """
+        self.url = url
+        self.task_type = task_type
+        self.delay = delay
+        self.start = time_now() if start is None else start
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.priority = Priority(priority)
+        self.deadline = deadline
+
+    @property
+    def adaptive(self) -> bool:
+        return self.delay is not None and self.min_delay is not None and self.max_delay is not None
+
+    @property
+    def key(self) -> str:
+        return f'{self.task_type.name}:{self.url}'
+
+    def to_document(self) -> dict:
+        return {'_id': self.key, 'task_type': self.task_type.value, 'url': self.url, 'delay': self.delay,
+                'start': self.start, 'min_delay': self.min_delay, 'max_delay': self.max_delay,
+                'priority': int(self.priority), 'deadline': self.deadline}
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'Task':
+        return cls(TaskType(document['task_type']), document['url'], document['delay'], document['start'],
+                   document.get('min_delay'), document.get('max_delay'),
+                   document.get('priority', Priority.NORMAL), document.get('deadline'))
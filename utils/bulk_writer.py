@@ -0,0 +1,139 @@
+import logging
+from queue import Queue, Empty
+from threading import Thread, Event
+from time import monotonic, perf_counter, sleep
+
+from pymongo.errors import BulkWriteError, PyMongoError, ServerSelectionTimeoutError
+
+from utils.metrics import METRICS, collection_kind
+from utils.scheduler import LagStats
+
+DUPLICATE_KEY = 11000
+
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriter:
+    """
+    Write-behind buffer: groups write operations per collection into unordered bulk_write batches.
+    Batch is flushed when it reaches batch_size or flush_interval seconds after its first operation.
+    add() blocks when max_pending operations are waiting, so producers can not outrun the database.
+    Failed batches are retried. After an error which leaves unknown whether the server applied the batch
+    (e.g. network timeout) only idempotent operations are retried, the others are dropped and counted as failed.
+    """
+
+    def __init__(self, db, batch_size=500, flush_interval=1.0, max_pending=20000, max_retries=5):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.latency = LagStats()
+        self._queue = Queue(maxsize=max_pending)
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        METRICS.gauge('writer_pending', self._queue.qsize)
+
+    def add(self, collection: str, operation, idempotent=True):
+        """
+        :param idempotent: applying the operation twice gives the same result (replace, $set, guarded $push),
+                           False for $inc, $push and inserts without unique index
+        """
+        self._queue.put((collection, operation, idempotent))
+
+    def flush(self):
+        """
+        Blocks until everything added before the call is written
+        """
+        done = Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def get_stats(self) -> dict:
+        return {'pending': self._queue.qsize(), 'batches': self.batches, 'written': self.written,
+                'failed': self.failed, 'latency': self.latency.snapshot()}
+
+    def _run(self):
+        pending = {}
+        count = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = None
+            if item is None or item is _STOP or isinstance(item, Event):
+                self._write_all(pending)
+                pending, count, deadline = {}, 0, None
+                if isinstance(item, Event):
+                    item.set()
+                if item is _STOP:
+                    break
+                continue
+            collection, operation, idempotent = item
+            pending.setdefault(collection, []).append((operation, idempotent))
+            count += 1
+            if deadline is None:
+                deadline = monotonic() + self.flush_interval
+            if count >= self.batch_size:
+                self._write_all(pending)
+                pending, count, deadline = {}, 0, None
+
+    def _write_all(self, pending: dict):
+        for collection, entries in pending.items():
+            try:
+                self._write(collection, entries)
+            except Exception:
+                # writer thread has to survive anything, otherwise producers block forever
+                self.failed += len(entries)
+                logger.exception('%d operations to %s were dropped', len(entries), collection)
+
+    def _write(self, collection: str, entries: list):
+        """
+        :param entries: [(operation, idempotent)]
+        """
+        for attempt in range(self.max_retries):
+            start = perf_counter()
+            try:
+                result = self.db[collection].bulk_write([operation for operation, _ in entries], ordered=False)
+                elapsed = perf_counter() - start
+                self.latency.add(elapsed)
+                METRICS.observe('mongo_write_seconds', elapsed, collection=collection_kind(collection), status='ok')
+                self.batches += 1
+                self.written += len(entries)
+                return result
+            except BulkWriteError as e:
+                # unordered batch: only failed operations have to be retried, the others are applied
+                errors = e.details.get('writeErrors', [])
+                self.written += len(entries) - len(errors)
+                entries = [entries[error['index']] for error in errors if error['code'] != DUPLICATE_KEY]
+                if not entries:
+                    return None
+            except ServerSelectionTimeoutError as e:
+                # no server to send the batch to, nothing was applied
+                METRICS.inc('mongo_write_errors', collection=collection_kind(collection))
+                logger.warning('Bulk write to %s failed: %s', collection, e)
+            except PyMongoError as e:
+                METRICS.inc('mongo_write_errors', collection=collection_kind(collection))
+                logger.warning('Bulk write to %s failed: %s', collection, e)
+                # the server may have applied the batch, repeating the rest could apply them twice
+                unsafe = sum(1 for _, idempotent in entries if not idempotent)
+                if unsafe:
+                    self.failed += unsafe
+                    logger.warning('%d not idempotent operations to %s were dropped', unsafe, collection)
+                    entries = [entry for entry in entries if entry[1]]
+                    if not entries:
+                        return None
+            sleep(min(30.0, 0.5 * 2 ** attempt))
+        self.failed += len(entries)
+        logger.warning('%d operations to %s were dropped after %d attempts', len(entries), collection, self.max_retries)
@@ -0,0 +1,36 @@
+class MinMaxBuckets:
+    """
+    Streaming min/max downsampling: [start, end] is split into equal time buckets,
+    only the lowest and the highest point of every bucket are kept.
+    Memory does not depend on amount of added points, spikes are preserved.
+    """
+
+    def __init__(self, start: float, end: float, buckets: int):
+        self.start = start
+        self.width = max(end - start, 1) / buckets
+        self.buckets = buckets
+        self._low = {}
+        self._high = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, x: float, y: float):
+        if y is None:
+            return
+        self.count += 1
+        bucket = min(self.buckets - 1, max(0, int((x - self.start) / self.width)))
+        low, high = self._low.get(bucket), self._high.get(bucket)
+        if low is None or y < low[1]:
+            self._low[bucket] = (x, y)
+        if high is None or y > high[1]:
+            self._high[bucket] = (x, y)
+
+    def points(self) -> tuple:
+        """
+        :return: xs, ys ordered by x
+        """
+        points = set(self._low.values()) | set(self._high.values())
+        ordered = sorted(points)
+        return [x for x, _ in ordered], [y for _, y in ordered]
@@ -0,0 +1,40 @@
+import bisect
+import hashlib
+
+
+def _hash(key: str) -> int:
+    # md5 instead of hash(): points have to be the same in every process
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys (item urls) onto nodes (shard numbers).
+    Every node is placed on the ring `replicas` times, so keys are spread evenly
+    and adding or removing a node moves only its own share of keys.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = _hash(f'{node}#{replica}')
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        kept = [(point, owner) for point, owner in zip(self._points, self._nodes) if owner != node]
+        self._points = [point for point, _ in kept]
+        self._nodes = [owner for _, owner in kept]
+
+    def get_node(self, key: str):
+        if not self._points:
+            raise KeyError('Hash ring is empty')
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[index]
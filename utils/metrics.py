@@ -0,0 +1,178 @@
+import bisect
+import re
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+# seconds, from 0.5 ms to 2 minutes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 120.0)
+
+
+class Histogram:
+    """
+    Fixed buckets histogram: observe() is one bisect and two additions, memory does not grow
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding q-th value, the last bucket is reported as the largest bound
+        """
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return self.bounds[-1]
+
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'mean': self.sum / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class Metrics:
+    """
+    In-process counters, timing histograms and gauges, keyed by name and labels.
+    Values are per process, every worker of the supervisor has its own registry.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name: str, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observes duration of the block in seconds, failed blocks are observed with status='error'
+        """
+        start = perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            self.observe(name, perf_counter() - start, status=status, **labels)
+
+    def gauge(self, name: str, function, **labels):
+        """
+        :param function: called on every snapshot, returns current value
+        """
+        self.gauges[self._key(name, labels)] = function
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            result = {_format_key(key): value for key, value in self.counters.items()}
+            result.update({_format_key(key): histogram.snapshot() for key, histogram in self.histograms.items()})
+        for key, function in list(self.gauges.items()):
+            result[_format_key(key)] = function()
+        return result
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{_metric_name(name)}_total{_format_labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                seen = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    seen += count
+                    lines.append(f'{_metric_name(name)}_bucket{_format_labels(labels + (("le", bound),))} {seen}')
+                lines.append(f'{_metric_name(name)}_bucket{_format_labels(labels + (("le", "+Inf"),))} '
+                             f'{histogram.count}')
+                lines.append(f'{_metric_name(name)}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{_metric_name(name)}_count{_format_labels(labels)} {histogram.count}')
+        for (name, labels), function in sorted(self.gauges.items(), key=lambda item: item[0]):
+            lines.append(f'{_metric_name(name)}{_format_labels(labels)} {function()}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host='127.0.0.1'):
+        """
+        Starts local HTTP endpoint with metrics in Prometheus text format
+        :return: ThreadingHTTPServer
+        """
+        # http.server pulls in email and html parsers, processes without metrics_port never need them
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def _format_key(key: tuple) -> str:
+    name, labels = key
+    return name + _format_labels(labels)
+
+
+def format_snapshot(snapshot: dict) -> str:
+    lines = []
+    for name, value in sorted(snapshot.items()):
+        if isinstance(value, dict):
+            value = f"count {value['count']}, mean {value['mean'] * 1000:.2f}ms, " \
+                    f"p50 <{value['p50'] * 1000:g}ms, p99 <{value['p99'] * 1000:g}ms"
+        lines.append(f'{name}: {value}')
+    return '\n'.join(lines)
+
+
+def collection_kind(collection: str) -> str:
+    """
+    item123/app730 -> item/app, so per item collections do not explode amount of series
+    """
+    match = re.match(r'(item|app)\d+$', collection)
+    return match.group(1) if match else collection
+
+
+METRICS = Metrics()
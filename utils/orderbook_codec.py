@@ -0,0 +1,177 @@
+import logging
+import sys
+import threading
+from array import array
+from itertools import accumulate
+
+logger = logging.getLogger(__name__)
+
+# 2 - documents keep their position after the keyframe in 'i'
+ENCODING_VERSION = 2
+REMOVED = -2 ** 31
+
+
+def _pack(levels: dict) -> bytes:
+    """
+    {price_cents: quantity} -> int32 pairs (price, quantity), little-endian
+    """
+    data = array('i')
+    for price, quantity in levels.items():
+        data.append(price)
+        data.append(quantity)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data.tobytes()
+
+
+def _unpack(blob: bytes) -> list:
+    data = array('i')
+    data.frombytes(blob)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return list(zip(data[::2], data[1::2]))
+
+
+def ladder_to_levels(ladder: list) -> dict:
+    """
+    Steam graph [[price, cumulative quantity], ...] -> {price_cents: quantity on this level}
+    """
+    levels = {}
+    previous = 0
+    for price, cumulative in ladder:
+        levels[int(round(price * 100))] = int(cumulative) - previous
+        previous = int(cumulative)
+    return levels
+
+
+def levels_to_ladder(levels: dict, descending: bool, top=None, prices=None) -> list:
+    """
+    :param prices: already sorted prices of levels, if known
+    """
+    if prices is None:
+        prices = sorted(levels, reverse=descending)
+    prices = prices[:top]
+    return [[price / 100, cumulative]
+            for price, cumulative in zip(prices, accumulate(levels[price] for price in prices))]
+
+
+def diff_levels(previous: dict, current: dict) -> dict:
+    """
+    Changed and new levels with their quantity, removed levels with REMOVED quantity
+    """
+    diff = {price: quantity for price, quantity in current.items() if previous.get(price) != quantity}
+    diff.update({price: REMOVED for price in previous if price not in current})
+    return diff
+
+
+def apply_diff(levels: dict, diff: list) -> bool:
+    """
+    Applies diff in place
+    :return: True if set of price levels was changed
+    """
+    changed = False
+    for price, quantity in diff:
+        if quantity == REMOVED:
+            changed = levels.pop(price, None) is not None or changed
+        else:
+            changed = changed or price not in levels
+            levels[price] = quantity
+    return changed
+
+
+class _Side:
+    def __init__(self, blob: bytes, descending: bool):
+        self.descending = descending
+        self.levels = dict(_unpack(blob))
+        self.prices = sorted(self.levels, reverse=descending)
+
+    def apply(self, blob: bytes):
+        if apply_diff(self.levels, _unpack(blob)):
+            self.prices = sorted(self.levels, reverse=self.descending)
+
+    def ladder(self, top=None) -> list:
+        return levels_to_ladder(self.levels, self.descending, top, self.prices)
+
+
+class HistogramEncoder:
+    """
+    Turns reformat_histogram snapshots into compact documents:
+    price levels are packed into int32 arrays (price in cents, quantity per level),
+    every keyframe_interval-th snapshot of an item is a keyframe, others keep only changed levels.
+    Every document keeps its position after the keyframe ('i'), so readers notice a lost or overwritten one.
+    """
+
+    def __init__(self, keyframe_interval=60):
+        self.keyframe_interval = keyframe_interval
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def reset(self, item_nameid=None):
+        with self._lock:
+            if item_nameid is None:
+                self._previous.clear()
+            else:
+                self._previous.pop(item_nameid, None)
+
+    def encode(self, item_nameid: str, histogram: dict) -> dict:
+        sell, buy = ladder_to_levels(histogram['sell']), ladder_to_levels(histogram['buy'])
+        with self._lock:
+            previous = self._previous.get(item_nameid)
+            keyframe = previous is None or previous[2] + 1 >= self.keyframe_interval
+            self._previous[item_nameid] = (sell, buy, 0 if keyframe else previous[2] + 1)
+        document = {key: value for key, value in histogram.items() if key not in ('sell', 'buy')}
+        document['enc'] = ENCODING_VERSION
+        document['k'] = keyframe
+        document['i'] = 0 if keyframe else previous[2] + 1
+        if keyframe:
+            document['s'], document['b'] = _pack(sell), _pack(buy)
+        else:
+            document['s'], document['b'] = _pack(diff_levels(previous[0], sell)), _pack(diff_levels(previous[1], buy))
+        return document
+
+
+def decode_histograms(documents, top=None):
+    """
+    Rebuilds full snapshots (or only top levels of every side) from a time ordered stream of documents.
+    Plain (not encoded) documents are passed through.
+    Unchanged markers ({timestamp, unchanged: True}) repeat the previous snapshot with their own timestamp.
+    A diff which does not follow its keyframe or the previous diff means lost or overwritten documents: the gap is
+    logged and snapshots till the next keyframe are skipped, they would be decoded wrong.
+    Version 1 documents have no positions, their diffs before the first keyframe are skipped.
+    """
+    sell = buy = None
+    previous = None
+    position = None
+    for document in documents:
+        if document.get('unchanged'):
+            if previous is not None:
+                yield dict(previous, timestamp=document['timestamp'])
+            continue
+        if 'enc' not in document:
+            sell = buy = None
+            if top is not None:
+                document = dict(document, sell=document['sell'][:top], buy=document['buy'][:top])
+            previous = document
+            yield document
+            continue
+        expected = None if position is None else position + 1
+        position = document.get('i')
+        if document['k']:
+            sell, buy = _Side(document['s'], descending=False), _Side(document['b'], descending=True)
+        elif position is not None and position != expected:
+            if sell is not None or expected is None:
+                logger.warning('Snapshot %s is diff %s after keyframe, expected %s: keyframe or diffs before it were '
+                               'lost or overwritten, snapshots till the next keyframe are skipped',
+                               document['timestamp'], position, 'a keyframe' if expected is None else expected)
+            sell = buy = previous = None
+            continue
+        elif sell is None:
+            continue
+        else:
+            sell.apply(document['s'])
+            buy.apply(document['b'])
+        histogram = {key: value for key, value in document.items() if key not in ('enc', 'k', 'i', 's', 'b')}
+        histogram['sell'] = sell.ladder(top)
+        histogram['buy'] = buy.ladder(top)
+        previous = histogram
+        yield histogram
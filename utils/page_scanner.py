@@ -0,0 +1,63 @@
+import re
+
+_MARKERS = re.compile(rb'Market_LoadOrderSpread\( (\d+) \);'
+                      rb'|(Market_LoadOrderSpread\( )'
+                      rb'|("marketable":1)'
+                      rb'|("market_marketable_restriction")')
+_TAIL = 64
+
+
+class ListingScanner:
+    """
+    Looks for all listing page markers in one pass over a stream of chunks:
+        Market_LoadOrderSpread( item_nameid ); - histogram id
+        "marketable":1 and "market_marketable_restriction" - resale flags of g_rgAssets
+    Order spread call is placed after g_rgAssets, so once item_nameid is found the rest of the page is not needed.
+    """
+
+    def __init__(self):
+        self.item_nameid = None
+        self.spread_seen = False
+        self.marketable = False
+        self.restricted = False
+        self.bytes_read = 0
+        self._tail = b''
+
+    @property
+    def done(self) -> bool:
+        return self.item_nameid is not None
+
+    @property
+    def broken(self) -> bool:
+        """
+        Order spread call was found but its argument was not
+        """
+        return self.spread_seen and self.item_nameid is None
+
+    @property
+    def is_short_tradable(self) -> bool:
+        return self.marketable and not self.restricted
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        :return: True when everything is found and the stream can be closed
+        """
+        self.bytes_read += len(chunk)
+        window = self._tail + chunk
+        for match in _MARKERS.finditer(window):
+            if match.group(1) is not None:
+                self.item_nameid = match.group(1).decode()
+            elif match.group(2) is not None:
+                self.spread_seen = True
+            elif match.group(3) is not None:
+                self.marketable = True
+            else:
+                self.restricted = True
+        self._tail = window[-_TAIL:]
+        return self.done
+
+    def scan(self, chunks) -> 'ListingScanner':
+        for chunk in chunks:
+            if self.feed(chunk):
+                break
+        return self
@@ -0,0 +1,118 @@
+import random
+from multiprocessing import Array, Lock
+from time import time, sleep
+
+# requests per second, burst size
+DEFAULT_BUDGETS = {
+    'itemordershistogram': (4.0, 10),
+    'pricehistory': (0.5, 5),
+    'search/render': (0.3, 3),
+    'listings': (0.5, 5),
+    'other': (1.0, 5),
+}
+
+THROTTLE_STATUSES = (429,)
+
+_TOKENS, _UPDATED, _BLOCKED_UNTIL, _FAILURES = range(4)
+_FIELDS = 4
+
+
+def endpoint_class(url: str) -> str:
+    for name in ('itemordershistogram', 'pricehistory', 'search/render'):
+        if f'/market/{name}' in url:
+            return name
+    if '/market/listings/' in url:
+        return 'listings'
+    return 'other'
+
+
+def is_throttled(status, text=None) -> bool:
+    """
+    Steam answers 429/5xx or sometimes an empty body (or 'null') when we request too much
+    """
+    if status is None:
+        return False
+    if status in THROTTLE_STATUSES or status >= 500:
+        return True
+    return status == 200 and text is not None and text.strip() in ('', 'null')
+
+
+class RateLimiter:
+    """
+    Token bucket per endpoint class with exponential backoff on throttling answers.
+    State lives in shared memory, so one instance passed to child processes gives them a common budget.
+    """
+
+    def __init__(self, budgets: dict = None, base_backoff=2.0, max_backoff=300.0):
+        budgets = dict(budgets or DEFAULT_BUDGETS)
+        budgets.setdefault('other', DEFAULT_BUDGETS['other'])
+        self.names = list(budgets)
+        self.rates = [float(budgets[name][0]) for name in self.names]
+        self.bursts = [float(budgets[name][1]) for name in self.names]
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._lock = Lock()
+        self._state = Array('d', _FIELDS * len(self.names), lock=False)
+        now = time()
+        for i, burst in enumerate(self.bursts):
+            self._state[i * _FIELDS + _TOKENS] = burst
+            self._state[i * _FIELDS + _UPDATED] = now
+
+    def _index(self, url: str) -> int:
+        name = endpoint_class(url)
+        return self.names.index(name if name in self.names else 'other') * _FIELDS
+
+    def reserve(self, url: str) -> float:
+        """
+        Takes one token from endpoint budget
+        :return: seconds caller has to wait before sending the request
+        """
+        i = self._index(url)
+        k = i // _FIELDS
+        with self._lock:
+            now = time()
+            state = self._state
+            rate = self.rates[k] / (1 + state[i + _FAILURES])
+            tokens = min(self.bursts[k], state[i + _TOKENS] + (now - state[i + _UPDATED]) * rate) - 1
+            state[i + _TOKENS] = tokens
+            state[i + _UPDATED] = now
+            wait = -tokens / rate if tokens < 0 else 0.0
+            return max(wait, state[i + _BLOCKED_UNTIL] - now)
+
+    def acquire(self, url: str):
+        wait = self.reserve(url)
+        if wait > 0:
+            sleep(wait)
+
+    async def acquire_async(self, url: str):
+        # asyncio is already loaded by the running loop, importing it on top would slow down sync processes
+        import asyncio
+        wait = self.reserve(url)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def report(self, url: str, throttled: bool):
+        """
+        Feedback from the response: throttling doubles backoff (with jitter) and slows the bucket down,
+        every successful answer restores the rate step by step
+        """
+        i = self._index(url)
+        with self._lock:
+            if throttled:
+                failures = self._state[i + _FAILURES] + 1
+                backoff = min(self.max_backoff, self.base_backoff * 2 ** (failures - 1))
+                backoff *= random.uniform(0.5, 1.5)
+                self._state[i + _FAILURES] = failures
+                self._state[i + _BLOCKED_UNTIL] = max(self._state[i + _BLOCKED_UNTIL], time() + backoff)
+                self._state[i + _TOKENS] = min(self._state[i + _TOKENS], 0.0)
+            elif self._state[i + _FAILURES] > 0:
+                self._state[i + _FAILURES] -= 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            now = time()
+            return {name: {
+                'tokens': self._state[k * _FIELDS + _TOKENS],
+                'failures': int(self._state[k * _FIELDS + _FAILURES]),
+                'blocked_for': max(0.0, self._state[k * _FIELDS + _BLOCKED_UNTIL] - now),
+            } for k, name in enumerate(self.names)}
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from utils.lru_cache import LRUCache
+from utils.metrics import METRICS
+from utils.rate_limiter import endpoint_class
+
+# seconds a page of the endpoint is served from memory, 0 - only simultaneous requests are merged
+DEFAULT_TTLS = {
+    'itemordershistogram': 5,
+    'pricehistory': 300,
+    'search/render': 60,
+    'listings': 600,
+    'other': 0,
+}
+
+
+class ResponseCache:
+    """
+    Pages by url with time to live per endpoint class and LRU eviction.
+    Identical requests in flight at the same time are merged: the first one fetches, others wait for its result.
+    Failed fetches (None) are not cached.
+    """
+
+    def __init__(self, ttls: dict = None, maxsize=2000):
+        """
+        :param ttls: {endpoint class: seconds}, missing classes use DEFAULT_TTLS
+        :param maxsize: max amount of pages per endpoint class
+        """
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.caches = {endpoint: LRUCache(maxsize, ttl) for endpoint, ttl in self.ttls.items() if ttl}
+        self.fetches = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._in_flight_async = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, url: str, endpoint: str):
+        cache = self.caches.get(endpoint)
+        page = None if cache is None else cache.get(url)
+        if page is not None:
+            METRICS.inc('response_cache', endpoint=endpoint, result='hit')
+        return page
+
+    def _store(self, url: str, endpoint: str, page):
+        cache = self.caches.get(endpoint)
+        if cache is not None and page is not None:
+            cache.put(url, page)
+
+    def get(self, url: str, fetch):
+        """
+        :param fetch: callable(url) -> page or None, called only on cache miss by the first of simultaneous callers
+        """
+        endpoint = endpoint_class(url)
+        page = self._cached(url, endpoint)
+        if page is not None:
+            return page
+        with self._lock:
+            future = self._in_flight.get(url)
+            leader = future is None
+            if leader:
+                future = self._in_flight[url] = Future()
+                self.fetches += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            METRICS.inc('response_cache', endpoint=endpoint, result='coalesced')
+            return future.result()
+        METRICS.inc('response_cache', endpoint=endpoint, result='miss')
+        try:
+            page = fetch(url)
+            self._store(url, endpoint, page)
+            future.set_result(page)
+            return page
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[url]
+
+    async def get_async(self, url: str, fetch):
+        """
+        Same as get for coroutines of one event loop
+        :param fetch: coroutine function(url) -> page or None
+        """
+        endpoint = endpoint_class(url)
+        page = self._cached(url, endpoint)
+        if page is not None:
+            return page
+        future = self._in_flight_async.get(url)
+        if future is not None:
+            self.coalesced += 1
+            METRICS.inc('response_cache', endpoint=endpoint, result='coalesced')
+            return await asyncio.shield(future)
+        future = self._in_flight_async[url] = asyncio.get_running_loop().create_future()
+        self.fetches += 1
+        METRICS.inc('response_cache', endpoint=endpoint, result='miss')
+        try:
+            page = await fetch(url)
+            self._store(url, endpoint, page)
+            future.set_result(page)
+            return page
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # nobody may wait for it
+            future.exception()
+            raise
+        finally:
+            del self._in_flight_async[url]
+
+    def get_stats(self) -> dict:
+        return {'fetches': self.fetches, 'coalesced': self.coalesced,
+                'caches': {endpoint: cache.get_stats() for endpoint, cache in self.caches.items()}}
@@ -0,0 +1,150 @@
+import logging
+import math
+import operator
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('best_bid', 'best_ask', 'spread', 'net_margin', 'ewma_price', 'volatility',
+           'buy_count', 'sell_count', 'buy_count_delta', 'sell_count_delta', 'buy_trend', 'sell_trend',
+           'updated', 'updates')
+
+# per item state which is not a metric
+_STATE = ('last_mid',)
+
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+
+class AlertRule:
+    def __init__(self, column: str, op: str, threshold: float):
+        if column not in COLUMNS or op not in OPERATORS:
+            raise ValueError(f'Wrong alert {column} {op} {threshold}')
+        self.column = column
+        self.op = op
+        self.threshold = threshold
+        self.active = np.zeros(0, dtype=bool)
+
+    def __str__(self):
+        return f'{self.column} {self.op} {self.threshold}'
+
+
+class RollingTable:
+    """
+    Rolling order book metrics per item, updated in O(1) by every histogram snapshot:
+        best_bid, best_ask - top levels of buy and sell sides
+        spread - best_ask / best_bid - 1
+        net_margin - what is left after buying at best bid and selling at best ask with Steam fee
+        ewma_price - EWMA of mid price
+        volatility - square root of EWMA of squared log returns of mid price between consecutive snapshots
+        buy_count_delta, sell_count_delta - change of order counts since the previous snapshot, *_trend - their EWMA
+    Columns are NumPy arrays with one row per item_nameid, so ranking all items does not touch the DB.
+    Alert rules fire once when an item crosses the threshold.
+    """
+
+    def __init__(self, alpha=0.1, fee=0.15, capacity=1024, on_alert=None):
+        """
+        :param alpha: EWMA weight of the newest snapshot
+        :param fee: Steam fee, same as screening.STEAM_FEE
+        :param on_alert: callable(item_nameid, rule, row) called when an alert fires, default - print
+        """
+        self.alpha = alpha
+        self.fee = fee
+        self.rows = {}
+        self.keys = []
+        self.columns = {column: np.full(capacity, np.nan) for column in COLUMNS + _STATE}
+        self.rules = []
+        self.on_alert = on_alert or self._log_alert
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _row(self, item_nameid: str) -> int:
+        row = self.rows.get(item_nameid)
+        if row is None:
+            row = self.rows[item_nameid] = len(self.keys)
+            self.keys.append(item_nameid)
+            capacity = len(self.columns['updates'])
+            if row >= capacity:
+                for column, values in self.columns.items():
+                    grown = np.full(capacity * 2, np.nan)
+                    grown[:capacity] = values
+                    self.columns[column] = grown
+            self.columns['updates'][row] = 0
+        return row
+
+    def update(self, item_nameid: str, histogram: dict):
+        """
+        :param histogram: reformat_histogram snapshot
+        """
+        bid = histogram['buy'][0][0] if histogram['buy'] else math.nan
+        ask = histogram['sell'][0][0] if histogram['sell'] else math.nan
+        mid = (bid + ask) / 2 if histogram['buy'] and histogram['sell'] else (ask if histogram['sell'] else bid)
+        with self._lock:
+            row = self._row(str(item_nameid))
+            c = self.columns
+            first = c['updates'][row] == 0
+            a = self.alpha
+            if first or math.isnan(c['ewma_price'][row]):
+                c['ewma_price'][row] = mid
+                c['volatility'][row] = 0.0
+                c['buy_count_delta'][row] = c['sell_count_delta'][row] = 0
+                c['buy_trend'][row] = c['sell_trend'][row] = 0.0
+            else:
+                last_mid = c['last_mid'][row]
+                log_return = math.log(mid / last_mid) if mid > 0 and last_mid > 0 else 0.0
+                c['ewma_price'][row] = (1 - a) * c['ewma_price'][row] + a * mid
+                c['volatility'][row] = math.sqrt((1 - a) * c['volatility'][row] ** 2 + a * log_return ** 2)
+                c['buy_count_delta'][row] = histogram['buy_count'] - c['buy_count'][row]
+                c['sell_count_delta'][row] = histogram['sell_count'] - c['sell_count'][row]
+                c['buy_trend'][row] = (1 - a) * c['buy_trend'][row] + a * c['buy_count_delta'][row]
+                c['sell_trend'][row] = (1 - a) * c['sell_trend'][row] + a * c['sell_count_delta'][row]
+            if mid > 0:
+                c['last_mid'][row] = mid
+            c['best_bid'][row], c['best_ask'][row] = bid, ask
+            c['spread'][row] = ask / bid - 1 if bid > 0 else math.nan
+            c['net_margin'][row] = ask * (1 - self.fee) / bid - 1 if bid > 0 else math.nan
+            c['buy_count'][row], c['sell_count'][row] = histogram['buy_count'], histogram['sell_count']
+            c['updated'][row] = histogram['timestamp']
+            c['updates'][row] += 1
+            fired = self._check_alerts(row)
+        for rule in fired:
+            self.on_alert(str(item_nameid), rule, self.get(str(item_nameid)))
+
+    def _check_alerts(self, row: int) -> list:
+        fired = []
+        for rule in self.rules:
+            if len(rule.active) <= row:
+                rule.active = np.concatenate((rule.active, np.zeros(len(self.columns['updates']), dtype=bool)))
+            active = bool(OPERATORS[rule.op](self.columns[rule.column][row], rule.threshold))
+            if active and not rule.active[row]:
+                fired.append(rule)
+            rule.active[row] = active
+        return fired
+
+    def add_alert(self, column: str, op: str, threshold: float) -> AlertRule:
+        rule = AlertRule(column, op, threshold)
+        with self._lock:
+            self.rules.append(rule)
+        return rule
+
+    def get(self, item_nameid: str) -> dict:
+        row = self.rows.get(str(item_nameid))
+        if row is None:
+            return None
+        return dict({column: self.columns[column][row].item() for column in COLUMNS}, item_nameid=str(item_nameid))
+
+    def top(self, column: str, n=10, descending=True) -> list:
+        if column not in COLUMNS:
+            raise ValueError(f'Unknown column {column}')
+        with self._lock:
+            values = self.columns[column][:len(self.keys)].copy()
+        keys = np.nan_to_num(values, nan=-np.inf if descending else np.inf)
+        order = np.argsort(-keys if descending else keys, kind='stable')[:n]
+        return [self.get(self.keys[row]) for row in order]
+
+    @staticmethod
+    def _log_alert(item_nameid: str, rule: AlertRule, row: dict):
+        logger.warning('ALERT: item %s: %s (%s = %.4f)', item_nameid, rule, rule.column, row[rule.column])
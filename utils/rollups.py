@@ -0,0 +1,128 @@
+import threading
+
+# bar name: seconds
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+
+
+def bar_collection(resolution: str) -> str:
+    return f'bars_{resolution}'
+
+
+def pick_resolution(period: int, points: int):
+    """
+    :return: the coarsest resolution giving at least points bars over period, None - only raw snapshots are enough
+    """
+    for resolution, seconds in sorted(RESOLUTIONS.items(), key=lambda pair: -pair[1]):
+        if period / seconds >= points:
+            return resolution
+    return None
+
+
+class _Bar:
+    __slots__ = ('t', 'since', 'n', 'bid_open', 'bid_high', 'bid_low', 'bid_close',
+                 'ask_open', 'ask_high', 'ask_low', 'ask_close', 'buy_count', 'sell_count')
+
+    def __init__(self, t: int, since: int):
+        self.t = t
+        self.since = since
+        self.n = 0
+        self.bid_open = self.bid_high = self.bid_low = self.bid_close = None
+        self.ask_open = self.ask_high = self.ask_low = self.ask_close = None
+        self.buy_count = self.sell_count = None
+
+    def add(self, bid, ask, buy_count, sell_count):
+        self.n += 1
+        if bid is not None:
+            if self.bid_open is None:
+                self.bid_open = self.bid_high = self.bid_low = bid
+            self.bid_high, self.bid_low, self.bid_close = max(self.bid_high, bid), min(self.bid_low, bid), bid
+        if ask is not None:
+            if self.ask_open is None:
+                self.ask_open = self.ask_high = self.ask_low = ask
+            self.ask_high, self.ask_low, self.ask_close = max(self.ask_high, ask), min(self.ask_low, ask), ask
+        self.buy_count, self.sell_count = buy_count, sell_count
+
+    def merge_update(self, older=False) -> dict:
+        """
+        Mongo update merging this part into the stored bar: open is kept from the first part,
+        high and low are extremes of all parts, close and order counts are taken from the last one
+        :param older: the part precedes the stored one (backfill), its open replaces the stored open and close is kept
+        """
+        first, last = ('$set', '$setOnInsert') if older else ('$setOnInsert', '$set')
+        update = {'$inc': {'n': self.n}, last: {'buy_count': self.buy_count, 'sell_count': self.sell_count}}
+        for side in ('bid', 'ask'):
+            if getattr(self, f'{side}_open') is not None:
+                update.setdefault(first, {})[f'{side}_open'] = getattr(self, f'{side}_open')
+                update.setdefault('$max', {})[f'{side}_high'] = getattr(self, f'{side}_high')
+                update.setdefault('$min', {})[f'{side}_low'] = getattr(self, f'{side}_low')
+                update[last][f'{side}_close'] = getattr(self, f'{side}_close')
+        return update
+
+
+class BarAggregator:
+    """
+    Rolls histogram snapshots of every item up into bid/ask OHLC bars with order counts (volume) at bar close.
+    Open bars live in memory, their parts are handed out for writing when the bar closes
+    or flush_interval seconds (of snapshot time) after the previous part, so stored open bars lag at most that much.
+    """
+
+    def __init__(self, resolutions: dict = None, flush_interval=300):
+        self.resolutions = resolutions or RESOLUTIONS
+        self.flush_interval = flush_interval
+        self._bars = {}
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def add(self, item_nameid: str, histogram: dict) -> list:
+        """
+        :return: [(resolution, item_nameid, part)] ready to be written
+        """
+        point = (histogram['buy'][0][0] if histogram['buy'] else None,
+                 histogram['sell'][0][0] if histogram['sell'] else None,
+                 histogram['buy_count'], histogram['sell_count'])
+        with self._lock:
+            self._last[str(item_nameid)] = point
+            return self._add(str(item_nameid), histogram['timestamp'], point)
+
+    def add_unchanged(self, item_nameid: str, timestamp: int) -> list:
+        """
+        Order book is the same as in the previous snapshot of the item, unknown before restart - nothing to add
+        """
+        with self._lock:
+            point = self._last.get(str(item_nameid))
+            return [] if point is None else self._add(str(item_nameid), timestamp, point)
+
+    def _add(self, item_nameid: str, timestamp: int, point: tuple) -> list:
+        ready = []
+        for resolution, seconds in self.resolutions.items():
+            key = (item_nameid, resolution)
+            bar = self._bars.get(key)
+            start = timestamp - timestamp % seconds
+            if bar is not None and (bar.t != start or timestamp - bar.since >= self.flush_interval):
+                ready.append((resolution, item_nameid, bar))
+                bar = None
+            if bar is None:
+                bar = self._bars[key] = _Bar(start, timestamp)
+            bar.add(*point)
+        return ready
+
+    def open_since(self, item_nameid: str):
+        """
+        :return: start of the open bar of the item at the finest resolution, None if there is none
+        """
+        finest = min(self.resolutions, key=self.resolutions.get)
+        with self._lock:
+            bar = self._bars.get((str(item_nameid), finest))
+        return None if bar is None else bar.t
+
+    def drain(self) -> list:
+        """
+        Parts of all open bars, e.g. before shutdown
+        """
+        with self._lock:
+            ready = [(resolution, item_nameid, bar) for (item_nameid, resolution), bar in self._bars.items()]
+            self._bars.clear()
+        return ready
+
+    def __len__(self):
+        return len(self._bars)
@@ -0,0 +1,261 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+from time import time
+
+from utils.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+# share of dispatches every priority class gets while all of them have due tasks
+DEFAULT_WEIGHTS = {Priority.HIGH: 8, Priority.NORMAL: 3, Priority.LOW: 1}
+
+
+class LagStats:
+    """
+    Rolling statistics of durations in seconds.
+    Scheduler uses it for lag: difference between task due time and the moment a worker actually started it
+    """
+
+    def __init__(self, window=10000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, lag: float):
+        lag = max(0.0, lag)
+        with self._lock:
+            self.count += 1
+            self.total += lag
+            self.max = max(self.max, lag)
+            self.recent.append(lag)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            recent = sorted(self.recent)
+            count, total, max_lag = self.count, self.total, self.max
+
+        def percentile(p):
+            return recent[min(len(recent) - 1, int(p * len(recent)))] if recent else 0.0
+
+        return {
+            'count': count,
+            'mean': total / count if count else 0.0,
+            'p50': percentile(0.5),
+            'p99': percentile(0.99),
+            'max': max_lag,
+        }
+
+
+class TaskScheduler:
+    """
+    Keeps periodic tasks in a min-heap keyed on the next due time (task.start).
+    Due tasks wait in a queue per priority class (task.priority) and at most max_in_flight of them are handed
+    to the long-lived worker pool, classes are served by weighted fair (stride) scheduling.
+    A task returns to the heap after its execution is finished.
+    Under overload work is skipped instead of being run late:
+        stale - task waited longer than its deadline (task.deadline, default - one period)
+        shed - a task of a higher priority waited longer than shed_lag, all waiting tasks of lower priorities are dropped
+    Skipped periodic tasks are moved to their next period.
+    """
+
+    def __init__(self, execute, max_workers=None, submit=None, on_reschedule=None, max_in_flight=None,
+                 weights: dict = None, shed_lag=30):
+        """
+        :param execute: callable(task) running the task in a worker
+        :param submit: optional callable(task) -> concurrent.futures.Future, replaces the thread pool
+        :param on_reschedule: optional callable(task) called after task got its next due time
+        :param max_in_flight: max amount of submitted unfinished tasks, default - max_workers of the thread pool,
+                              None with submit - unlimited
+        :param weights: {Priority: weight}, see DEFAULT_WEIGHTS
+        :param shed_lag: seconds a waiting task may be late before lower priorities are shed, None - never shed
+        """
+        if submit is None:
+            max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+            max_in_flight = max_in_flight or max_workers
+        self.max_in_flight = max_in_flight
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.shed_lag = shed_lag
+        self._ready = {priority: deque() for priority in sorted(self.weights)}
+        self._pass = {priority: 0.0 for priority in self.weights}
+        self._virtual_time = 0.0
+        self.skipped = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._woken = False
+        self._execute = execute
+        self._executor = None if submit else ThreadPoolExecutor(max_workers=max_workers)
+        self._submit = submit or (lambda task: self._executor.submit(self._run, task))
+        self._on_reschedule = on_reschedule
+        self._generation = 0
+        self.in_flight = 0
+        self.lag = LagStats()
+
+    def __len__(self):
+        return len(self._heap) + self.waiting + self.in_flight
+
+    @property
+    def waiting(self) -> int:
+        """
+        Amount of due tasks waiting for a free worker
+        """
+        return sum(len(ready) for ready in self._ready.values())
+
+    def schedule(self, task):
+        with self._cond:
+            heapq.heappush(self._heap, (task.start, next(self._counter), task))
+            self._woken = True
+            self._cond.notify()
+
+    def clear(self):
+        """
+        Drops all tasks, the ones in flight are not rescheduled after they finish
+        """
+        with self._cond:
+            self._heap.clear()
+            for ready in self._ready.values():
+                ready.clear()
+            self._generation += 1
+
+    def tasks(self) -> list:
+        with self._cond:
+            return [entry[2] for entry in self._heap] + [task for ready in self._ready.values() for task in ready]
+
+    def wake(self):
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def wait(self, timeout=None):
+        """
+        Sleeps until timeout expires or wake()/schedule() is called
+        """
+        with self._cond:
+            if not self._woken:
+                self._cond.wait(timeout)
+            self._woken = False
+
+    def run_pending(self, now=None):
+        """
+        Hands due tasks to free workers, highest priorities first in proportion to their weights
+        :return: seconds until the next deadline or None if there are no tasks.
+                 Tasks waiting for a free worker are handed out when a running one finishes (it wakes the scheduler)
+        """
+        now = time() if now is None else now
+        due, skipped = [], []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                task = heapq.heappop(self._heap)[2]
+                self._ready[self._priority(task)].append(task)
+            self._shed(now, skipped)
+            while self.max_in_flight is None or self.in_flight + len(due) < self.max_in_flight:
+                task = self._next_ready(now, skipped)
+                if task is None:
+                    break
+                due.append(task)
+            self.in_flight += len(due)
+            next_deadline = self._heap[0][0] if self._heap else None
+            generation = self._generation
+        for task, reason in skipped:
+            self._skip(task, reason, now)
+        for task in due:
+            future = self._submit(task)
+            future.add_done_callback(lambda f, t=task: self._on_done(t, f, generation))
+        return None if next_deadline is None else max(0.0, next_deadline - time())
+
+    def _priority(self, task) -> Priority:
+        priority = getattr(task, 'priority', Priority.NORMAL)
+        return priority if priority in self._ready else max(self._ready)
+
+    @staticmethod
+    def _deadline(task):
+        deadline = getattr(task, 'deadline', None)
+        return task.delay if deadline is None else deadline
+
+    def _next_ready(self, now: float, skipped: list):
+        """
+        Pops the next task of the class with the smallest pass, stale tasks met on the way are moved to skipped
+        """
+        while True:
+            candidates = [priority for priority, ready in self._ready.items() if ready]
+            if not candidates:
+                return None
+            priority = min(candidates, key=lambda p: (max(self._pass[p], self._virtual_time), p))
+            # class which was idle does not get a burst for the time it had nothing to do
+            self._virtual_time = max(self._pass[priority], self._virtual_time)
+            self._pass[priority] = self._virtual_time + 1 / self.weights[priority]
+            task = self._ready[priority].popleft()
+            deadline = self._deadline(task)
+            if deadline is not None and now - task.start > deadline:
+                skipped.append((task, 'stale'))
+                continue
+            return task
+
+    def _shed(self, now: float, skipped: list):
+        if self.shed_lag is None:
+            return
+        for priority, ready in self._ready.items():
+            if ready and now - ready[0].start > self.shed_lag:
+                for lower in self._ready:
+                    if lower > priority:
+                        skipped.extend((task, 'shed') for task in self._ready[lower])
+                        self._ready[lower].clear()
+                return
+
+    def _skip(self, task, reason: str, now: float):
+        priority = self._priority(task)
+        self.skipped[(priority.name, reason)] = self.skipped.get((priority.name, reason), 0) + 1
+        METRICS.inc('skipped_tasks', priority=priority.name.lower(), reason=reason)
+        if task.delay is not None:
+            # the nearest period start which is not in the past
+            task.start += (int((now - task.start) // task.delay) + 1) * task.delay
+            self.schedule(task)
+            if self._on_reschedule is not None:
+                self._on_reschedule(task)
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            waiting = {priority.name: len(ready) for priority, ready in self._ready.items()}
+        return {'tasks': len(self), 'in_flight': self.in_flight, 'waiting': waiting,
+                'skipped': {f'{priority}:{reason}': count for (priority, reason), count in self.skipped.items()},
+                'lag': self.lag.snapshot()}
+
+    def _run(self, task):
+        self.lag.add(time() - task.start)
+        return self._execute(task)
+
+    def _on_done(self, task, future, generation):
+        with self._cond:
+            self.in_flight -= 1
+            # a worker is free for tasks waiting in ready queues
+            self._woken = True
+            self._cond.notify()
+        if future.cancelled() or generation != self._generation:
+            return
+        error = future.exception()
+        if error is not None:
+            logger.warning('Task %s failed: %r', task.url, error)
+        if task.delay is not None:
+            task.start = max(task.start + task.delay, time())
+            self.schedule(task)
+            if self._on_reschedule is not None:
+                self._on_reschedule(task)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
@@ -0,0 +1,277 @@
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import chain
+from time import monotonic, sleep
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# one order book snapshot, levels of it are the row's buy + sell records of the levels file starting at 'levels'
+ROW = np.dtype([('item', '<i8'), ('timestamp', '<i8'), ('levels', '<i8'), ('buy_count', '<i4'),
+                ('sell_count', '<i4'), ('buy', '<i4'), ('sell', '<i4'), ('flags', '<i4'), ('reserved', '<i4')])
+# price in cents, cumulative quantity as in Steam ladders
+LEVEL = np.dtype([('price', '<i4'), ('quantity', '<i4')])
+
+UNCHANGED = 1
+
+
+def day_of(timestamp: int) -> str:
+    return _day_name(int(timestamp) // 86400)
+
+
+@lru_cache(maxsize=64)
+def _day_name(day: int) -> str:
+    return datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%Y-%m-%d')
+
+
+def ladder_to_array(ladder: list) -> np.ndarray:
+    values = np.fromiter(chain.from_iterable(ladder), dtype=np.float64, count=2 * len(ladder)).reshape(-1, 2)
+    levels = np.empty(len(values), dtype=LEVEL)
+    levels['price'] = np.rint(values[:, 0] * 100)
+    levels['quantity'] = values[:, 1]
+    return levels
+
+
+def array_to_ladder(levels: np.ndarray) -> list:
+    return [[price / 100, quantity] for price, quantity in levels.tolist()]
+
+
+class SegmentStore:
+    """
+    Append-only columnar store of order book snapshots.
+    Every day has its own directory with fixed-width segment files per writer process:
+        {writer}.rows - ROW records, {writer}.levels - LEVEL records of all ladders
+    Snapshots are buffered per item and appended as blocks of consecutive rows of one item,
+    blocks are indexed in SQLite (blocks.sqlite) by item and time range.
+    Reads map segment files with mmap and slice blocks out of them without copying.
+    """
+
+    def __init__(self, root: str, writer: str = None, block_rows=256, flush_interval=60):
+        """
+        :param writer: name of segment files of this process, processes must not share it
+        :param block_rows: buffered snapshots of an item are appended once there are that many of them
+        :param flush_interval: max seconds a snapshot waits in the buffer
+        """
+        self.root = root
+        self.writer = writer or f'w{os.getpid()}'
+        self.block_rows = block_rows
+        self.flush_interval = flush_interval
+        os.makedirs(root, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(root, 'blocks.sqlite'), timeout=60, check_same_thread=False)
+        self.index.execute('PRAGMA journal_mode=WAL')
+        self.index.execute('PRAGMA synchronous=NORMAL')
+        self.index.execute('CREATE TABLE IF NOT EXISTS blocks (item INTEGER, day TEXT, file TEXT, row_start INTEGER, '
+                           'row_count INTEGER, t_min INTEGER, t_max INTEGER)')
+        self.index.execute('CREATE INDEX IF NOT EXISTS blocks_item_time ON blocks (item, t_max)')
+        self.index.commit()
+        # item -> (day, [(timestamp, buy_count, sell_count, flags, buy levels, sell levels)]), oldest first
+        self._buffers = OrderedDict()
+        self._buffered_at = {}
+        self._files = {}
+        self._maps = {}
+        self._lock = threading.RLock()
+        self.appended_rows = 0
+        self.appended_blocks = 0
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def append(self, item: int, histogram: dict):
+        self._append(int(item), histogram['timestamp'], histogram['buy_count'], histogram['sell_count'], 0,
+                     ladder_to_array(histogram['buy']), ladder_to_array(histogram['sell']))
+
+    def append_unchanged(self, item: int, timestamp: int):
+        """
+        Order book is the same as in the previous snapshot, readers repeat it
+        """
+        empty = np.empty(0, dtype=LEVEL)
+        self._append(int(item), timestamp, 0, 0, UNCHANGED, empty, empty)
+
+    def _append(self, item: int, timestamp: int, buy_count: int, sell_count: int, flags: int, buy, sell):
+        day = day_of(timestamp)
+        with self._lock:
+            buffer = self._buffers.get(item)
+            if buffer is not None and buffer[0] != day:
+                self._flush_item(item)
+                buffer = None
+            if buffer is None:
+                buffer = self._buffers[item] = (day, [])
+                self._buffered_at[item] = monotonic()
+            buffer[1].append((timestamp, buy_count, sell_count, flags, buy, sell))
+            if len(buffer[1]) >= self.block_rows:
+                self._flush_item(item)
+                self.index.commit()
+
+    def _file(self, day: str, kind: str):
+        path = os.path.join(self.root, day, f'{self.writer}.{kind}')
+        file = self._files.get(path)
+        if file is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file = self._files[path] = open(path, 'ab')
+        return file
+
+    def _flush_item(self, item: int):
+        day, rows = self._buffers.pop(item)
+        del self._buffered_at[item]
+        rows_file, levels_file = self._file(day, 'rows'), self._file(day, 'levels')
+        row_start, level_start = rows_file.tell() // ROW.itemsize, levels_file.tell() // LEVEL.itemsize
+        records = np.zeros(len(rows), dtype=ROW)
+        offset = level_start
+        for i, (timestamp, buy_count, sell_count, flags, buy, sell) in enumerate(rows):
+            records[i] = (item, timestamp, offset, buy_count, sell_count, len(buy), len(sell), flags, 0)
+            offset += len(buy) + len(sell)
+        levels_file.write(b''.join(side.tobytes() for row in rows for side in row[4:6]))
+        levels_file.flush()
+        # rows point to levels, so they are written after them and indexed after both
+        rows_file.write(records.tobytes())
+        rows_file.flush()
+        self.index.execute('INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (item, day, self.writer, row_start, len(rows), rows[0][0], rows[-1][0]))
+        self.appended_rows += len(rows)
+        self.appended_blocks += 1
+
+    def flush(self, older_than=None):
+        """
+        Appends buffered snapshots, only the ones waiting longer than older_than seconds if it is given
+        """
+        with self._lock:
+            now = monotonic()
+            for item in list(self._buffers):
+                if older_than is not None and now - self._buffered_at[item] < older_than:
+                    break
+                self._flush_item(item)
+            self.index.commit()
+
+    def _flush_periodically(self):
+        while not self._closed:
+            sleep(1)
+            try:
+                self.flush(self.flush_interval)
+            except Exception as e:
+                logger.warning('Segment flush failed: %r', e)
+
+    def _map(self, day: str, file: str, kind: str, dtype, end: int):
+        """
+        Read-only mapping of a segment file covering at least end records, remapped when the file has grown
+        """
+        if end == 0:
+            return np.empty(0, dtype=dtype)
+        path = os.path.join(self.root, day, f'{file}.{kind}')
+        mapped = self._maps.get(path)
+        if mapped is None or len(mapped) < end:
+            mapped = self._maps[path] = np.memmap(path, dtype=dtype, mode='r')
+        return mapped
+
+    def read_blocks(self, item: int, start: int, end: int):
+        """
+        :return: generator of (rows, levels) views of stored blocks of the item intersecting [start, end], time ordered
+        """
+        with self._lock:
+            blocks = self.index.execute('SELECT day, file, row_start, row_count FROM blocks '
+                                        'WHERE item = ? AND t_max >= ? AND t_min <= ? ORDER BY t_min',
+                                        (int(item), start, end)).fetchall()
+        for day, file, row_start, row_count in blocks:
+            rows = self._map(day, file, 'rows', ROW, row_start + row_count)[row_start:row_start + row_count]
+            last = rows[-1]
+            levels = self._map(day, file, 'levels', LEVEL, last['levels'] + last['buy'] + last['sell'])
+            yield rows, levels
+
+    def _last_full_before(self, item: int, start: int):
+        with self._lock:
+            blocks = self.index.execute('SELECT day, file, row_start, row_count FROM blocks '
+                                        'WHERE item = ? AND t_min < ? ORDER BY t_min DESC LIMIT 16',
+                                        (int(item), start)).fetchall()
+        for day, file, row_start, row_count in blocks:
+            rows = self._map(day, file, 'rows', ROW, row_start + row_count)[row_start:row_start + row_count]
+            full = np.nonzero((rows['flags'] & UNCHANGED == 0) & (rows['timestamp'] < start))[0]
+            if len(full):
+                row = rows[full[-1]]
+                last = row['levels'] + row['buy'] + row['sell']
+                return row, self._map(day, file, 'levels', LEVEL, last)
+        return None
+
+    def read(self, item: int, start: int, end: int, top=None):
+        """
+        Snapshots of the item with start <= timestamp <= end in reformat_histogram format,
+        unchanged markers repeat the previous snapshot with their own timestamp
+        :param top: keep only top price levels of every side
+        """
+        item = int(item)
+        previous = None
+
+        def histogram(row, levels, timestamp):
+            offset, buy, sell = int(row['levels']), int(row['buy']), int(row['sell'])
+            return {'timestamp': timestamp, 'buy_count': int(row['buy_count']), 'sell_count': int(row['sell_count']),
+                    'buy': array_to_ladder(levels[offset:offset + min(buy, top or buy)]),
+                    'sell': array_to_ladder(levels[offset + buy:offset + buy + min(sell, top or sell)])}
+
+        for rows, levels in self.read_blocks(item, start, end):
+            selected = rows[(rows['timestamp'] >= start) & (rows['timestamp'] <= end)]
+            for row in selected:
+                if row['flags'] & UNCHANGED:
+                    if previous is None:
+                        source = self._last_full_before(item, start)
+                        previous = None if source is None else histogram(*source, 0)
+                    if previous is not None:
+                        yield dict(previous, timestamp=int(row['timestamp']))
+                    continue
+                previous = histogram(row, levels, int(row['timestamp']))
+                yield previous
+        # snapshots of this process which are still buffered
+        with self._lock:
+            buffered = list(self._buffers.get(item, (None, []))[1])
+        for timestamp, buy_count, sell_count, flags, buy, sell in buffered:
+            if start <= timestamp <= end:
+                if flags & UNCHANGED:
+                    if previous is not None:
+                        yield dict(previous, timestamp=timestamp)
+                    continue
+                previous = {'timestamp': timestamp, 'buy_count': buy_count, 'sell_count': sell_count,
+                            'buy': array_to_ladder(buy[:top]), 'sell': array_to_ladder(sell[:top])}
+                yield previous
+
+    def items(self) -> list:
+        with self._lock:
+            return [item for item, in self.index.execute('SELECT DISTINCT item FROM blocks')]
+
+    def prune(self, before: int) -> int:
+        """
+        Drops whole days older than the day of before timestamp
+        :return: amount of removed snapshots
+        """
+        day = day_of(before)
+        with self._lock:
+            removed, = self.index.execute('SELECT COALESCE(SUM(row_count), 0) FROM blocks WHERE day < ?',
+                                          (day,)).fetchone()
+            self.index.execute('DELETE FROM blocks WHERE day < ?', (day,))
+            self.index.commit()
+            for path in [path for path in self._files if os.path.basename(os.path.dirname(path)) < day]:
+                self._files.pop(path).close()
+            for path in [path for path in self._maps if os.path.basename(os.path.dirname(path)) < day]:
+                del self._maps[path]
+        for name in os.listdir(self.root):
+            if os.path.isdir(os.path.join(self.root, name)) and name < day:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        return removed
+
+    def get_stats(self) -> dict:
+        return {'buffered_items': len(self._buffers), 'appended_rows': self.appended_rows,
+                'appended_blocks': self.appended_blocks}
+
+    def close(self):
+        self._closed = True
+        self._flusher.join()
+        self.flush()
+        with self._lock:
+            for file in self._files.values():
+                file.close()
+            self._files.clear()
+            self._maps.clear()
+        self.index.close()
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+
+from utils.rate_limiter import RateLimiter
+from utils.steam_session import SteamSession
+
+logger = logging.getLogger(__name__)
+
+
+class _Account:
+    def __init__(self, session: SteamSession):
+        self.session = session
+        self.in_flight = 0
+        self.errors = 0
+        self.healthy = False
+
+    @property
+    def exhausted(self) -> bool:
+        return self.session.requests_counter >= self.session.requests_threshold
+
+    def get_stats(self) -> dict:
+        return {'username': self.session.username, 'healthy': self.healthy, 'in_flight': self.in_flight,
+                'requests': self.session.requests_counter, 'errors': self.errors}
+
+
+class NoHealthySession(Exception):
+    pass
+
+
+class SessionPool:
+    """
+    Several logged in SteamSession objects behind the same get_text/iter_chunks interface.
+    Every request goes to the least loaded healthy account which has request budget left.
+    Accounts failing is_session_alive are taken out of rotation until the next successful check.
+    Error answers, connection errors and timeouts count towards max_errors in a row, which triggers the check.
+    """
+
+    def __init__(self, sessions: list, health_interval=300, max_errors=5):
+        self.accounts = [_Account(session) for session in sessions]
+        self.health_interval = health_interval
+        self.max_errors = max_errors
+        self._health_task = None
+
+    @classmethod
+    async def create(cls, credentials_json_paths: list, connections_limit=100, limiters: list = None,
+                     health_interval=300):
+        """
+        :param limiters: RateLimiter per account (same order as credentials), each account has its own budget
+        :raise NoHealthySession: no account could log in
+        """
+        limiters = limiters or [RateLimiter() for _ in credentials_json_paths]
+        sessions = [SteamSession(path, connections_limit=connections_limit, limiter=limiter)
+                    for path, limiter in zip(credentials_json_paths, limiters)]
+        pool = cls(sessions, health_interval)
+        # workers have no console: accounts are logged in by the parent (login_accounts) or with shared_secret
+        for account in pool.accounts:
+            try:
+                await account.session.try_init_cookies(interactive=False)
+                account.healthy = True
+            except Exception as e:
+                # left out of rotation, health checks try to log it in again
+                logger.warning('Login of %s failed: %r', account.session.username, e)
+        if not any(account.healthy for account in pool.accounts):
+            await pool.aio_destructor()
+            raise NoHealthySession('No Steam account could log in')
+        pool._health_task = asyncio.ensure_future(pool._watch_health())
+        return pool
+
+    @property
+    def username(self) -> str:
+        return ','.join(account.session.username for account in self.accounts)
+
+    def pick(self) -> _Account:
+        candidates = [account for account in self.accounts if account.healthy and not account.exhausted]
+        if not candidates:
+            raise NoHealthySession('There is no healthy Steam session with request budget left')
+        return min(candidates, key=lambda account: (account.in_flight, account.session.requests_counter))
+
+    async def get_text(self, url):
+        account = self.pick()
+        account.in_flight += 1
+        try:
+            text, error = await account.session.get_text(url)
+        except Exception as e:
+            self._register_result(account, repr(e))
+            raise
+        finally:
+            account.in_flight -= 1
+        self._register_result(account, error)
+        return text, error
+
+    async def iter_chunks(self, url, chunk_size=16384):
+        account = self.pick()
+        account.in_flight += 1
+        chunks = account.session.iter_chunks(url, chunk_size)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            self._register_result(account, repr(e))
+            raise
+        finally:
+            account.in_flight -= 1
+            await chunks.aclose()
+
+    def _register_result(self, account: _Account, error):
+        if error is None:
+            account.errors = 0
+            return
+        account.errors += 1
+        if account.errors >= self.max_errors and account.healthy:
+            asyncio.ensure_future(self.check(account))
+
+    async def check(self, account: _Account):
+        try:
+            alive = await account.session.is_session_alive()
+            if not alive:
+                # cookies may have been refreshed by another process, shared_secret allows to log in again
+                await account.session.try_init_cookies(interactive=False)
+                alive = True
+        except Exception as e:
+            logger.warning('Health check of %s failed: %r', account.session.username, e)
+            alive = False
+        if account.healthy and not alive:
+            logger.warning('Session of %s is dead, it is taken out of rotation', account.session.username)
+        elif not account.healthy and alive:
+            logger.info('Session of %s is back in rotation', account.session.username)
+        account.healthy = alive
+        account.errors = 0
+
+    async def _watch_health(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*(self.check(account) for account in self.accounts))
+
+    async def is_session_alive(self) -> bool:
+        return any(account.healthy for account in self.accounts)
+
+    def get_stats(self) -> list:
+        return [account.get_stats() for account in self.accounts]
+
+    async def aio_destructor(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        for account in self.accounts:
+            await account.session.aio_destructor()
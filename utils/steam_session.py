@@ -1,6 +1,9 @@
 import asyncio
 import aiohttp
 import base64
+import hashlib
+import hmac
+import struct
 import time
 import rsa
 import os
@@ -10,6 +13,8 @@ import uuid
 from yarl import URL
 from http.cookies import SimpleCookie
 
+from utils.rate_limiter import RateLimiter, is_throttled
+
 
 class InvalidCredentials(Exception):
     pass
@@ -19,13 +24,44 @@ class CaptchaRequired(Exception):
     pass
 
 
+class SteamGuardRequired(Exception):
+    pass
+
+
+STEAM_GUARD_CHARS = '23456789BCDFGHJKMNPQRTVWXY'
+
+
+def steam_guard_code(shared_secret: str, timestamp: float = None) -> str:
+    """
+    One time code of Steam Guard mobile authenticator
+    :param shared_secret: base64 shared_secret of the authenticator (maFile)
+    """
+    counter = int((time.time() if timestamp is None else timestamp) // 30)
+    digest = hmac.new(base64.b64decode(shared_secret), struct.pack('>Q', counter), hashlib.sha1).digest()
+    offset = digest[19] & 0x0F
+    value = struct.unpack('>I', digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    code = ''
+    for _ in range(5):
+        value, index = divmod(value, len(STEAM_GUARD_CHARS))
+        code += STEAM_GUARD_CHARS[index]
+    return code
+
+
 class LoginExecutor:
 
-    def __init__(self, username: str, password: str, session: aiohttp.ClientSession) -> None:
+    def __init__(self, username: str, password: str, session: aiohttp.ClientSession, shared_secret: str = None,
+                 interactive: bool = True) -> None:
+        """
+        :param shared_secret: steam guard codes are generated from it instead of asking for them
+        :param interactive: ask for steam guard code in console if there is no shared_secret,
+                            processes without console (MarketSupervisor workers) raise SteamGuardRequired instead
+        """
         self.username = username
         self.password = password
         self.one_time_code = ''
         self.session = session
+        self.shared_secret = shared_secret
+        self.interactive = interactive
 
     async def login(self) -> aiohttp.ClientSession:
         login_response = await self._send_login_request()
@@ -97,7 +133,13 @@ class LoginExecutor:
     async def _enter_steam_guard_if_necessary(self, login_response: aiohttp.ClientResponse) -> aiohttp.ClientResponse:
         json_ = await login_response.json()
         if json_['requires_twofactor']:
-            self.one_time_code = input('Please put there your steam guard one time code: ')
+            if self.shared_secret:
+                self.one_time_code = steam_guard_code(self.shared_secret)
+            elif self.interactive:
+                self.one_time_code = input('Please put there your steam guard one time code: ')
+            else:
+                raise SteamGuardRequired(f'{self.username} needs steam guard code: add shared_secret to credentials '
+                                         f'or log in from console first, workers reuse saved cookies')
             return await self._send_login_request()
         return login_response
 
@@ -116,34 +158,45 @@ class LoginExecutor:
 
 
 class SteamSession:
-    def __init__(self, credentials_json_path: str):
+    def __init__(self, credentials_json_path: str, connections_limit: int = 100, keepalive_timeout: float = 30,
+                 limiter: RateLimiter = None, max_retries: int = 3):
         """
         format of credentials:
-            {"username": nickname, "password": password, "path_to_cookies": path_to_cookies or ''}
+            {"username": nickname, "password": password, "path_to_cookies": path_to_cookies or '',
+             "shared_secret": steam guard shared_secret, optional}
+        Should be created inside running event loop. All requests share one pool of keep-alive connections.
         """
         self.credentials_json_path = credentials_json_path
         self.credentials = json.load(open(credentials_json_path, "r"))
         self.username = self.credentials['username']
         self.password = self.credentials['password']
         self.cookies_path = self.credentials.get('path_to_cookies', None)
+        self.shared_secret = self.credentials.get('shared_secret')
         self.requests_counter = 0
         self.requests_threshold = 99000
-        self.session = aiohttp.ClientSession()
+        self.limiter = limiter
+        self.max_retries = max_retries
+        connector = aiohttp.TCPConnector(limit=connections_limit, keepalive_timeout=keepalive_timeout)
+        self.session = aiohttp.ClientSession(connector=connector)
         self.cookies = None
 
-    async def try_init_cookies(self):
-        if os.path.exists(self.cookies_path):
+    async def try_init_cookies(self, interactive=True):
+        """
+        :param interactive: see LoginExecutor
+        """
+        if self.cookies_path and os.path.exists(self.cookies_path):
             print("Cookies found.")
             self.session._cookie_jar.load(self.cookies_path)
         if await self.is_session_alive():
             print('Session is alive. Login is not required')
         else:
             print('Cookies are invalid. Please, login.')
-            self.session = await LoginExecutor(self.username, self.password, self.session).login()
+            self.session = await LoginExecutor(self.username, self.password, self.session, self.shared_secret,
+                                               interactive).login()
             self.save_cookies()
 
     def save_cookies(self):
-        if not os.path.exists(self.cookies_path):
+        if not self.cookies_path or not os.path.exists(self.cookies_path):
             self.cookies_path = f"{str(uuid.uuid4())}.cookie"
         self.session._cookie_jar.save(self.cookies_path)
         self.credentials['path_to_cookies'] = self.cookies_path
@@ -156,11 +209,63 @@ class SteamSession:
         """
         if self.requests_counter < self.requests_threshold:
             self.requests_counter += 1
+            if self.limiter is not None:
+                await self.limiter.acquire_async(url)
             response = await self.session.get(url)
-            return response, None if response.status == 200 else None, response.reason
+            if self.limiter is not None:
+                self.limiter.report(url, is_throttled(response.status))
+            return (response, None) if response.status == 200 else (None, response.reason)
         else:
             return None, 'Requests threshold reached.'
 
+    async def get_text(self, url):
+        """
+        returns page text, error_string. Connection is released back to the pool.
+        """
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if self.requests_counter >= self.requests_threshold:
+                return None, 'Requests threshold reached.'
+            self.requests_counter += 1
+            if self.limiter is not None:
+                await self.limiter.acquire_async(url)
+            async with self.session.get(url) as response:
+                text = await response.text() if response.status == 200 else None
+                throttled = is_throttled(response.status, text)
+                if self.limiter is not None:
+                    self.limiter.report(url, throttled)
+                if not throttled:
+                    return (text, None) if response.status == 200 else (None, response.reason)
+                error = f'Throttled ({response.status} {response.reason})'
+                if self.limiter is None:
+                    break
+        return None, error
+
+    async def iter_chunks(self, url, chunk_size=16384):
+        """
+        Async generator of page byte chunks. Closing it early drops the connection instead of reading the rest.
+        Throttled answers are retried after limiter backoff, like in get_text.
+        :raise aiohttp.ClientError: page is not loaded, an empty stream is never a page
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.requests_counter >= self.requests_threshold:
+                raise aiohttp.ClientError(f'Requests threshold reached, {url} is not requested')
+            if self.limiter is not None:
+                await self.limiter.acquire_async(url)
+            self.requests_counter += 1
+            async with self.session.get(url) as response:
+                throttled = is_throttled(response.status)
+                if self.limiter is not None:
+                    self.limiter.report(url, throttled)
+                if throttled and self.limiter is not None and attempt < self.max_retries:
+                    continue
+                if response.status != 200:
+                    raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                      status=response.status, message=response.reason)
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    yield chunk
+                return
+
     async def is_session_alive(self):
         async with self.session.get('https://steamcommunity.com/my/home/') as resp:
             return self.username in await resp.text()
@@ -171,6 +276,21 @@ class SteamSession:
         await asyncio.sleep(0.250)
 
 
+async def login_accounts(credentials_json_paths):
+    """
+    Logs accounts in one by one in this process, which has a console for steam guard codes, and saves their cookies,
+    so worker processes start from valid cookies
+    :param credentials_json_paths: path or list of paths
+    """
+    paths = [credentials_json_paths] if isinstance(credentials_json_paths, str) else credentials_json_paths
+    for path in paths:
+        session = SteamSession(path)
+        try:
+            await session.try_init_cookies()
+        finally:
+            await session.aio_destructor()
+
+
 async def main():
     ss = SteamSession('/home/issokov/Desktop/credentials.txt')
     await ss.try_init_cookies()